@@ -4,10 +4,16 @@ from django import forms
 from django.utils.safestring import mark_safe
 from django.urls import reverse
 
-from balance_service.utils import su_calculators
+from balance_service.utils import ledger, su_calculators
 from util.keycloak_client import KeycloakClient
 
-from .models import Allocation, Charge
+from .models import (
+    Allocation,
+    ArchivedCharge,
+    Charge,
+    ChargeAuditRun,
+    ChargeDiscrepancy,
+)
 
 
 class ChargeInline(admin.TabularInline):
@@ -32,6 +38,23 @@ class ChargeInline(admin.TabularInline):
         return False
 
 
+class ArchivedChargeInline(admin.TabularInline):
+    model = ArchivedCharge
+    extra = 0
+    fields = ChargeInline.fields + ["archived_at"]
+    readonly_fields = fields
+    verbose_name_plural = "archived charges"
+
+    def has_add_permission(self, request, obj):
+        return False
+
+    def has_change_permission(self, request, obj):
+        return False
+
+    def has_delete_permission(self, request, obj):
+        return False
+
+
 class AllocationAdmin(admin.ModelAdmin):
     def project_title(self, obj):
         return str(obj.project.title)
@@ -316,6 +339,11 @@ class AllocationAdmin(admin.ModelAdmin):
         </table>
         """)
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Charges added inline bypass the enforcement path, so resync the ledger
+        ledger.rebuild(form.instance)
+
     def alloc_count(self, obj):
         return obj.project.allocations.count()
 
@@ -375,7 +403,7 @@ class AllocationAdmin(admin.ModelAdmin):
         "project__pi__last_name",
     ]
     list_filter = ["status", "date_requested"]
-    inlines = [ChargeInline]
+    inlines = [ChargeInline, ArchivedChargeInline]
     # form = ReviewAllocationForm
 
     class Media:
@@ -386,3 +414,53 @@ class AllocationAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Allocation, AllocationAdmin)
+
+
+class ReadOnlyAdmin(admin.ModelAdmin):
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class ChargeAuditRunAdmin(ReadOnlyAdmin):
+    def discrepancies(self, obj):
+        url = reverse("admin:allocations_chargediscrepancy_changelist")
+        return mark_safe(
+            f'<a href="{url}?run__id__exact={obj.pk}">'
+            f"{obj.discrepancy_count} discrepancies</a>"
+        )
+
+    list_display = [
+        "started_at",
+        "finished_at",
+        "status",
+        "regions",
+        "portal_reservations",
+        "openstack_reservations",
+        "discrepancies",
+    ]
+    list_filter = ["status"]
+    ordering = ["-started_at"]
+
+
+class ChargeDiscrepancyAdmin(ReadOnlyAdmin):
+    list_display = [
+        "resource_id",
+        "region_name",
+        "kind",
+        "portal_value",
+        "openstack_value",
+        "run",
+    ]
+    list_filter = ["kind", "region_name", "run"]
+    list_select_related = ["run"]
+    search_fields = ["resource_id"]
+
+
+admin.site.register(ChargeAuditRun, ChargeAuditRunAdmin)
+admin.site.register(ChargeDiscrepancy, ChargeDiscrepancyAdmin)
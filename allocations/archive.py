@@ -0,0 +1,115 @@
+"""Archival of the charges of long inactive allocations.
+
+Enforcement only reads the charges of active allocations, but ``Charge`` keeps
+every charge ever written. :func:`archive_charges` moves the charges of
+allocations that expired more than ``ALLOCATIONS_CHARGE_ARCHIVE_AFTER_DAYS``
+ago into ``ArchivedCharge``, keeping their ids, so the hot table only grows
+with the number of recent charges.
+
+Code reading charges of past allocations goes through :func:`all_charges`,
+which reads both tables. Archived charges keep counting in the allocation
+ledgers and in the SU rollups.
+"""
+
+import itertools
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from allocations.models import Allocation, ArchivedCharge, Charge
+
+LOG = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+_ARCHIVED_FIELDS = [
+    "id",
+    "allocation_id",
+    "user_id",
+    "region_name",
+    "resource_id",
+    "resource_type",
+    "start_time",
+    "end_time",
+    "hourly_cost",
+    "updated_at",
+]
+
+
+def archivable_allocations(now=None):
+    """Inactive allocations whose charges all ended before the cutoff."""
+    now = now or timezone.now()
+    cutoff = now - timezone.timedelta(
+        days=settings.ALLOCATIONS_CHARGE_ARCHIVE_AFTER_DAYS
+    )
+    return (
+        Allocation.objects.filter(status="inactive", expiration_date__lt=cutoff)
+        .filter(charges__isnull=False)
+        .exclude(charges__end_time__gt=cutoff)
+        .exclude(charges__end_time__isnull=True)
+        .distinct()
+    )
+
+
+def archive_allocation(allocation_id):
+    """Move all charges of an allocation to ``ArchivedCharge``.
+
+    Charges are moved in batches, each in its own transaction. Returns the
+    number of charges moved.
+    """
+    moved = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Charge.objects.select_for_update()
+                .filter(allocation_id=allocation_id)
+                .order_by("pk")
+                .values_list(*_ARCHIVED_FIELDS)[:BATCH_SIZE]
+            )
+            if not rows:
+                break
+            ArchivedCharge.objects.bulk_create(
+                [ArchivedCharge(**dict(zip(_ARCHIVED_FIELDS, row))) for row in rows]
+            )
+            # Archived charges still count in the rollups, so skip the delete
+            # signals, which would take them out, and delete the whole batch
+            # at once. Nothing references charges.
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {Charge._meta.db_table} "
+                    f"WHERE id IN ({', '.join(['%s'] * len(rows))})",
+                    [row[0] for row in rows],
+                )
+            moved += len(rows)
+    return moved
+
+
+def archive_charges(now=None):
+    """Archive the charges of every archivable allocation.
+
+    Returns the number of charges moved.
+    """
+    moved = 0
+    allocation_ids = list(archivable_allocations(now).values_list("pk", flat=True))
+    for allocation_id in allocation_ids:
+        try:
+            moved += archive_allocation(allocation_id)
+        except Exception:
+            LOG.exception(f"Error archiving charges of allocation {allocation_id}")
+    LOG.info(f"Archived {moved} charges of {len(allocation_ids)} allocations")
+    return moved
+
+
+def all_charges(*args, **filters):
+    """Charges matching the filters, whether archived or not.
+
+    Takes the same filters as ``Charge.objects.filter``. Returns ``Charge``
+    instances followed by ``ArchivedCharge`` instances, which have the same
+    fields.
+    """
+    return itertools.chain(
+        Charge.objects.filter(*args, **filters),
+        ArchivedCharge.objects.filter(*args, **filters),
+    )
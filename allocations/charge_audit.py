@@ -0,0 +1,219 @@
+"""Audit of portal charges against the reservations recorded in OpenStack.
+
+:func:`run` compares the latest charge of each reservation with what Blazar
+records for it in each region, and saves the differences as
+``ChargeDiscrepancy`` rows of a ``ChargeAuditRun``. Both sides are read in
+reservation id order, the portal with a chunked queryset iterator and the
+region with server-side cursors, and merged like a sorted merge join, so memory
+use does not grow with the number of charges. Regions are audited in parallel,
+each in its own thread.
+
+Only reservations whose lease started in the last
+``ALLOCATIONS_CHARGE_AUDIT_WINDOW_DAYS`` are compared, on both sides. Charges
+still waiting for their reservation id are skipped.
+"""
+
+import contextlib
+import heapq
+import itertools
+import logging
+from datetime import timezone as dt_timezone
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from allocations.models import Charge, ChargeAuditRun, ChargeDiscrepancy
+from balance_service.enforcement.usage_enforcement import TMP_RESOURCE_ID_PREFIX
+
+from . import region_db, utils
+
+LOG = logging.getLogger(__name__)
+
+CHUNK_SIZE = 2000
+BATCH_SIZE = 500
+COST_TOLERANCE = 1e-6
+
+_OPENSTACK_QUERIES = [
+    utils.get_computehost_charges_by_ids,
+    utils.get_network_charges_by_ids,
+    utils.get_floatingip_charges_by_ids,
+]
+
+
+def _utc(dt):
+    return dt.astimezone(dt_timezone.utc).strftime(utils.DATETIME_FORMAT)
+
+
+def portal_reservations(region, started_after):
+    """``(resource_id, end_time, hourly_cost)`` of reservations, in id order.
+
+    A reservation charged to several allocations has several charges, so its
+    last charge is the one compared, as OpenStack only keeps the last state
+    of a lease.
+    """
+    rows = (
+        Charge.objects.filter(region_name=region, end_time__gte=started_after)
+        .exclude(resource_id__startswith=TMP_RESOURCE_ID_PREFIX)
+        .order_by("resource_id", "-end_time")
+        .values_list("resource_id", "start_time", "end_time", "hourly_cost")
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    for resource_id, charges in itertools.groupby(rows, key=itemgetter(0)):
+        charges = list(charges)
+        _, start_time, end_time, hourly_cost = charges[0]
+        start_time = min(charge[1] for charge in charges)
+        if start_time >= started_after:
+            yield resource_id, _utc(end_time), float(hourly_cost)
+
+
+def openstack_reservations(region, started_after):
+    """``(resource_id, end_time, hourly_cost)`` of reservations, in id order.
+
+    Each kind of reservation is streamed on its own connection. Hosts or
+    networks with different SU factors come in separate rows, which are
+    summed.
+    """
+    with contextlib.ExitStack() as stack:
+        streams = []
+        for query in _OPENSTACK_QUERIES:
+            db = stack.enter_context(region_db.connection(region))
+            streams.append(query(db, started_after=_utc(started_after), stream=True))
+        records = heapq.merge(*streams, key=itemgetter("resource_id"))
+        for resource_id, rows in itertools.groupby(
+            records, key=itemgetter("resource_id")
+        ):
+            rows = list(rows)
+            yield (
+                resource_id,
+                max(row["end_time"] for row in rows),
+                sum(row["hourly_cost"] for row in rows),
+            )
+
+
+def _in_order(reservations, source, counts):
+    previous = None
+    for reservation in reservations:
+        if previous is not None and reservation[0] <= previous:
+            raise ValueError(
+                f"{source} reservations are not sorted by id at {reservation[0]}"
+            )
+        previous = reservation[0]
+        counts[source] += 1
+        yield reservation
+
+
+def _describe(reservation):
+    _, end_time, hourly_cost = reservation
+    return f"ends {end_time}, {hourly_cost:g} SU/h"
+
+
+def compare(portal, openstack, counts=None):
+    """Merge two streams of reservations sorted by id.
+
+    Args:
+        portal: ``(resource_id, end_time, hourly_cost)`` from the portal.
+        openstack: the same from OpenStack.
+        counts (dict): if given, the number of reservations read from each
+            side is added to it, under ``"portal"`` and ``"openstack"``.
+
+    Yields:
+        ``(resource_id, kind, portal_value, openstack_value)`` for each
+        discrepancy, ``kind`` being one of ``ChargeDiscrepancy.KINDS``.
+    """
+    if counts is None:
+        counts = {}
+    counts.setdefault("portal", 0)
+    counts.setdefault("openstack", 0)
+    portal = _in_order(portal, "portal", counts)
+    openstack = _in_order(openstack, "openstack", counts)
+    p = next(portal, None)
+    o = next(openstack, None)
+    while p is not None or o is not None:
+        if o is None or (p is not None and p[0] < o[0]):
+            yield p[0], ChargeDiscrepancy.MISSING_IN_OPENSTACK, _describe(p), ""
+            p = next(portal, None)
+        elif p is None or o[0] < p[0]:
+            yield o[0], ChargeDiscrepancy.MISSING_IN_PORTAL, "", _describe(o)
+            o = next(openstack, None)
+        else:
+            if p[1] != o[1]:
+                yield p[0], ChargeDiscrepancy.END_TIME, p[1], o[1]
+            if abs(p[2] - o[2]) > COST_TOLERANCE:
+                yield p[0], ChargeDiscrepancy.HOURLY_COST, f"{p[2]:g}", f"{o[2]:g}"
+            p = next(portal, None)
+            o = next(openstack, None)
+
+
+def _audit_region(audit_run, region):
+    counts = {"portal": 0, "openstack": 0}
+    batch = []
+    for resource_id, kind, portal_value, openstack_value in compare(
+        portal_reservations(region, audit_run.window_start),
+        openstack_reservations(region, audit_run.window_start),
+        counts,
+    ):
+        batch.append(
+            ChargeDiscrepancy(
+                run=audit_run,
+                region_name=region,
+                resource_id=resource_id,
+                kind=kind,
+                portal_value=portal_value,
+                openstack_value=openstack_value,
+            )
+        )
+        if len(batch) >= BATCH_SIZE:
+            ChargeDiscrepancy.objects.bulk_create(batch)
+            batch = []
+    ChargeDiscrepancy.objects.bulk_create(batch)
+    return counts
+
+
+def _audit_region_thread(audit_run, region):
+    try:
+        return _audit_region(audit_run, region)
+    finally:
+        # The portal connection opened by this thread
+        connection.close()
+
+
+def run(now=None, regions=None):
+    """Audit the charges of every region with a configured database.
+
+    Regions are audited in parallel, and the discrepancies of each region are
+    saved as they are found. A region that fails is logged and marks the run
+    as failed, keeping the discrepancies found until then.
+
+    Returns:
+        The ``ChargeAuditRun``.
+    """
+    now = now or timezone.now()
+    if regions is None:
+        regions = sorted(settings.REGION_OPENSTACK_DB_CONNECT)
+    audit_run = ChargeAuditRun.objects.create(
+        window_start=now
+        - timezone.timedelta(days=settings.ALLOCATIONS_CHARGE_AUDIT_WINDOW_DAYS),
+        regions=", ".join(regions),
+    )
+    results = region_db.map_regions(
+        lambda region: _audit_region_thread(audit_run, region), regions
+    )
+    counts = {
+        source: sum(result[source] for result in results.values())
+        for source in ("portal", "openstack")
+    }
+    failed = len(results) < len(regions)
+    audit_run.discrepancy_count = audit_run.discrepancies.count()
+    audit_run.portal_reservations = counts["portal"]
+    audit_run.openstack_reservations = counts["openstack"]
+    audit_run.status = ChargeAuditRun.FAILED if failed else ChargeAuditRun.SUCCEEDED
+    audit_run.finished_at = timezone.now()
+    audit_run.save()
+    LOG.info(
+        f"Charge audit {audit_run.pk}: {audit_run.discrepancy_count} discrepancies "
+        f"in {counts['portal']} portal and {counts['openstack']} OpenStack "
+        f"reservations"
+    )
+    return audit_run
@@ -0,0 +1,142 @@
+"""Reconciliation of Keycloak group attributes with allocation state.
+
+Each Keycloak group of a project has a ``has_active_allocation`` attribute
+that the rest of the testbed reads. :func:`reconcile` fetches every group
+once, page by page, diffs their attributes against the projects that have an
+active allocation in the portal, and corrects the groups that disagree. The
+corrections are made by a few threads at a time, in batches with a pause in
+between.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from allocations.models import Allocation
+from projects.models import Project
+from util.keycloak_client import KeycloakClient
+
+LOG = logging.getLogger(__name__)
+
+ATTRIBUTE = "has_active_allocation"
+PAGE_SIZE = 500
+WORKERS = 4
+BATCH_SIZE = 20
+BATCH_PAUSE_SECONDS = 0.5
+
+
+def diff(groups, active_charge_codes, charge_codes):
+    """Find the groups whose attribute disagrees with the portal.
+
+    Args:
+        groups (dict): Keycloak groups by name.
+        active_charge_codes (set): charge codes with an active allocation.
+        charge_codes (set): every project's charge code.
+
+    Returns:
+        A tuple of the groups to activate, the groups to deactivate and the
+        active charge codes without a group.
+    """
+    to_activate = []
+    to_deactivate = []
+    missing = []
+    for charge_code in charge_codes:
+        group = groups.get(charge_code)
+        if group is None:
+            if charge_code in active_charge_codes:
+                missing.append(charge_code)
+            continue
+        is_active = "true" in group.get("attributes", {}).get(ATTRIBUTE, [])
+        if charge_code in active_charge_codes and not is_active:
+            to_activate.append(group)
+        elif charge_code not in active_charge_codes and is_active:
+            to_deactivate.append(group)
+    return to_activate, to_deactivate, missing
+
+
+def _apply(keycloak_client, groups_admin, corrections):
+    """Make ``(group, active)`` corrections, returning the number that failed."""
+    failed = 0
+
+    def correct(correction):
+        group, active = correction
+        try:
+            keycloak_client.update_group(
+                group,
+                keycloakproject=groups_admin,
+                **{ATTRIBUTE: "true" if active else "false"},
+            )
+            return True
+        except Exception:
+            LOG.exception(f"Failed to update project {group['name']} in Keycloak")
+            return False
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        for start in range(0, len(corrections), BATCH_SIZE):
+            if start:
+                time.sleep(BATCH_PAUSE_SECONDS)
+            batch = corrections[start : start + BATCH_SIZE]
+            failed += sum(not ok for ok in executor.map(correct, batch))
+    return failed
+
+
+def reconcile(keycloak_client=None):
+    """Correct the ``has_active_allocation`` attribute of Keycloak groups.
+
+    Returns:
+        A dict of counts and durations in seconds for the run.
+    """
+    started = time.perf_counter()
+    keycloak_client = keycloak_client or KeycloakClient()
+    # The admin token is renewed by the client as needed during the run
+    groups_admin = keycloak_client._project_admin()
+
+    groups = {
+        group["name"]: group
+        for group in keycloak_client.iter_groups(
+            page_size=PAGE_SIZE, keycloakproject=groups_admin
+        )
+    }
+    fetched = time.perf_counter()
+
+    active_charge_codes = set(
+        Allocation.objects.filter(status="active").values_list(
+            "project__charge_code", flat=True
+        )
+    )
+    charge_codes = set(Project.objects.values_list("charge_code", flat=True))
+    to_activate, to_deactivate, missing = diff(
+        groups, active_charge_codes, charge_codes
+    )
+    for group in to_activate:
+        LOG.warning(
+            f"CONSISTENCY: Project {group['name']} with active allocation not active in Keycloak"
+        )
+    for group in to_deactivate:
+        LOG.warning(
+            f"CONSISTENCY: Project {group['name']} without active allocation is active in Keycloak"
+        )
+    for charge_code in missing:
+        LOG.warning(f"CONSISTENCY: Project {charge_code} has no group in Keycloak")
+    diffed = time.perf_counter()
+
+    corrections = [(group, True) for group in to_activate] + [
+        (group, False) for group in to_deactivate
+    ]
+    failed = _apply(keycloak_client, groups_admin, corrections)
+    applied = time.perf_counter()
+
+    report = {
+        "groups": len(groups),
+        "projects": len(charge_codes),
+        "activated": len(to_activate),
+        "deactivated": len(to_deactivate),
+        "missing_groups": len(missing),
+        "failed": failed,
+        "fetch_seconds": round(fetched - started, 3),
+        "diff_seconds": round(diffed - fetched, 3),
+        "apply_seconds": round(applied - diffed, 3),
+        "total_seconds": round(applied - started, 3),
+    }
+    LOG.info(f"Keycloak consistency check: {report}")
+    return report
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.20 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allocations', '0011_allocation_ticket_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AllocationLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('committed_sus', models.FloatField(default=0.0)),
+                ('settled_sus', models.FloatField(default=0.0)),
+                ('settled_until', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('allocation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='ledger', to='allocations.allocation')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.20 on 2026-10-18 14:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('allocations', '0012_allocationledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AllocationUserLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('committed_sus', models.FloatField(default=0.0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('allocation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_ledgers', to='allocations.allocation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allocation_ledgers', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('allocation', 'user')},
+            },
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.20 on 2026-10-18 15:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0042_alter_publicationsource_approved_with_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('allocations', '0013_allocationuserledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charge',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='ChargeRollupState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('charge_id', models.IntegerField(unique=True)),
+                ('project_id', models.IntegerField()),
+                ('allocation_id', models.IntegerField()),
+                ('region_name', models.CharField(max_length=255)),
+                ('user_id', models.IntegerField()),
+                ('resource_type', models.CharField(max_length=255)),
+                ('hour', models.DateTimeField()),
+                ('sus', models.FloatField()),
+                ('deleted', models.BooleanField(db_index=True, default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('value', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChargeRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'hour'), ('day', 'day')], max_length=8)),
+                ('bucket', models.DateTimeField()),
+                ('region_name', models.CharField(max_length=255)),
+                ('resource_type', models.CharField(max_length=255)),
+                ('sus', models.FloatField(default=0.0)),
+                ('charge_count', models.IntegerField(default=0)),
+                ('allocation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='charge_rollups', to='allocations.allocation')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='charge_rollups', to='projects.project')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='charge_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('granularity', 'bucket', 'project', 'allocation', 'region_name', 'user', 'resource_type')},
+            },
+        ),
+    ]
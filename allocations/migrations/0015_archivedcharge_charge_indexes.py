@@ -0,0 +1,58 @@
+# Generated by Django 4.2.20 on 2026-10-18 16:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+RESOURCE_INDEX = "allocations_charge_resource_region_idx"
+
+
+def add_resource_index(apps, schema_editor):
+    # region_name and resource_id are unbounded text columns, which MySQL can
+    # only index up to a prefix length
+    if schema_editor.connection.vendor == "mysql":
+        columns = "resource_id(191), region_name(64)"
+    else:
+        columns = "resource_id, region_name"
+    schema_editor.execute(
+        f"CREATE INDEX {RESOURCE_INDEX} ON allocations_charge ({columns})"
+    )
+
+
+def remove_resource_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "mysql":
+        schema_editor.execute(f"DROP INDEX {RESOURCE_INDEX} ON allocations_charge")
+    else:
+        schema_editor.execute(f"DROP INDEX {RESOURCE_INDEX}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('allocations', '0014_charge_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_resource_index, remove_resource_index),
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(fields=['allocation', 'user'], name='allocations_allocat_7a3145_idx'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedCharge',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('region_name', models.TextField()),
+                ('resource_id', models.TextField()),
+                ('resource_type', models.TextField()),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField(null=True)),
+                ('hourly_cost', models.FloatField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('allocation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_charges', to='allocations.allocation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_charges', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
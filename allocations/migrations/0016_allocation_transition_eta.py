@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-18 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allocations', '0015_archivedcharge_charge_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='allocation',
+            name='transition_eta',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.20 on 2026-10-18 18:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allocations', '0016_allocation_transition_eta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChargeAuditRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('running', 'running'), ('succeeded', 'succeeded'), ('failed', 'failed')], default='running', max_length=16)),
+                ('window_start', models.DateTimeField()),
+                ('regions', models.TextField(blank=True)),
+                ('portal_reservations', models.IntegerField(default=0)),
+                ('openstack_reservations', models.IntegerField(default=0)),
+                ('discrepancy_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChargeDiscrepancy',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('region_name', models.CharField(max_length=255)),
+                ('resource_id', models.CharField(max_length=255)),
+                ('kind', models.CharField(choices=[('end_time', 'end time mismatch'), ('hourly_cost', 'hourly cost mismatch'), ('missing_in_openstack', 'missing in OpenStack'), ('missing_in_portal', 'missing in portal')], max_length=32)),
+                ('portal_value', models.CharField(blank=True, max_length=255)),
+                ('openstack_value', models.CharField(blank=True, max_length=255)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='discrepancies', to='allocations.chargeauditrun')),
+            ],
+            options={
+                'verbose_name_plural': 'charge discrepancies',
+            },
+        ),
+    ]
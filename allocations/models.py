@@ -1,7 +1,9 @@
 import logging
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.core.validators import MinValueValidator
 from projects.models import Project
 from util.consts import allocation
@@ -51,6 +53,8 @@ class Allocation(models.Model):
     balance_service_version = models.IntegerField(default=2, null=False)
     low_allocation_warning_issued = models.DateTimeField(null=True)
     ticket_id = models.CharField(max_length=100, null=True, blank=True)
+    # When the job activating or expiring this allocation was scheduled for
+    transition_eta = models.DateTimeField(null=True, blank=True)
 
     def as_dict(self):
         return Allocation.to_dict(self)
@@ -101,6 +105,45 @@ class Charge(models.Model):
     start_time = models.DateTimeField()
     end_time = models.DateTimeField(null=True)
     hourly_cost = models.FloatField()
+    # Set explicitly by queryset updates, which bypass auto_now
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        # (resource_id, region_name) is also indexed, with prefix lengths on
+        # MySQL, by migration 0015, as Index cannot declare those
+        indexes = [
+            models.Index(fields=["allocation", "user"]),
+        ]
+
+    def __str__(self):
+        return f"{self.allocation.project}: {self.start_time}-{self.end_time}"
+
+
+class ArchivedCharge(models.Model):
+    """A charge of a long inactive allocation, moved out of ``Charge``.
+
+    Keeps the id the charge had. Charges are moved here by
+    ``allocations.archive.archive_charges``, and can be read along with the
+    charges that were not archived with ``allocations.archive.all_charges``.
+    """
+
+    id = models.IntegerField(primary_key=True)
+    allocation = models.ForeignKey(
+        Allocation, related_name="archived_charges", on_delete=models.CASCADE
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="archived_charges",
+        on_delete=models.CASCADE,
+    )
+    region_name = models.TextField()
+    resource_id = models.TextField()
+    resource_type = models.TextField()
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField(null=True)
+    hourly_cost = models.FloatField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"{self.allocation.project}: {self.start_time}-{self.end_time}"
@@ -120,3 +163,202 @@ class ChargeBudget(models.Model):
             "user",
             "project",
         )
+
+
+class AllocationLedger(models.Model):
+    """Running SU counters for an allocation, maintained as charges are written.
+
+    ``committed_sus`` is the sum of the total cost of every charge of the
+    allocation. ``settled_sus`` is the part of it contributed by charges that
+    ended at or before ``settled_until``; only charges ending after that
+    checkpoint need to be read to compute the used SUs.
+    """
+
+    allocation = models.OneToOneField(
+        Allocation, related_name="ledger", on_delete=models.CASCADE
+    )
+    committed_sus = models.FloatField(default=0.0)
+    settled_sus = models.FloatField(default=0.0)
+    settled_until = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.allocation}: {self.settled_sus}/{self.committed_sus}"
+
+
+class AllocationUserLedger(models.Model):
+    """Running total SU cost of the charges of one user on an allocation.
+
+    Maintained alongside ``AllocationLedger``, and locked to check a user's
+    ``ChargeBudget`` without aggregating their charges.
+    """
+
+    allocation = models.ForeignKey(
+        Allocation, related_name="user_ledgers", on_delete=models.CASCADE
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="allocation_ledgers",
+        on_delete=models.CASCADE,
+    )
+    committed_sus = models.FloatField(default=0.0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (
+            "allocation",
+            "user",
+        )
+
+    def __str__(self):
+        return f"{self.allocation} {self.user}: {self.committed_sus}"
+
+
+class ChargeRollup(models.Model):
+    """Total SU cost of the charges starting in an hour or a day.
+
+    Charges are attributed in full to the bucket their start time falls in,
+    in the current time zone. Rows are maintained by
+    ``allocations.rollups.refresh``.
+    """
+
+    HOUR = "hour"
+    DAY = "day"
+    GRANULARITIES = (
+        (HOUR, "hour"),
+        (DAY, "day"),
+    )
+
+    granularity = models.CharField(max_length=8, choices=GRANULARITIES)
+    bucket = models.DateTimeField()
+    project = models.ForeignKey(
+        Project, related_name="charge_rollups", on_delete=models.CASCADE
+    )
+    allocation = models.ForeignKey(
+        Allocation, related_name="charge_rollups", on_delete=models.CASCADE
+    )
+    region_name = models.CharField(max_length=255)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="charge_rollups",
+        on_delete=models.CASCADE,
+    )
+    resource_type = models.CharField(max_length=255)
+    sus = models.FloatField(default=0.0)
+    charge_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (
+            "granularity",
+            "bucket",
+            "project",
+            "allocation",
+            "region_name",
+            "user",
+            "resource_type",
+        )
+
+    def __str__(self):
+        return f"{self.project} {self.granularity} {self.bucket}: {self.sus}"
+
+
+class ChargeRollupState(models.Model):
+    """What a charge last contributed to ``ChargeRollup``.
+
+    Lets a charge that was shortened, forked or deleted since it was rolled up
+    be taken out of its old buckets. Ids are not foreign keys, so the state
+    outlives the charge until the rollup has processed its deletion.
+    """
+
+    charge_id = models.IntegerField(unique=True)
+    project_id = models.IntegerField()
+    allocation_id = models.IntegerField()
+    region_name = models.CharField(max_length=255)
+    user_id = models.IntegerField()
+    resource_type = models.CharField(max_length=255)
+    hour = models.DateTimeField()
+    sus = models.FloatField()
+    deleted = models.BooleanField(default=False, db_index=True)
+
+
+class RollupWatermark(models.Model):
+    """Up to when changes have been rolled up, by rollup name."""
+
+    name = models.CharField(max_length=255, unique=True)
+    value = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+
+class ChargeAuditRun(models.Model):
+    """A comparison of portal charges with the reservations in OpenStack.
+
+    Runs are made by ``allocations.charge_audit.run``, and list what they
+    found as ``ChargeDiscrepancy`` rows.
+    """
+
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUSES = (
+        (RUNNING, "running"),
+        (SUCCEEDED, "succeeded"),
+        (FAILED, "failed"),
+    )
+
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUSES, default=RUNNING)
+    # Reservations that started after this were audited
+    window_start = models.DateTimeField()
+    regions = models.TextField(blank=True)
+    portal_reservations = models.IntegerField(default=0)
+    openstack_reservations = models.IntegerField(default=0)
+    discrepancy_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"Charge audit {self.started_at} ({self.status})"
+
+
+class ChargeDiscrepancy(models.Model):
+    """A reservation whose charge disagrees with OpenStack."""
+
+    END_TIME = "end_time"
+    HOURLY_COST = "hourly_cost"
+    MISSING_IN_OPENSTACK = "missing_in_openstack"
+    MISSING_IN_PORTAL = "missing_in_portal"
+    KINDS = (
+        (END_TIME, "end time mismatch"),
+        (HOURLY_COST, "hourly cost mismatch"),
+        (MISSING_IN_OPENSTACK, "missing in OpenStack"),
+        (MISSING_IN_PORTAL, "missing in portal"),
+    )
+
+    run = models.ForeignKey(
+        ChargeAuditRun, related_name="discrepancies", on_delete=models.CASCADE
+    )
+    region_name = models.CharField(max_length=255)
+    resource_id = models.CharField(max_length=255)
+    kind = models.CharField(max_length=32, choices=KINDS)
+    portal_value = models.CharField(max_length=255, blank=True)
+    openstack_value = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        verbose_name_plural = "charge discrepancies"
+
+    def __str__(self):
+        return f"{self.resource_id} at {self.region_name}: {self.kind}"
+
+
+@receiver(post_delete, sender=Charge)
+def charge_deleted(sender, instance, **kwargs):
+    ChargeRollupState.objects.filter(charge_id=instance.pk).update(deleted=True)
+
+
+@receiver(post_save, sender=Allocation)
+def allocation_saved(sender, instance, **kwargs):
+    from allocations import tasks
+
+    if tasks.needs_transition_scheduling(instance):
+        transaction.on_commit(lambda: tasks.schedule_allocation_transition(instance.pk))
@@ -0,0 +1,134 @@
+"""Pooled, parallel access to the OpenStack databases of each region.
+
+Connections opened with ``utils.connect_to_region_db`` are kept in a small
+pool per region and checked with a ping before being reused. Work on several
+regions runs in parallel with :func:`map_regions`, one thread per region, and
+queries on many reservations are split into batches of ``IN_BATCH_SIZE``
+parameters. Functions run in the threads that also use the portal database
+must close their connection to it when done, as the charge audit does.
+"""
+
+import contextlib
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import utils
+
+LOG = logging.getLogger(__name__)
+
+IN_BATCH_SIZE = 500
+
+
+class ConnectionPool:
+    """Reusable connections to one region's database."""
+
+    def __init__(self, region, size):
+        self.region = region
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _checkout(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            return utils.connect_to_region_db(self.region)
+        try:
+            conn.ping()
+        except Exception:
+            LOG.info(f"Reconnecting to the {self.region} database")
+            self._discard(conn)
+            return utils.connect_to_region_db(self.region)
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        except BaseException:
+            # Also when abandoned by a generator, with results left unread
+            self._discard(conn)
+            raise
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            self._discard(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connection(region):
+    """A pooled connection to a region's database, as a context manager."""
+    with _pools_lock:
+        pool = _pools.get(region)
+        if pool is None:
+            pool = _pools[region] = ConnectionPool(
+                region, settings.ALLOCATIONS_REGION_DB_POOL_SIZE
+            )
+    return pool.connection()
+
+
+def close_all():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def batches(items):
+    """Yield ``(offset, batch)`` for consecutive batches of ``IN_BATCH_SIZE``."""
+    items = list(items)
+    for start in range(0, len(items), IN_BATCH_SIZE):
+        yield start, items[start : start + IN_BATCH_SIZE]
+
+
+def map_regions(fn, regions):
+    """Call ``fn(region)`` for each region in parallel.
+
+    Returns:
+        A dict of the result for each region. Regions for which ``fn`` raised
+        are logged and left out.
+    """
+    regions = list(regions)
+    if not regions:
+        return {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        futures = {region: executor.submit(fn, region) for region in regions}
+        for region, future in futures.items():
+            try:
+                results[region] = future.result()
+            except Exception:
+                LOG.exception(f"Error querying the {region} database")
+    return results
+
+
+def get_resource_ids(region, leases):
+    """Reservation ids of leases in a region, by index in ``leases``.
+
+    See ``utils.get_resource_ids``.
+    """
+    resource_ids = {}
+    with connection(region) as db:
+        for offset, batch in batches(leases):
+            for i, resource_id in utils.get_resource_ids(db, batch).items():
+                resource_ids[offset + i] = resource_id
+    return resource_ids
@@ -0,0 +1,219 @@
+"""Hourly and daily SU usage rollups of charges.
+
+:func:`refresh` only reads charges updated since the last run, using
+``Charge.updated_at``. What each charge contributed is remembered in
+``ChargeRollupState``, so that charges shortened by ``stop_charging``, forked
+by allocation renewals or deleted are moved out of their old buckets.
+Reports then aggregate rollup rows with :func:`usage` instead of charges, as
+of :func:`refreshed_at`; the ``rollup-charges`` beat task refreshes them.
+"""
+
+import collections
+import logging
+
+from django.db import transaction
+from django.db.models import F, Sum, functions
+from django.utils import timezone
+
+from allocations.models import (
+    Charge,
+    ChargeRollup,
+    ChargeRollupState,
+    RollupWatermark,
+)
+from balance_service.utils import ledger
+
+LOG = logging.getLogger(__name__)
+
+WATERMARK_NAME = "charge_rollups"
+# Charges updated by transactions still open when a run starts may commit
+# with an older updated_at, so each run also re-reads this much before the
+# watermark. Re-reading a charge is a no-op.
+WATERMARK_OVERLAP = timezone.timedelta(minutes=15)
+BATCH_SIZE = 2000
+
+_CHARGE_FIELDS = [
+    "id",
+    "allocation_id",
+    "allocation__project_id",
+    "region_name",
+    "user_id",
+    "resource_type",
+    "start_time",
+    "end_time",
+    "hourly_cost",
+]
+
+_KEY_FIELDS = [
+    "project_id",
+    "allocation_id",
+    "region_name",
+    "user_id",
+    "resource_type",
+]
+
+
+def _hour(dt):
+    return timezone.localtime(dt).replace(minute=0, second=0, microsecond=0)
+
+
+def _add(deltas, state, sign):
+    key = tuple(getattr(state, f) for f in _KEY_FIELDS)
+    day = timezone.localtime(state.hour).replace(hour=0)
+    buckets = ((ChargeRollup.HOUR, state.hour), (ChargeRollup.DAY, day))
+    for granularity, bucket in buckets:
+        delta = deltas[(granularity, bucket) + key]
+        delta[0] += sign * state.sus
+        delta[1] += sign
+
+
+def _apply(deltas):
+    for (granularity, bucket, *key), (sus, count) in deltas.items():
+        if not count and not sus:
+            continue
+        rollup = dict(zip(_KEY_FIELDS, key), granularity=granularity, bucket=bucket)
+        updated = ChargeRollup.objects.filter(**rollup).update(
+            sus=F("sus") + sus, charge_count=F("charge_count") + count
+        )
+        # Removals from rows that were deleted with their allocation are moot
+        if not updated and count > 0:
+            ChargeRollup.objects.create(sus=sus, charge_count=count, **rollup)
+
+
+def _process(rows, deltas):
+    """Compare a batch of charges with their last contributions."""
+    states = ChargeRollupState.objects.in_bulk(
+        [row[0] for row in rows], field_name="charge_id"
+    )
+    new_states = []
+    changed_states = []
+    for (
+        charge_id,
+        allocation_id,
+        project_id,
+        region_name,
+        user_id,
+        resource_type,
+        start_time,
+        end_time,
+        hourly_cost,
+    ) in rows:
+        current = ChargeRollupState(
+            charge_id=charge_id,
+            project_id=project_id,
+            allocation_id=allocation_id,
+            region_name=region_name,
+            user_id=user_id,
+            resource_type=resource_type,
+            hour=_hour(start_time),
+            sus=ledger.total_sus(
+                ledger.ChargeState(
+                    allocation_id, user_id, start_time, end_time, hourly_cost
+                )
+            ),
+        )
+        previous = states.get(charge_id)
+        if previous is None:
+            new_states.append(current)
+        elif all(
+            getattr(previous, f) == getattr(current, f)
+            for f in _KEY_FIELDS + ["hour", "sus"]
+        ):
+            continue
+        else:
+            _add(deltas, previous, -1)
+            current.pk = previous.pk
+            changed_states.append(current)
+        _add(deltas, current, 1)
+    ChargeRollupState.objects.bulk_create(new_states)
+    ChargeRollupState.objects.bulk_update(
+        changed_states, _KEY_FIELDS + ["hour", "sus"], batch_size=BATCH_SIZE
+    )
+
+
+def refresh(now=None):
+    """Roll up the charges changed since the last run.
+
+    Runs are serialized by locking the watermark row. Returns the number of
+    charges read.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        watermark, _ = RollupWatermark.objects.select_for_update().get_or_create(
+            name=WATERMARK_NAME
+        )
+        charges = Charge.objects.all()
+        if watermark.value is not None:
+            charges = charges.filter(updated_at__gt=watermark.value - WATERMARK_OVERLAP)
+
+        deltas = collections.defaultdict(lambda: [0.0, 0])
+        read = 0
+        batch = []
+        for row in (
+            charges.order_by()
+            .values_list(*_CHARGE_FIELDS)
+            .iterator(chunk_size=BATCH_SIZE)
+        ):
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                _process(batch, deltas)
+                read += len(batch)
+                batch = []
+        _process(batch, deltas)
+        read += len(batch)
+
+        deleted = ChargeRollupState.objects.filter(deleted=True)
+        for state in deleted:
+            _add(deltas, state, -1)
+        deleted.delete()
+
+        _apply(deltas)
+        watermark.value = now
+        watermark.save(update_fields=["value"])
+
+    LOG.info(f"Rolled up {read} charges into {len(deltas)} buckets")
+    return read
+
+
+def refreshed_at():
+    """Up to when the rollups were refreshed, or None if they never were."""
+    return (
+        RollupWatermark.objects.filter(name=WATERMARK_NAME)
+        .values_list("value", flat=True)
+        .first()
+    )
+
+
+def usage(start=None, end=None, period=None, group_by=(), **filters):
+    """Sum SUs and charge counts from the rollups.
+
+    Args:
+        start (datetime): only charges starting at or after this time.
+        end (datetime): only charges starting before this time.
+        period (str): "hour", "day", "month" or "year", to also group by the
+            period charges started in, returned as ``period``.
+        group_by (list[str]): other fields to group by, e.g. "region_name",
+            "project_id", "user_id" or "resource_type".
+        filters: ``ChargeRollup`` filters, e.g. ``project_id=...``.
+
+    Returns:
+        A list of dicts with the ``group_by`` fields, ``period`` if given,
+        ``sus`` and ``charges``, or a single such dict without grouping.
+    """
+    granularity = ChargeRollup.HOUR if period == "hour" else ChargeRollup.DAY
+    rollups = ChargeRollup.objects.filter(granularity=granularity, **filters)
+    if start:
+        rollups = rollups.filter(bucket__gte=start)
+    if end:
+        rollups = rollups.filter(bucket__lt=end)
+
+    fields = list(group_by)
+    if period:
+        rollups = rollups.annotate(period=functions.Trunc("bucket", period))
+        fields.insert(0, "period")
+    totals = dict(sus=functions.Coalesce(Sum("sus"), 0.0), charges=Sum("charge_count"))
+    if not fields:
+        result = rollups.aggregate(**totals)
+        result["charges"] = result["charges"] or 0
+        return result
+    return list(rollups.values(*fields).annotate(**totals).order_by(*fields))
@@ -7,25 +7,39 @@ from operator import attrgetter
 
 from celery.decorators import task
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import get_connection, send_mail
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import (
+    Count,
+    F,
+    FloatField,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    functions,
+)
 from django.forms.models import model_to_dict
 from django.utils import timezone
 from django.utils.html import strip_tags
 from django.urls import reverse
-from keycloak.exceptions import KeycloakClientError
 
-from allocations.models import Allocation, Charge
-from balance_service.utils.su_calculators import project_balances
+from allocations.models import Allocation, AllocationLedger, Charge
+from balance_service.utils import ledger
+from balance_service.utils.su_calculators import (
+    project_balances,
+    total_sus_expression,
+)
 from balance_service.enforcement.usage_enforcement import TMP_RESOURCE_ID_PREFIX
-from projects.models import Project
 from util.keycloak_client import KeycloakClient
 
-from . import utils
+from . import archive, charge_audit, consistency, region_db, rollups
 
 LOG = logging.getLogger(__name__)
 
+# Allocations that have used this much of their SUs get a warning
+LOW_ALLOCATION_PERCENT = 90
+
 
 def _send_expiration_warning_mail(alloc, today):
     """
@@ -142,7 +156,7 @@ def warn_user_for_expiring_allocation():
     )
 
 
-def _send_low_allocation_warning(alloc, percent_used):
+def _send_low_allocation_warning(alloc, percent_used, connection=None):
     charge_code = alloc.project.charge_code
     project_url = f'https://chameleoncloud.org{reverse("projects:view_project", args=[alloc.project.id])}'
     docs_url = (
@@ -174,6 +188,7 @@ def _send_low_allocation_warning(alloc, percent_used):
             recipient_list=[email],
             message=strip_tags(" ".join(email_body.split()).strip()),
             html_message=email_body,
+            connection=connection,
         )
     except Exception:
         pass
@@ -186,49 +201,72 @@ def warn_user_for_low_allocations():
     """
     Sends an email to users when their allocation is 90% utilized
     """
+    # Total SUs of each allocation's charges, including pending use
+    total_sus = (
+        Charge.objects.filter(allocation=OuterRef("pk"))
+        .order_by()
+        .values("allocation")
+        .annotate(total=Sum(total_sus_expression()))
+        .values("total")
+    )
     # NOTE this avoids sending a low allocation email if we've already
     # sent an expiration warning email, as if the allocation is soon expiring
     # low remaining SUs does not matter.
-    active_allocations = Allocation.objects.filter(
-        status="active",
-        low_allocation_warning_issued__isnull=True,
-        expiration_warning_issued__isnull=True,
+    low_allocations = (
+        Allocation.objects.filter(
+            status="active",
+            low_allocation_warning_issued__isnull=True,
+            expiration_warning_issued__isnull=True,
+            su_allocated__gt=0,
+        )
+        .annotate(
+            total_sus=functions.Coalesce(
+                Subquery(total_sus, output_field=FloatField()), 0.0
+            )
+        )
+        .filter(total_sus__gte=F("su_allocated") * LOW_ALLOCATION_PERCENT / 100)
+        .select_related("project__pi")
     )
 
     emails_sent = 0
-    # Iterate over all active allocations that haven't been issued warnings
-    for alloc in active_allocations:
-        # Calculate the percentage of used SUs
-        balances = project_balances([alloc.project.id])[0]
-        # Skip edge cases
-        if balances["total"] is None:
-            continue
-        percentage_used = round(100.0 * balances["total"] / balances["allocated"], 2)
-
-        # Ignore if allocation hasn't used 90% of SUs.
-        if percentage_used < 90:
-            continue
-        # Otherwise send warning mail
-        mail_sent = _send_low_allocation_warning(alloc, percentage_used)
-        charge_code = alloc.project.charge_code
-
-        # If we successfully sent mail, log it in the database
-        if mail_sent:
-            emails_sent += 1
-            LOG.info(f"Warned PI about low allocation {alloc.id}")
-            try:
-                with transaction.atomic():
-                    alloc.low_allocation_warning_issued = datetime.now(timezone.utc)
-                    alloc.save()
-            except Exception:
+    with get_connection() as connection:
+        for alloc in low_allocations:
+            percentage_used = round(100.0 * alloc.total_sus / alloc.su_allocated, 2)
+            mail_sent = _send_low_allocation_warning(
+                alloc, percentage_used, connection=connection
+            )
+            charge_code = alloc.project.charge_code
+
+            # If we successfully sent mail, log it in the database
+            if mail_sent:
+                emails_sent += 1
+                LOG.info(f"Warned PI about low allocation {alloc.id}")
+                try:
+                    Allocation.objects.filter(pk=alloc.pk).update(
+                        low_allocation_warning_issued=datetime.now(timezone.utc)
+                    )
+                except Exception:
+                    LOG.error(
+                        f"Failed to update ORM with low warning timestamp "
+                        f"for project {charge_code}."
+                    )
+            else:
                 LOG.error(
-                    f"Failed to update ORM with low warning timestamp "
-                    f"for project {charge_code}."
+                    f"Failed to send expiration warning email for project {charge_code}"
                 )
-        else:
-            LOG.error(
-                f"Failed to send expiration warning email for project {charge_code}"
-            )
+    LOG.info(f"Sent {emails_sent} low allocation warnings")
+
+
+@task
+def rollup_charges():
+    """Roll up the charges changed since the last run into usage buckets"""
+    rollups.refresh()
+
+
+@task
+def archive_charges():
+    """Move the charges of long inactive allocations out of the Charge table"""
+    archive.archive_charges()
 
 
 def _deactivate_allocation(alloc):
@@ -257,10 +295,12 @@ def _deactivate_allocation(alloc):
 
 def _fork_charge(charge, split_datetime, new_allocation):
     """Fork charge and assign to new allocation"""
+    original_state = ledger.charge_state(charge)
     # end original charge by setting the new end time
     original_end_time = charge.end_time
     charge.end_time = split_datetime
     charge.save()
+    capped_state = ledger.charge_state(charge)
 
     # create a new charge by duplicating the old one
     # set a new allocation to the new charge
@@ -272,24 +312,77 @@ def _fork_charge(charge, split_datetime, new_allocation):
     charge.end_time = original_end_time
     charge.save()
 
+    ledger.record(
+        removed=[original_state], added=[capped_state, ledger.charge_state(charge)]
+    )
+
+
+def _rollover_charges(prev_alloc, new_alloc, split_datetime):
+    """Fork the ongoing charges of an allocation into the next one.
+
+    Same as ``_fork_charge`` on each charge ending after ``split_datetime``,
+    with one update capping the charges and one insert of their continuations.
+    Returns the number of charges forked.
+    """
+    ongoing = list(
+        Charge.objects.select_for_update().filter(
+            allocation_id=prev_alloc.id, end_time__gt=split_datetime
+        )
+    )
+    if not ongoing:
+        return 0
+    original_states = [ledger.charge_state(charge) for charge in ongoing]
+    Charge.objects.filter(pk__in=[charge.pk for charge in ongoing]).update(
+        end_time=split_datetime, updated_at=timezone.now()
+    )
+    capped_states = [
+        state._replace(end_time=split_datetime) for state in original_states
+    ]
+    continuations = Charge.objects.bulk_create(
+        [
+            Charge(
+                allocation=new_alloc,
+                user_id=charge.user_id,
+                region_name=charge.region_name,
+                resource_id=charge.resource_id,
+                resource_type=charge.resource_type,
+                start_time=max(split_datetime, charge.start_time),
+                end_time=charge.end_time,
+                hourly_cost=charge.hourly_cost,
+            )
+            for charge in ongoing
+        ]
+    )
+    ledger.record(
+        removed=original_states,
+        added=capped_states + [ledger.charge_state(c) for c in continuations],
+    )
+    return len(ongoing)
+
+
+def _expire_allocation(alloc):
+    charge_code = alloc.project.charge_code
+    try:
+        with transaction.atomic():
+            # set status to inactive and set the final su_used in portal db
+            _deactivate_allocation(alloc)
+    except Exception:
+        LOG.exception(f"Error expiring project {charge_code}")
+        return False
+    LOG.info(f"Expired allocation {alloc.id} for {charge_code}")
+    return True
+
 
 def expire_allocations():
     now = timezone.now()
 
     expired_allocations = Allocation.objects.filter(
         status="active", expiration_date__lte=now
-    )
+    ).select_related("project")
     expired_alloc_count = 0
     for alloc in expired_allocations:
-        charge_code = alloc.project.charge_code
-        try:
-            with transaction.atomic():
-                # set status to inactive and set the final su_used in portal db
-                _deactivate_allocation(alloc)
-                expired_alloc_count = expired_alloc_count + 1
-        except Exception:
-            LOG.exception(f"Error expiring project {charge_code}")
-        LOG.info(f"Expired allocation {alloc.id} for {charge_code}")
+        if _expire_allocation(alloc):
+            expired_alloc_count = expired_alloc_count + 1
 
     LOG.debug(
         "need to expire {} allocations, and {} were actually expired".format(
@@ -299,7 +392,16 @@ def expire_allocations():
 
 
 def deactivate_multiple_active_allocations_of_projects():
-    active_allocs = Allocation.objects.filter(status="active")
+    projects_with_duplicates = (
+        Allocation.objects.filter(status="active")
+        .values("project_id")
+        .annotate(active_count=Count("pk"))
+        .filter(active_count__gt=1)
+        .values("project_id")
+    )
+    active_allocs = Allocation.objects.filter(
+        status="active", project_id__in=projects_with_duplicates
+    ).select_related("project")
     project_allocations = defaultdict(list)
     for alloc in active_allocs:
         project_allocations[alloc.project_id].append(alloc)
@@ -324,88 +426,213 @@ def deactivate_multiple_active_allocations_of_projects():
                 )
 
 
+def _active_allocations(project_ids):
+    """The active allocation of each project, by project id."""
+    return {
+        alloc.project_id: alloc
+        for alloc in Allocation.objects.filter(
+            status="active", project_id__in=project_ids
+        ).select_related("project")
+    }
+
+
+def _activate_allocation(alloc, now, active_allocations=None):
+    charge_code = alloc.project.charge_code
+    # deactivate active allocation for the project and set status to active
+    if active_allocations is None:
+        active_allocations = _active_allocations([alloc.project_id])
+    prev_alloc = active_allocations.get(alloc.project_id)
+    try:
+        with transaction.atomic():
+            if prev_alloc:
+                _deactivate_allocation(prev_alloc)
+                # duplicate the ongoing charges
+                _rollover_charges(prev_alloc, alloc, now)
+            LOG.info(f"Activating allocation {alloc.id} for project {charge_code}")
+            alloc.status = "active"
+            alloc.save()
+            keycloak_client = KeycloakClient()
+            keycloak_client.update_project(charge_code, has_active_allocation="true")
+
+            updated_project = keycloak_client._lookup_group(charge_code)
+            LOG.info(
+                f"Project {charge_code} should have active allocation in Keycloak: "
+                f"{updated_project.get('attributes')}"
+            )
+    except Exception:
+        LOG.exception(f"Error activating project {charge_code}")
+        return False
+    active_allocations[alloc.project_id] = alloc
+    LOG.info(f"Started allocation {alloc.id} for {charge_code}")
+    return True
+
+
 def active_approved_allocations():
     now = timezone.now()
 
-    approved_allocations = Allocation.objects.filter(
-        status="approved", start_date__lte=now
+    approved_allocations = list(
+        Allocation.objects.filter(status="approved", start_date__lte=now)
+        .select_related("project")
+        .order_by("start_date")
+    )
+    active_allocations = _active_allocations(
+        {alloc.project_id for alloc in approved_allocations}
     )
     activated_alloc_count = 0
     for alloc in approved_allocations:
-        charge_code = alloc.project.charge_code
-        # deactivate active allocation for the project and set status to active
-        project_active_allocations = Allocation.objects.filter(
-            status="active", project_id=alloc.project.id
+        if _activate_allocation(alloc, now, active_allocations):
+            activated_alloc_count = activated_alloc_count + 1
+
+    LOG.debug(
+        "need to activated {} allocations, and {} were actually activated".format(
+            len(approved_allocations), activated_alloc_count
         )
-        prev_alloc = None
-        if len(project_active_allocations) > 0:
-            prev_alloc = project_active_allocations[0]
-        try:
-            with transaction.atomic():
-                if prev_alloc:
-                    _deactivate_allocation(prev_alloc)
-                    allocation_charges = Charge.objects.filter(
-                        allocation__id=prev_alloc.id
-                    )
-                    # duplicate the ongoing charges
-                    for c in allocation_charges:
-                        if c.end_time > now:
-                            _fork_charge(c, now, alloc)
-                LOG.info(f"Activating allocation {alloc.id} for project {charge_code}")
-                alloc.status = "active"
-                alloc.save()
-                keycloak_client = KeycloakClient()
-                keycloak_client.update_project(
-                    charge_code, has_active_allocation="true"
-                )
+    )
 
-                updated_project = keycloak_client._lookup_group(charge_code)
-                LOG.info(
-                    f"Project {charge_code} should have active allocation in Keycloak: "
-                    f"{updated_project.get('attributes')}"
+
+def _next_transition(alloc):
+    """When an allocation is next due to be activated or expired, if ever"""
+    if alloc.status == "approved":
+        return alloc.start_date
+    if alloc.status == "active":
+        return alloc.expiration_date
+    return None
+
+
+def _transition_horizon(now):
+    return now + timedelta(seconds=settings.ALLOCATIONS_TRANSITION_HORIZON_SECONDS)
+
+
+def needs_transition_scheduling(alloc):
+    """Whether a saved allocation may need its transition job (re)scheduled"""
+    eta = _next_transition(alloc)
+    if eta is None or eta > _transition_horizon(timezone.now()):
+        # Only a job scheduled earlier may need to be cancelled
+        return alloc.transition_eta is not None
+    return eta != alloc.transition_eta
+
+
+def schedule_allocation_transition(allocation_id):
+    """Enqueue a job activating or expiring an allocation when it is due.
+
+    Jobs are only enqueued for transitions due within
+    ``ALLOCATIONS_TRANSITION_HORIZON_SECONDS``, as the broker redelivers jobs
+    held for too long; the periodic sweep schedules later ones as they come
+    within the horizon. The time a job is scheduled for is kept in
+    ``Allocation.transition_eta``, so it is not scheduled twice, and jobs
+    made obsolete by a later edit do nothing.
+    """
+    with transaction.atomic():
+        alloc = Allocation.objects.select_for_update().filter(pk=allocation_id).first()
+        if alloc is None:
+            return
+        eta = _next_transition(alloc)
+        if eta is not None and eta > _transition_horizon(timezone.now()):
+            eta = None
+        if eta == alloc.transition_eta:
+            return
+        Allocation.objects.filter(pk=allocation_id).update(transition_eta=eta)
+        if eta is not None:
+            LOG.info(f"Scheduling the {alloc.status} allocation {alloc.id} for {eta}")
+            transaction.on_commit(
+                lambda: transition_allocation.apply_async(
+                    args=[allocation_id, eta.isoformat()], eta=eta
                 )
+            )
 
-                activated_alloc_count = activated_alloc_count + 1
-        except Exception:
-            LOG.exception(f"Error activating project {charge_code}")
-        LOG.info(f"Started allocation {alloc.id} for {charge_code}")
 
-    LOG.debug(
-        "need to activated {} allocations, and {} were actually activated".format(
-            len(approved_allocations), activated_alloc_count
+@task
+def transition_allocation(allocation_id, eta):
+    """Activate or expire an allocation, if still due at ``eta``"""
+    with transaction.atomic():
+        alloc = (
+            Allocation.objects.select_for_update()
+            .select_related("project")
+            .filter(pk=allocation_id)
+            .first()
         )
+        if alloc is None or alloc.transition_eta != datetime.fromisoformat(eta):
+            LOG.debug(f"Skipping obsolete transition of allocation {allocation_id}")
+            return
+        alloc.transition_eta = None
+        Allocation.objects.filter(pk=allocation_id).update(transition_eta=None)
+        now = timezone.now()
+        if alloc.status == "approved" and alloc.start_date <= now:
+            _activate_allocation(alloc, now)
+        elif alloc.status == "active" and alloc.expiration_date <= now:
+            _expire_allocation(alloc)
+        else:
+            # Woken up early, e.g. by clock skew between hosts
+            transaction.on_commit(lambda: schedule_allocation_transition(allocation_id))
+
+
+def schedule_allocation_transitions():
+    """Schedule the transitions coming within the horizon, if not yet"""
+    horizon = _transition_horizon(timezone.now())
+    upcoming = (
+        Allocation.objects.filter(
+            Q(status="approved", start_date__lte=horizon)
+            | Q(status="active", expiration_date__lte=horizon)
+        )
+        .exclude(status="approved", transition_eta=F("start_date"))
+        .exclude(status="active", transition_eta=F("expiration_date"))
     )
+    for allocation_id in upcoming.values_list("pk", flat=True):
+        schedule_allocation_transition(allocation_id)
+
+
+@task
+def rebuild_allocation_ledger(allocation_id):
+    """Build the SU ledger of an allocation that was read without one."""
+    with transaction.atomic():
+        alloc = Allocation.objects.filter(pk=allocation_id).first()
+        if alloc is None:
+            return
+        current = AllocationLedger.objects.filter(allocation_id=allocation_id).first()
+        if current is not None and current.settled_until <= timezone.now():
+            # Already built since the task was queued
+            return
+        ledger.rebuild(alloc)
 
 
 @task
 def activate_expire_allocations():
+    # Allocations are activated and expired by transition_allocation jobs when
+    # due, so this only catches up on missed ones.
     # expire allocations
     expire_allocations()
     # check projects with multiple active allocations
     deactivate_multiple_active_allocations_of_projects()
     # activate allocations
     active_approved_allocations()
-    # check consistency between allocation system and Keycloak
-    check_keycloak_consistency()
+    # schedule the jobs for the next transitions
+    schedule_allocation_transitions()
 
 
 def _fill_charge_tmp_resource_ids():
     charge_by_region = defaultdict(list)
-    for charge in Charge.objects.filter(resource_id__startswith=TMP_RESOURCE_ID_PREFIX):
+    for charge in Charge.objects.filter(
+        resource_id__startswith=TMP_RESOURCE_ID_PREFIX
+    ).select_related("allocation"):
         charge_by_region[charge.region_name].append(charge)
 
-    for region in charge_by_region.keys():
-        db = utils.connect_to_region_db(region)
+    def resolve(region):
+        leases = []
         for charge in charge_by_region[region]:
             items = charge.resource_id.split("/", maxsplit=4)
             project_id = items[1]
             user_id = items[2]
             lease_start_date = items[3]
             name = items[4]
-            resource_type = charge.resource_type
-            resource_id = utils.get_resource_id(
-                db, project_id, user_id, lease_start_date, resource_type, name
+            leases.append(
+                (project_id, user_id, lease_start_date, charge.resource_type, name)
             )
+        return region_db.get_resource_ids(region, leases)
+
+    resolved = region_db.map_regions(resolve, charge_by_region.keys())
+    for region, resource_ids in resolved.items():
+        for i, charge in enumerate(charge_by_region[region]):
+            resource_id = resource_ids.get(i)
             if resource_id:
                 charge.resource_id = resource_id
                 charge.save()
@@ -416,71 +643,20 @@ def _fill_charge_tmp_resource_ids():
                     LOG.info(
                         f"The allocation uses v1 balance service, removing charge {charge_dict}"
                     )
-                    charge.delete()
+                    with transaction.atomic():
+                        ledger.record(removed=[ledger.charge_state(charge)])
+                        charge.delete()
 
 
+@task
 def check_keycloak_consistency():
-    active_projects = {
-        alloc.project.charge_code
-        for alloc in Allocation.objects.filter(status="active")
-    }
-    inactive_projects = set(
-        project.charge_code
-        for project in Project.objects.filter(~Q(charge_code__in=active_projects))
-    )
-
-    keycloak_client = KeycloakClient()
-    groups = keycloak_client._project_admin()
-    groups_url = groups._client.get_full_url(
-        groups.get_path("collection", realm=keycloak_client.realm_name)
-    )
-
-    active_groups = {
-        group.get("name")
-        for group in groups._client.get(url=groups_url, briefRepresentation=False)
-        # Filter for any groups with have `has_active_allocation` == "true"
-        if "true" in group.get("attributes", {}).get("has_active_allocation", [])
-    }
-    inactive_groups = {
-        group.get("name")
-        for group in groups._client.get(url=groups_url, briefRepresentation=False)
-        # Filter for any groups with have `has_active_allocation` == "false" or None
-        if any(
-            inactive in group.get("attributes", {}).get("has_active_allocation", [])
-            for inactive in ("false", None)
-        )
-    }
-
-    for project in active_projects:
-        if project in inactive_groups:
-            LOG.warning(
-                f"CONSISTENCY: Project {project} with active allocation not active in Keycloak"
-            )
-            try:
-                keycloak_client.update_project(project, has_active_allocation="true")
-            except KeycloakClientError:
-                # If there are many errors to correct, the client may expire
-                LOG.warning(f"Failed to update project {project} in Keycloak. Retrying")
-                keycloak_client = KeycloakClient()
-                keycloak_client.update_project(project, has_active_allocation="true")
-
-    for project in inactive_projects:
-        if project in active_groups:
-            LOG.warning(
-                f"CONSISTENCY: Project {project} without active allocation is active in Keycloak"
-            )
-            try:
-                keycloak_client.update_project(project, has_active_allocation="false")
-            except KeycloakClientError:
-                # If there are many errors to correct, the client may expire
-                LOG.warning(f"Failed to update project {project} in Keycloak. Retrying")
-                keycloak_client = KeycloakClient()
-                keycloak_client.update_project(project, has_active_allocation="false")
+    """Check consistency between allocation system and Keycloak"""
+    consistency.reconcile()
 
 
 def check_charge():
     """
-    Check if the charges of the active allocations are in sync
+    Check if the charges of the allocations are in sync
     with the actual state of openstack databases
     """
     # openstack db overwrites records for updated leases, so we
@@ -488,46 +664,9 @@ def check_charge():
     # reservation to alert on potential over-charging.
 
     _fill_charge_tmp_resource_ids()
-
-    compare_content = defaultdict(lambda: defaultdict(dict))
-    for alloc in Allocation.objects.filter(status="active"):
-        for charge in alloc.charges.all():
-            region = charge.region_name
-            resource_id = charge.resource_id
-
-            end_time = compare_content[region][resource_id].get("end_time")
-            if not end_time or end_time > charge.end_time:
-                compare_content[region][resource_id] = {
-                    "end_time": charge.end_time,
-                    "hourly_cost": charge.hourly_cost,
-                }
-    # fetch info from openstack db
-    for region in compare_content.keys():
-        db = utils.connect_to_region_db(region)
-        region_resources = compare_content[region]
-
-        openstack_records = []
-        resource_ids = list(region_resources.keys())
-        openstack_records.extend(utils.get_computehost_charges_by_ids(db, resource_ids))
-        openstack_records.extend(utils.get_network_charges_by_ids(db, resource_ids))
-        openstack_records.extend(utils.get_floatingip_charges_by_ids(db, resource_ids))
-
-        for openstack_r in openstack_records:
-            resource_id = openstack_r.get("resource_id")
-            portal_r = region_resources.get(resource_id)
-            openstack_endtime = openstack_r.get("end_time")
-            portal_endtime = portal_r.get("end_time").strftime(utils.DATETIME_FORMAT)
-            if openstack_endtime != portal_endtime:
-                pass
-                # LOG.error(
-                #     f"{resource_id} at {region} has incorrect end time! "
-                #     f"openstack={openstack_endtime}, portal={portal_endtime}"
-                # )
-            openstack_cost = openstack_r.get("hourly_cost")
-            portal_cost = float(portal_r.get("hourly_cost"))
-            if openstack_cost != portal_cost:
-                pass
-                # LOG.error(
-                #     f"{resource_id} at {region} has incorrect hourly cost! "
-                #     f"openstack={openstack_cost}, portal={portal_cost}"
-                # )
+    audit_run = charge_audit.run()
+    if audit_run.discrepancy_count:
+        LOG.error(
+            f"Charge audit {audit_run.pk} found {audit_run.discrepancy_count} "
+            "charges out of sync with OpenStack"
+        )
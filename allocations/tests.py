@@ -1,21 +1,89 @@
 import logging
+import time
 
-from datetime import timedelta
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta, timezone as dt_timezone
 from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 from projects.models import Project
-from util.keycloak_client import KeycloakClient
+from util.keycloak_client import (
+    AdminTokenManager,
+    KeycloakClient,
+    get_token_manager,
+)
 
-from allocations import tasks
-from allocations.models import Allocation
+from allocations import (
+    archive,
+    charge_audit,
+    consistency,
+    region_db,
+    rollups,
+    tasks,
+)
+from allocations.models import (
+    Allocation,
+    AllocationLedger,
+    Charge,
+    ChargeAuditRun,
+    ChargeDiscrepancy,
+)
+from balance_service.utils import ledger
+from balance_service.utils.su_calculators import get_total_sus
 
 LOG = logging.getLogger(__name__)
 
 
+class AllocationFixtures:
+    """Creates ``self.user``, the PI of ``self.project``, at ``self.now``."""
+
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.now()
+        self.user = get_user_model().objects.create_user(
+            username="test_requestor",
+            password="test_password",
+            email="test_requestor@example.com",
+        )
+        self.project = self._create_project("TEST123")
+
+    def _create_project(self, charge_code, pi=None):
+        return Project.objects.create(
+            description="This is a test project for allocations.",
+            pi=pi or self.user,
+            title=charge_code,
+            nickname=charge_code,
+            charge_code=charge_code,
+        )
+
+    def _create_allocation(
+        self, project=None, status="active", start_date=None, days=30, **kwargs
+    ):
+        """An allocation of ``days`` from ``start_date``, now by default."""
+        start_date = start_date or self.now
+        kwargs.setdefault("su_requested", 1000)
+        return Allocation.objects.create(
+            project=project or self.project,
+            status=status,
+            requestor=self.user,
+            date_requested=kwargs.pop("date_requested", self.now),
+            start_date=start_date,
+            expiration_date=start_date + timedelta(days=days),
+            **kwargs,
+        )
+
+
+class AllocationTestCase(AllocationFixtures, TestCase):
+    pass
+
+
 class StatusTests(TestCase):
     def setUp(self):
         User = get_user_model()
@@ -417,3 +485,817 @@ class ExpireTests(TestCase):
         for alloc in expired_allocations:
             self.assertTrue(alloc.status, "active")
             alloc.delete()
+
+
+class RollupTests(AllocationTestCase):
+    def setUp(self):
+        super().setUp()
+        self.allocation = self._create_allocation(
+            start_date=self.now - timedelta(days=30), days=60, su_allocated=1000
+        )
+        self.charges = [
+            Charge.objects.create(
+                allocation=self.allocation,
+                user=self.user,
+                region_name=region,
+                resource_id=f"res-{i}",
+                resource_type="physical:host",
+                start_time=self.now - timedelta(days=i),
+                end_time=self.now - timedelta(days=i) + timedelta(hours=2),
+                hourly_cost=1.5,
+            )
+            for i, region in enumerate(["CHI@UC", "CHI@TACC", "CHI@UC"])
+        ]
+
+    def _expected_by_region(self):
+        expected = defaultdict(float)
+        for charge in Charge.objects.all():
+            expected[charge.region_name] += get_total_sus(charge)
+        return dict(expected)
+
+    def _rolled_up_by_region(self):
+        return {
+            row["region_name"]: row["sus"]
+            for row in rollups.usage(group_by=["region_name"])
+        }
+
+    def assertRollupsMatchCharges(self):
+        rollups.refresh()
+        self.assertEqual(self._rolled_up_by_region(), self._expected_by_region())
+        hourly = rollups.usage(period="hour")
+        self.assertAlmostEqual(
+            sum(row["sus"] for row in hourly), sum(self._expected_by_region().values())
+        )
+
+    def test_rollups_follow_charge_changes(self):
+        self.assertRollupsMatchCharges()
+        self.assertEqual(rollups.usage()["charges"], 3)
+
+        # Shortened like stop_charging does
+        Charge.objects.filter(pk=self.charges[0].pk).update(
+            end_time=self.now + timedelta(hours=1), updated_at=timezone.now()
+        )
+        self.assertRollupsMatchCharges()
+
+        # Forked into a new allocation
+        new_allocation = self._create_allocation(status="approved", days=60)
+        tasks._fork_charge(
+            Charge.objects.get(pk=self.charges[1].pk),
+            self.now - timedelta(days=1, hours=-1),
+            new_allocation,
+        )
+        self.assertRollupsMatchCharges()
+        self.assertEqual(
+            rollups.usage(allocation=new_allocation)["sus"],
+            get_total_sus(Charge.objects.get(allocation=new_allocation)),
+        )
+
+        self.charges[2].delete()
+        self.assertRollupsMatchCharges()
+        self.assertEqual(rollups.usage()["charges"], 3)
+
+    def test_refresh_only_reads_changed_charges(self):
+        self.assertIsNone(rollups.refreshed_at())
+        self.assertEqual(rollups.refresh(), 3)
+        self.assertIsNotNone(rollups.refreshed_at())
+        later = timezone.now() + rollups.WATERMARK_OVERLAP * 2
+        with mock.patch("django.utils.timezone.now", return_value=later):
+            # Charges within the overlap before the watermark are read again
+            self.assertEqual(rollups.refresh(), 3)
+            self.assertEqual(rollups.refresh(), 0)
+            self.charges[0].hourly_cost = 3.0
+            self.charges[0].save()
+            self.assertEqual(rollups.refresh(), 1)
+        self.assertEqual(self._rolled_up_by_region(), self._expected_by_region())
+
+
+class ArchiveTests(AllocationTestCase):
+    def _allocation(self, status, expiration_date, charge_ends):
+        start_date = expiration_date - timedelta(days=365)
+        alloc = self._create_allocation(
+            status=status,
+            start_date=start_date,
+            days=365,
+            date_requested=start_date,
+            su_allocated=1000,
+        )
+        for i, end_time in enumerate(charge_ends):
+            Charge.objects.create(
+                allocation=alloc,
+                user=self.user,
+                region_name="CHI@UC",
+                resource_id=f"res-{alloc.pk}-{i}",
+                resource_type="physical:host",
+                start_time=end_time - timedelta(hours=10),
+                end_time=end_time,
+                hourly_cost=1.0,
+            )
+        return alloc
+
+    def test_archive_charges_of_long_inactive_allocations(self):
+        long_ago = self.now - timedelta(days=800)
+        old = self._allocation("inactive", long_ago, [long_ago, long_ago])
+        # expired long ago, but still has a charge that ended recently
+        recent = self._allocation(
+            "inactive", long_ago, [long_ago, self.now - timedelta(days=10)]
+        )
+        active = self._allocation(
+            "active", self.now + timedelta(days=30), [self.now + timedelta(hours=1)]
+        )
+        old_charge_ids = set(old.charges.values_list("pk", flat=True))
+        rollups.refresh()
+        total_before = rollups.usage()["sus"]
+
+        self.assertEqual(list(archive.archivable_allocations()), [old])
+        self.assertEqual(archive.archive_charges(), 2)
+
+        self.assertFalse(old.charges.exists())
+        self.assertEqual(recent.charges.count(), 2)
+        self.assertEqual(active.charges.count(), 1)
+        self.assertEqual(
+            set(old.archived_charges.values_list("pk", flat=True)), old_charge_ids
+        )
+        self.assertEqual(
+            {c.pk for c in archive.all_charges(allocation=old)}, old_charge_ids
+        )
+        self.assertEqual(len(list(archive.all_charges(user=self.user))), 5)
+
+        # Archived charges still count in rollups and ledgers
+        rollups.refresh()
+        self.assertEqual(rollups.usage()["sus"], total_before)
+        self.assertEqual(ledger.compute_counters(old.pk, self.now), (20.0, 20.0))
+        self.assertEqual(archive.archive_charges(), 0)
+
+    def test_archive_moves_a_batch_in_constant_queries(self):
+        long_ago = self.now - timedelta(days=800)
+        alloc = self._allocation("inactive", long_ago, [long_ago] * 20)
+
+        # Savepoint, select, insert, delete and release per batch, then the
+        # savepoint, select and release of the empty batch
+        with self.assertNumQueries(8):
+            self.assertEqual(archive.archive_allocation(alloc.pk), 20)
+        self.assertFalse(alloc.charges.exists())
+
+
+class LowAllocationWarningTests(AllocationTestCase):
+    def _allocation(self, name, used_sus, **kwargs):
+        alloc = self._create_allocation(
+            project=self._create_project(name),
+            start_date=self.now - timedelta(days=30),
+            days=60,
+            su_requested=100,
+            su_allocated=100,
+            **kwargs,
+        )
+        if used_sus:
+            Charge.objects.create(
+                allocation=alloc,
+                user=self.user,
+                region_name="CHI@UC",
+                resource_id=f"res-{name}",
+                resource_type="physical:host",
+                start_time=self.now - timedelta(hours=used_sus),
+                end_time=self.now,
+                hourly_cost=1.0,
+            )
+        return alloc
+
+    def test_warn_only_allocations_over_threshold(self):
+        low = self._allocation("LOW", 95)
+        self._allocation("FINE", 50)
+        self._allocation("UNUSED", 0)
+        self._allocation("WARNED", 99, low_allocation_warning_issued=self.now)
+        self._allocation("EXPIRING", 99, expiration_warning_issued=self.now)
+
+        with mock.patch("allocations.tasks.get_connection") as get_connection:
+            get_connection.return_value = mail.get_connection()
+            tasks.warn_user_for_low_allocations()
+        get_connection.assert_called_once()
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("LOW has used 95.0%", mail.outbox[0].subject)
+        low.refresh_from_db()
+        self.assertIsNotNone(low.low_allocation_warning_issued)
+
+        tasks.warn_user_for_low_allocations()
+        self.assertEqual(len(mail.outbox), 1)
+
+
+@mock.patch.object(KeycloakClient, "_lookup_group", return_value={"attributes": {}})
+@mock.patch.object(KeycloakClient, "update_project")
+@mock.patch("allocations.tasks.transition_allocation.apply_async")
+class TransitionSchedulingTests(AllocationTestCase):
+    def _approve(self, start_date):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self._create_allocation(
+                status="approved", start_date=start_date, days=180, su_allocated=1000
+            )
+
+    def test_approval_schedules_activation(self, apply_async, *mocks):
+        start = self.now + timedelta(minutes=10)
+        alloc = self._approve(start)
+        apply_async.assert_called_once_with(
+            args=[alloc.pk, start.isoformat()], eta=start
+        )
+        alloc.refresh_from_db()
+        self.assertEqual(alloc.transition_eta, start)
+
+        # Saving without changing the dates does not schedule it again
+        with self.captureOnCommitCallbacks(execute=True):
+            alloc.justification = "updated"
+            alloc.save()
+        self.assertEqual(apply_async.call_count, 1)
+
+        # Moving the start date reschedules it, and the first job does nothing
+        new_start = start + timedelta(minutes=5)
+        with self.captureOnCommitCallbacks(execute=True):
+            alloc.start_date = new_start
+            alloc.save()
+        apply_async.assert_called_with(
+            args=[alloc.pk, new_start.isoformat()], eta=new_start
+        )
+        with mock.patch("django.utils.timezone.now", return_value=new_start):
+            tasks.transition_allocation(alloc.pk, start.isoformat())
+            alloc.refresh_from_db()
+            self.assertEqual(alloc.status, "approved")
+
+            with self.captureOnCommitCallbacks(execute=True):
+                tasks.transition_allocation(alloc.pk, new_start.isoformat())
+        alloc.refresh_from_db()
+        self.assertEqual(alloc.status, "active")
+        self.assertIsNone(alloc.transition_eta)
+
+    def test_sweep_schedules_transitions_within_horizon(self, apply_async, *mocks):
+        start = self.now + timedelta(days=3)
+        alloc = self._approve(start)
+        apply_async.assert_not_called()
+
+        with mock.patch(
+            "django.utils.timezone.now", return_value=start - timedelta(minutes=10)
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                tasks.schedule_allocation_transitions()
+            with self.captureOnCommitCallbacks(execute=True):
+                tasks.schedule_allocation_transitions()
+        apply_async.assert_called_once_with(
+            args=[alloc.pk, start.isoformat()], eta=start
+        )
+
+
+class KeycloakConsistencyTests(AllocationTestCase):
+    def setUp(self):
+        super().setUp()
+        for charge_code, status in [
+            ("ACTIVE_OK", "active"),
+            ("ACTIVE_WRONG", "active"),
+            ("ACTIVE_UNSET", "active"),
+            ("ACTIVE_MISSING", "active"),
+            ("INACTIVE_OK", "inactive"),
+            ("INACTIVE_WRONG", "inactive"),
+        ]:
+            self._create_allocation(
+                project=self._create_project(charge_code),
+                status=status,
+                su_requested=100,
+            )
+
+    def _group(self, name, value=None):
+        attributes = {"has_active_allocation": [value]} if value else {}
+        return {"id": f"id-{name}", "name": name, "attributes": attributes}
+
+    def test_reconcile_corrects_mismatched_groups(self):
+        groups = [
+            self._group("ACTIVE_OK", "true"),
+            self._group("ACTIVE_WRONG", "false"),
+            self._group("ACTIVE_UNSET"),
+            self._group("INACTIVE_OK", "false"),
+            self._group("INACTIVE_WRONG", "true"),
+            self._group("NOT_A_PROJECT", "true"),
+        ]
+        client = mock.Mock(spec=KeycloakClient)
+        client.iter_groups.return_value = iter(groups)
+
+        report = consistency.reconcile(client)
+
+        client._project_admin.assert_called_once()
+        self.assertEqual(
+            client.iter_groups.call_args.kwargs["keycloakproject"],
+            client._project_admin.return_value,
+        )
+        client.iter_groups.assert_called_once()
+        updates = {
+            call.args[0]["name"]: call.kwargs["has_active_allocation"]
+            for call in client.update_group.call_args_list
+        }
+        self.assertEqual(
+            updates,
+            {"ACTIVE_WRONG": "true", "ACTIVE_UNSET": "true", "INACTIVE_WRONG": "false"},
+        )
+        self.assertEqual(report["activated"], 2)
+        self.assertEqual(report["deactivated"], 1)
+        self.assertEqual(report["missing_groups"], 1)
+        self.assertEqual(report["failed"], 0)
+
+    def test_iter_groups_fetches_pages(self):
+        groups = [self._group(f"GROUP{i}") for i in range(5)]
+        groups_admin = mock.Mock()
+
+        def get(url):
+            params = parse_qs(urlparse(url).query)
+            first, max_ = int(params["first"][0]), int(params["max"][0])
+            return groups[first : first + max_]
+
+        groups_admin._client.get_full_url.return_value = "https://keycloak/groups"
+        groups_admin._client.get.side_effect = get
+        client = KeycloakClient.__new__(KeycloakClient)
+        client.realm_name = "chameleon"
+        fetched = list(client.iter_groups(page_size=2, keycloakproject=groups_admin))
+        self.assertEqual(fetched, groups)
+        self.assertEqual(groups_admin._client.get.call_count, 3)
+
+
+class AdminTokenTests(TestCase):
+    def setUp(self):
+        self.manager = AdminTokenManager("https://keycloak", "portal", "secret")
+        self.grants = 0
+
+        def client_credentials():
+            self.grants += 1
+            time.sleep(0.05)
+            return {"access_token": f"token-{self.grants}", "expires_in": 300}
+
+        openid = mock.Mock()
+        openid.client_credentials.side_effect = client_credentials
+        self.manager.realm.open_id_connect = mock.Mock(return_value=openid)
+
+    def test_token_reused_until_shortly_before_expiry(self):
+        self.assertEqual(self.manager.get_token(), "token-1")
+        self.assertEqual(self.manager.get_token(), "token-1")
+        admin_client = self.manager.admin_client()
+        later = time.monotonic() + 300 - AdminTokenManager.EXPIRY_MARGIN_SECONDS
+        with mock.patch("time.monotonic", return_value=later):
+            # Clients made before the renewal send the new token
+            self.assertEqual(
+                admin_client._add_auth_header()["Authorization"], "Bearer token-2"
+            )
+        self.assertEqual(self.grants, 2)
+
+    def test_concurrent_callers_share_one_grant(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            tokens = set(executor.map(lambda _: self.manager.get_token(), range(8)))
+        self.assertEqual(tokens, {"token-1"})
+        self.assertEqual(self.grants, 1)
+
+    def test_one_manager_per_client(self):
+        self.assertIs(
+            get_token_manager("https://keycloak", "portal", "secret"),
+            get_token_manager("https://keycloak", "portal", "secret"),
+        )
+
+
+class KeycloakGroupLookupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.groups = [
+            {"id": f"id-{name}", "name": name, "attributes": {}, "subGroups": []}
+            for name in ["CHI-1", "CHI-12", "CHI-123"]
+        ]
+        self.groups_admin = mock.Mock()
+        self.groups_admin._client.get_full_url.return_value = "https://keycloak/groups"
+        self.groups_admin._client.get.side_effect = self._get
+        patcher = mock.patch.object(
+            KeycloakClient, "_project_admin", return_value=self.groups_admin
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = KeycloakClient.__new__(KeycloakClient)
+        self.client.realm_name = "chameleon"
+
+    def _get(self, url):
+        # Substring search, like Keycloak before exact searches
+        search = parse_qs(urlparse(url).query)["search"][0]
+        return [group for group in self.groups if search in group["name"]]
+
+    def test_lookup_matches_exact_name(self):
+        self.assertEqual(self.client._lookup_group("CHI-12")["id"], "id-CHI-12")
+        self.assertIsNone(self.client._lookup_group("CHI-2"))
+
+    def test_lookup_cached_until_written(self):
+        self.client._lookup_group("CHI-1")
+        self.client._lookup_group("CHI-1")
+        self.assertEqual(self.groups_admin._client.get.call_count, 1)
+
+        self.client.update_project("CHI-1", has_active_allocation="true")
+        self.groups[0]["attributes"] = {"has_active_allocation": ["true"]}
+
+        self.assertEqual(
+            self.client._lookup_group("CHI-1")["attributes"],
+            {"has_active_allocation": ["true"]},
+        )
+        # The update read the group afresh, and the next lookup missed
+        self.assertEqual(self.groups_admin._client.get.call_count, 3)
+
+
+class KeycloakMembershipCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.members = [
+            {"id": "kc-1", "username": "pi", "email": "pi@example.com"},
+            {"id": "kc-2", "username": "member", "email": "member@example.com"},
+        ]
+        self.roles = {"pi": "admin"}
+        self.groups_admin = mock.Mock()
+        self.groups_admin._client.get_full_url.return_value = "https://keycloak/groups"
+        self.groups_admin._client.get.side_effect = lambda url: list(self.members)
+        self.roles_admin = mock.Mock()
+        self.roles_admin.bulk_fetch_group_member_roles.side_effect = (
+            lambda group_id: dict(self.roles)
+        )
+        self.client = KeycloakClient.__new__(KeycloakClient)
+        self.client.realm_name = "chameleon"
+        for name, value in [
+            ("_project_admin", self.groups_admin),
+            ("_user_project_roles_admin", self.roles_admin),
+            ("_user_projects_admin", mock.Mock()),
+            ("_lookup_group", {"id": "group-1", "name": "CHI-1", "subGroups": []}),
+            ("get_keycloak_user_id_from_portal_user", "kc-3"),
+            ("get_user_from_portal_user", {"id": "kc-3", "username": "new"}),
+        ]:
+            patcher = mock.patch.object(KeycloakClient, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.new_user = mock.Mock(username="new", email="new@example.com")
+
+    def test_members_and_roles_fetched_once(self):
+        self.client.get_project_members("CHI-1")
+        self.client.get_roles_for_all_project_members("CHI-1")
+        self.client.get_project_members("CHI-1")
+
+        self.assertEqual(self.groups_admin._client.get.call_count, 1)
+        self.assertEqual(self.roles_admin.bulk_fetch_group_member_roles.call_count, 1)
+
+    def test_changes_written_through(self):
+        self.client.get_project_membership("CHI-1")
+
+        self.client.update_membership("CHI-1", self.new_user, "add")
+        self.client.set_user_project_role(self.new_user, "CHI-1", "manager")
+        membership = self.client.get_project_membership("CHI-1")
+        self.assertEqual(
+            [m["username"] for m in membership["members"]], ["pi", "member", "new"]
+        )
+        self.assertEqual(membership["roles"], {"pi": "admin", "new": "manager"})
+
+        self.client.update_membership("CHI-1", self.new_user, "delete")
+        membership = self.client.get_project_membership("CHI-1")
+        self.assertEqual(
+            [m["username"] for m in membership["members"]], ["pi", "member"]
+        )
+        self.assertEqual(membership["roles"], {"pi": "admin"})
+        self.assertEqual(self.groups_admin._client.get.call_count, 1)
+
+    def test_membership_expires(self):
+        with override_settings(KEYCLOAK_MEMBERSHIP_CACHE_TTL_SECONDS=0):
+            self.client.get_project_members("CHI-1")
+            self.client.get_project_members("CHI-1")
+        self.assertEqual(self.groups_admin._client.get.call_count, 2)
+
+
+class FakeRegionDB:
+    """Answers the batched TMP resource id lookup from a dict of leases."""
+
+    def __init__(self, reservations):
+        self.reservations = reservations
+        self.queries = 0
+        self.closed = False
+
+    def cursor(self, *args):
+        return self
+
+    def ping(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def execute(self, sql, params):
+        self.queries += 1
+        self.rows = []
+        for i in range(0, len(params), 6):
+            idx, *lease = params[i : i + 6]
+            if tuple(lease) in self.reservations:
+                self.rows.append({"idx": idx, "id": self.reservations[tuple(lease)]})
+
+    def fetchall(self):
+        return self.rows
+
+
+class RegionDBTests(AllocationTestCase):
+    def setUp(self):
+        super().setUp()
+        self.allocation = self._create_allocation(su_requested=100)
+        self.addCleanup(region_db.close_all)
+
+    def _tmp_charge(self, region, name):
+        return Charge.objects.create(
+            allocation=self.allocation,
+            user=self.user,
+            region_name=region,
+            resource_id=f"TMP/project/user/2024-01-01 00:00/{name}",
+            resource_type="physical:host",
+            start_time=self.now,
+            end_time=self.now + timedelta(hours=1),
+            hourly_cost=1.0,
+        )
+
+    def test_fill_tmp_resource_ids_in_batches(self):
+        known = {
+            region: FakeRegionDB(
+                {
+                    ("project", "user", "2024-01-01 00:00", "physical:host", name): (
+                        f"{region}-{name}"
+                    )
+                    for name in ["a", "b"]
+                }
+            )
+            for region in ["CHI@UC", "CHI@TACC"]
+        }
+        charges = [
+            self._tmp_charge(region, name)
+            for region in known
+            for name in ["a", "b", "unknown"]
+        ]
+
+        with mock.patch(
+            "allocations.utils.connect_to_region_db", side_effect=known.get
+        ) as connect, mock.patch.object(region_db, "IN_BATCH_SIZE", 2):
+            tasks._fill_charge_tmp_resource_ids()
+            # Connections are reused by the next run
+            tasks._fill_charge_tmp_resource_ids()
+
+        self.assertEqual(connect.call_count, 2)
+        for db in known.values():
+            # 3 leases in batches of 2, then the unknown one again
+            self.assertEqual(db.queries, 3)
+        for charge in charges:
+            charge.refresh_from_db()
+            name = charge.resource_id.rsplit("/", 1)[-1].rsplit("-", 1)[-1]
+            if name == "unknown":
+                self.assertTrue(charge.resource_id.startswith("TMP/"))
+            else:
+                self.assertEqual(charge.resource_id, f"{charge.region_name}-{name}")
+
+
+class FakeReservationsDB:
+    """Streams the reservations of a region, by kind, from a list of rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.resource_type = None
+
+    def cursor(self, *args):
+        return self
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+    def execute(self, sql, params):
+        for resource_type, table in [
+            ("physical:host", "computehost_allocations"),
+            ("network", "network_allocations"),
+            ("virtual:floatingip", "floatingip_allocations"),
+        ]:
+            if table in sql:
+                self.resource_type = resource_type
+
+    def __iter__(self):
+        for row in sorted(self.rows, key=lambda row: row["resource_id"]):
+            if row["resource_type"] == self.resource_type:
+                yield row
+
+
+class ChargeAuditTests(TestCase):
+    def test_compare_sorted_streams(self):
+        portal = [
+            ("a", "2026-01-01 00:00:00", 1.0),
+            ("b", "2026-01-01 00:00:00", 1.0),
+            ("c", "2026-01-02 00:00:00", 2.0),
+        ]
+        openstack = [
+            ("b", "2026-01-01 00:00:00", 1.0),
+            ("c", "2026-01-01 00:00:00", 3.0),
+            ("d", "2026-01-01 00:00:00", 1.0),
+        ]
+        counts = {}
+
+        discrepancies = list(
+            charge_audit.compare(iter(portal), iter(openstack), counts)
+        )
+
+        self.assertEqual(
+            [(resource_id, kind) for resource_id, kind, _, _ in discrepancies],
+            [
+                ("a", ChargeDiscrepancy.MISSING_IN_OPENSTACK),
+                ("c", ChargeDiscrepancy.END_TIME),
+                ("c", ChargeDiscrepancy.HOURLY_COST),
+                ("d", ChargeDiscrepancy.MISSING_IN_PORTAL),
+            ],
+        )
+        self.assertEqual(counts, {"portal": 3, "openstack": 3})
+
+    def test_compare_rejects_unsorted_stream(self):
+        portal = [("b", "", 1.0), ("a", "", 1.0)]
+        with self.assertRaises(ValueError):
+            list(charge_audit.compare(iter(portal), iter([])))
+
+
+class ChargeAuditRunTests(AllocationFixtures, TransactionTestCase):
+    """Regions are audited in threads, which need the charges committed."""
+
+    def setUp(self):
+        super().setUp()
+        self.now = self.now.replace(microsecond=0)
+        self.allocation = self._create_allocation(
+            start_date=self.now - timedelta(days=60), days=90, su_requested=100
+        )
+        self.addCleanup(region_db.close_all)
+
+    def _charge(self, resource_id, start, end, hourly_cost=1.0):
+        return Charge.objects.create(
+            allocation=self.allocation,
+            user=self.user,
+            region_name="CHI@UC",
+            resource_id=resource_id,
+            resource_type="physical:host",
+            start_time=start,
+            end_time=end,
+            hourly_cost=hourly_cost,
+        )
+
+    def _reservation(self, resource_id, start, end, hourly_cost, **kwargs):
+        row = {
+            "username": "test_requestor",
+            "extra": '{"charge_code": "TEST123"}',
+            "project_name": "TEST123",
+            "start_on": start.astimezone(dt_timezone.utc).replace(tzinfo=None),
+            "end_on": end.astimezone(dt_timezone.utc).replace(tzinfo=None),
+            "resource_id": resource_id,
+            "resource_type": "physical:host",
+            "hourly_cost": hourly_cost,
+        }
+        row.update(kwargs)
+        return row
+
+    def test_run_saves_discrepancies(self):
+        start = self.now - timedelta(days=2)
+        end = self.now + timedelta(days=1)
+        # Forked at allocation renewal, the last charge is compared
+        self._charge("forked", start, self.now - timedelta(days=1), 1.0)
+        self._charge("forked", self.now - timedelta(days=1), end, 2.0)
+        self._charge("in-sync", start, end)
+        self._charge("extended", start, end)
+        self._charge("portal-only", start, end)
+        self._charge("TMP/project/user/2026-01-01 00:00/lease", start, end)
+        # Started before the audit window
+        self._charge("old", self.now - timedelta(days=90), end)
+        rows = [
+            self._reservation("forked", start, end, 2.0),
+            self._reservation("in-sync", start, end, 0.5),
+            self._reservation("in-sync", start, end, 0.5),
+            self._reservation("extended", start, end + timedelta(hours=1), 1.0),
+            self._reservation(
+                "openstack-only", start, end, 1, resource_type="virtual:floatingip"
+            ),
+        ]
+
+        with mock.patch(
+            "allocations.utils.connect_to_region_db",
+            side_effect=lambda region: FakeReservationsDB(rows),
+        ):
+            audit_run = charge_audit.run(now=self.now, regions=["CHI@UC"])
+
+        self.assertEqual(audit_run.status, ChargeAuditRun.SUCCEEDED)
+        self.assertEqual(audit_run.portal_reservations, 4)
+        self.assertEqual(audit_run.openstack_reservations, 4)
+        self.assertEqual(audit_run.discrepancy_count, 3)
+        self.assertEqual(
+            set(audit_run.discrepancies.values_list("resource_id", "kind")),
+            {
+                ("extended", ChargeDiscrepancy.END_TIME),
+                ("portal-only", ChargeDiscrepancy.MISSING_IN_OPENSTACK),
+                ("openstack-only", ChargeDiscrepancy.MISSING_IN_PORTAL),
+            },
+        )
+
+    def test_run_marks_failed_regions(self):
+        with mock.patch(
+            "allocations.utils.connect_to_region_db", side_effect=Exception("down")
+        ):
+            audit_run = charge_audit.run(now=self.now, regions=["CHI@UC"])
+
+        self.assertEqual(audit_run.status, ChargeAuditRun.FAILED)
+        self.assertIsNotNone(audit_run.finished_at)
+
+
+class RolloverTests(AllocationTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [
+            self.user,
+            get_user_model().objects.create_user(
+                username="test_member", password="test_password"
+            ),
+        ]
+
+    def _allocations(self, project):
+        allocations = [
+            self._create_allocation(
+                project=project, status=status, start_date=start, date_requested=start
+            )
+            for status, start in [
+                ("active", self.now - timedelta(days=30)),
+                ("approved", self.now),
+            ]
+        ]
+        prev_alloc, new_alloc = allocations
+        for i, (start, end) in enumerate(
+            [
+                # ended, ongoing, and starting later
+                (self.now - timedelta(days=3), self.now - timedelta(days=2)),
+                (self.now - timedelta(days=1), self.now + timedelta(days=1)),
+                (self.now - timedelta(hours=5), self.now + timedelta(hours=7)),
+                (self.now + timedelta(days=1), self.now + timedelta(days=2)),
+            ]
+        ):
+            Charge.objects.create(
+                allocation=prev_alloc,
+                user=self.users[i % 2],
+                region_name="CHI@UC",
+                resource_id=f"reservation-{i}",
+                resource_type="physical:host",
+                start_time=start,
+                end_time=end,
+                hourly_cost=i + 1.5,
+            )
+        for alloc in allocations:
+            ledger.rebuild(alloc)
+        return prev_alloc, new_alloc
+
+    def _summary(self, alloc):
+        charges = Charge.objects.filter(allocation=alloc).order_by("resource_id")
+        return {
+            "charges": [
+                (c.user_id, c.resource_id, c.start_time, c.end_time, c.hourly_cost)
+                for c in charges
+            ],
+            "sus": sum(get_total_sus(c) for c in charges),
+            "committed": round(self._ledger(alloc).committed_sus, 6),
+        }
+
+    def _ledger(self, alloc):
+        return AllocationLedger.objects.get(allocation_id=alloc.id)
+
+    def test_rollover_matches_forking_each_charge(self):
+        per_charge = self._allocations(self.project)
+        bulk = self._allocations(self._create_project("BULK"))
+        sus_before = sum(
+            get_total_sus(c)
+            for c in Charge.objects.filter(allocation__project__charge_code="BULK")
+        )
+
+        for charge in Charge.objects.filter(allocation=per_charge[0]):
+            if charge.end_time > self.now:
+                tasks._fork_charge(charge, self.now, per_charge[1])
+        forked = tasks._rollover_charges(bulk[0], bulk[1], self.now)
+
+        self.assertEqual(forked, 3)
+        for per_charge_alloc, bulk_alloc in zip(per_charge, bulk):
+            self.assertEqual(self._summary(per_charge_alloc), self._summary(bulk_alloc))
+            # The ledgers were kept up to date rather than rebuilt
+            self.assertAlmostEqual(
+                self._ledger(bulk_alloc).committed_sus,
+                ledger.compute_counters(bulk_alloc.id, self.now)[0],
+            )
+        self.assertEqual(sum(self._summary(alloc)["sus"] for alloc in bulk), sus_before)
+
+    @mock.patch.object(KeycloakClient, "_lookup_group", return_value={})
+    @mock.patch.object(KeycloakClient, "update_project", return_value=None)
+    def test_activation_rolls_over_charges(self, update_project_mock, lookup_mock):
+        prev_alloc, new_alloc = self._allocations(self.project)
+
+        tasks.active_approved_allocations()
+
+        prev_alloc.refresh_from_db()
+        new_alloc.refresh_from_db()
+        self.assertEqual(prev_alloc.status, "inactive")
+        self.assertEqual(new_alloc.status, "active")
+        self.assertEqual(Charge.objects.filter(allocation=new_alloc).count(), 3)
+        self.assertFalse(
+            Charge.objects.filter(
+                allocation=prev_alloc, end_time__gt=timezone.now()
+            ).exists()
+        )
@@ -20,14 +20,13 @@ def connect_to_portal_db():
     )
 
 
-def parse_db_query(query_fetch):
-    result = []
+def iter_db_query(query_fetch):
     for row in query_fetch:
         extra = json.loads(row["extra"])
         charge_code = extra.get("charge_code")
         if not charge_code:
             charge_code = row["project_name"]
-        charge = {
+        yield {
             "username": row["username"],
             "charge_code": charge_code,
             "start_time": row["start_on"].strftime(DATETIME_FORMAT),
@@ -36,16 +35,47 @@ def parse_db_query(query_fetch):
             "resource_type": row["resource_type"],
             "hourly_cost": float(row["hourly_cost"]),
         }
-        result.append(charge)
-    return result
 
 
-def get_computehost_charges_by_ids(db, resource_ids=None):
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    resource_id_params = "SELECT DISTINCT id FROM blazar.reservations"
-    if resource_ids:
-        resource_id_params = ",".join(f'"{r}"' for r in resource_ids)
-    cursor.execute("""
+def parse_db_query(query_fetch):
+    return list(iter_db_query(query_fetch))
+
+
+def _reservation_condition(resource_ids, started_after):
+    """SQL condition on the reservations to query, and its parameters."""
+    if started_after is not None:
+        return "l.start_date >= %s", [started_after]
+    if not resource_ids:
+        return "r.id IN (SELECT DISTINCT id FROM blazar.reservations)", []
+    return (
+        "r.id IN ({})".format(",".join(["%s"] * len(resource_ids))),
+        list(resource_ids),
+    )
+
+
+def _query_charges(db, sql, resource_ids, started_after, stream):
+    """Run a charges query, in reservation id order.
+
+    With ``stream``, rows are read from the server as the returned iterator is
+    consumed, which needs the connection for itself until then.
+    """
+    condition, params = _reservation_condition(resource_ids, started_after)
+    if stream:
+        cursor = db.cursor(MySQLdb.cursors.SSDictCursor)
+    else:
+        cursor = db.cursor(MySQLdb.cursors.DictCursor)
+    cursor.execute(sql.format(condition), params)
+    if stream:
+        return iter_db_query(cursor)
+    return parse_db_query(cursor.fetchall())
+
+
+def get_computehost_charges_by_ids(
+    db, resource_ids=None, started_after=None, stream=False
+):
+    return _query_charges(
+        db,
+        """
         SELECT lu.name AS username, p.extra, p.name AS project_name,
         start_date AS start_on,
         LEAST(COALESCE(end_date, l.deleted_at, r.deleted_at),
@@ -71,19 +101,20 @@ def get_computehost_charges_by_ids(db, resource_ids=None):
             WHERE capability_name = 'su_factor'
             AND resource_type = 'physical:host'
         ) AS j ON j.computehost_id = c.id
-        WHERE r.id IN ({})
+        WHERE {}
         GROUP BY r.id, capability_value
-    """.format(resource_id_params))
-
-    return parse_db_query(cursor.fetchall())
+        ORDER BY r.id
+    """,
+        resource_ids,
+        started_after,
+        stream,
+    )
 
 
-def get_network_charges_by_ids(db, resource_ids=None):
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    resource_id_params = "SELECT DISTINCT id FROM blazar.reservations"
-    if resource_ids:
-        resource_id_params = ",".join(f'"{r}"' for r in resource_ids)
-    cursor.execute("""
+def get_network_charges_by_ids(db, resource_ids=None, started_after=None, stream=False):
+    return _query_charges(
+        db,
+        """
         SELECT lu.name AS username, p.extra, p.name AS project_name,
         start_date AS start_on,
         LEAST(COALESCE(end_date, l.deleted_at, r.deleted_at),
@@ -109,19 +140,22 @@ def get_network_charges_by_ids(db, resource_ids=None):
             WHERE capability_name = 'su_factor'
             AND resource_type = 'network'
         ) AS j ON j.network_id = n.id
-        WHERE r.id IN ({})
+        WHERE {}
         GROUP BY r.id, capability_value
-    """.format(resource_id_params))
-
-    return parse_db_query(cursor.fetchall())
+        ORDER BY r.id
+    """,
+        resource_ids,
+        started_after,
+        stream,
+    )
 
 
-def get_floatingip_charges_by_ids(db, resource_ids=None):
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    resource_id_params = "SELECT DISTINCT id FROM blazar.reservations"
-    if resource_ids:
-        resource_id_params = ",".join(f'"{r}"' for r in resource_ids)
-    cursor.execute("""
+def get_floatingip_charges_by_ids(
+    db, resource_ids=None, started_after=None, stream=False
+):
+    return _query_charges(
+        db,
+        """
         SELECT lu.name AS username, p.extra, p.name AS project_name,
         start_date AS start_on,
         LEAST(COALESCE(end_date, l.deleted_at, r.deleted_at),
@@ -135,38 +169,54 @@ def get_floatingip_charges_by_ids(db, resource_ids=None):
         JOIN keystone.project AS p ON p.id = l.project_id
         JOIN keystone.user AS u ON u.id = l.user_id
         JOIN keystone.local_user AS lu ON lu.user_id = u.id
-        WHERE r.id IN ({})
+        WHERE {}
         GROUP BY r.id
-    """.format(resource_id_params))
+        ORDER BY r.id
+    """,
+        resource_ids,
+        started_after,
+        stream,
+    )
 
-    return parse_db_query(cursor.fetchall())
 
+def get_resource_ids(db, leases):
+    """Find the reservation ids of leases, as recorded in TMP resource ids.
 
-def get_resource_id(
-    db, project_id, user_id, lease_start_date, resource_type, lease_name
-):
+    Args:
+        db: A region database connection.
+        leases (list[tuple]): ``(project_id, user_id, lease_start_date,
+            resource_type, lease_name)`` of each lease.
+
+    Returns:
+        A dict of the reservation id of each lease found, by its index in
+        ``leases``.
+    """
+    if not leases:
+        return {}
     cursor = db.cursor(MySQLdb.cursors.DictCursor)
+    lease_rows = " UNION ALL ".join(
+        [
+            "SELECT %s AS idx, %s AS project_id, %s AS user_id, %s AS start_date, "
+            "%s AS resource_type, %s AS name"
+        ]
+        * len(leases)
+    )
+    params = [value for i, lease in enumerate(leases) for value in (i, *lease)]
     cursor.execute(
         """
-        SELECT r.id AS id
-        FROM blazar.leases AS l
-        JOIN blazar.reservations AS r ON l.id = r.lease_id
-        WHERE project_id = %(project_id)s
-        AND user_id = %(user_id)s
-        AND start_date = %(start_date)s
-        AND resource_type = %(resource_type)s
-        AND name = %(lease_name)s
-        """,
-        {
-            "project_id": project_id,
-            "user_id": user_id,
-            "start_date": lease_start_date,
-            "resource_type": resource_type,
-            "lease_name": lease_name,
-        },
+        SELECT k.idx, r.id AS id
+        FROM ({}) AS k
+        JOIN blazar.leases AS l
+        ON l.project_id = k.project_id
+        AND l.user_id = k.user_id
+        AND l.start_date = k.start_date
+        AND l.name = k.name
+        JOIN blazar.reservations AS r
+        ON l.id = r.lease_id AND r.resource_type = k.resource_type
+        """.format(lease_rows),
+        params,
     )
-    resource_id = cursor.fetchone()
-    if resource_id:
-        return resource_id.get("id")
-    else:
-        return None
+    resource_ids = {}
+    for row in cursor.fetchall():
+        resource_ids.setdefault(int(row["idx"]), row["id"])
+    return resource_ids
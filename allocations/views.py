@@ -7,7 +7,7 @@ from django.core.exceptions import ValidationError
 from django.http import HttpResponse, JsonResponse, HttpResponseForbidden
 from django.contrib.auth.decorators import login_required, user_passes_test
 from projects.models import Project
-from util.keycloak_client import KeycloakClient
+from chameleon import keycloak_users
 from util.project_allocation_mapper import ProjectAllocationMapper
 
 import logging
@@ -59,11 +59,12 @@ def get_all_alloc(request):
         json: dumps all data as serialized json.
     """
     try:
-        keycloak_client = KeycloakClient()
-        user_attributes = keycloak_client.get_all_users_attributes()
         mapper = ProjectAllocationMapper(request)
         resp = mapper.get_all_projects()
         logger.debug("Total projects: %s", len(resp))
+        user_attributes = keycloak_users.users_attributes(
+            username__in={r["pi"]["username"] for r in resp}
+        )
         for r in resp:
             pi_attributes = user_attributes.get(r["pi"]["username"], {})
             if pi_attributes:
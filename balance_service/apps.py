@@ -0,0 +1,34 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.core import checks
+
+# Backends whose entries are not shared between worker processes
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def check_shared_cache(app_configs, **kwargs):
+    """Retried enforcement callbacks are deduplicated through the cache."""
+    backend = settings.CACHES.get("default", {}).get("BACKEND")
+    if backend not in LOCAL_CACHE_BACKENDS:
+        return []
+    return [
+        checks.Warning(
+            f"The default cache backend {backend} is not shared between processes.",
+            hint=(
+                "Retried balance service callbacks reaching another worker "
+                "will not be deduplicated. Set CACHE_BACKEND to a shared "
+                "cache, like Redis or Memcached, in production."
+            ),
+            id="balance_service.W001",
+        )
+    ]
+
+
+class BalanceServiceConfig(AppConfig):
+    name = "balance_service"
+
+    def ready(self):
+        checks.register(check_shared_cache, checks.Tags.caches)
@@ -15,18 +15,21 @@
 
 import collections
 import datetime
+import hashlib
 import json
 import logging
 
 import pytz
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.utils import timezone
 
 from allocations.models import Charge, ChargeBudget
 from balance_service.enforcement import exceptions
 from balance_service.models import ConfigVariable
-from balance_service.utils import su_calculators
+from balance_service.utils import ledger, metrics, su_calculators
+from balance_service.utils.openstack import keystone
 from projects.models import Project
 from projects.util import get_user_by_reference
 from util.keycloak_client import KeycloakClient
@@ -39,6 +42,9 @@ LeaseEval = collections.namedtuple(
     "LeaseEval", ["project", "user", "region", "duration", "total_su_factor", "amount"]
 )
 
+KEYSTONE_LOOKUP_CACHE_PREFIX = "balance_service:keystone_lookup"
+QUOTE_CACHE_PREFIX = "balance_service:quote"
+
 TMP_RESOURCE_ID_PREFIX = "TMP"
 TMP_RESOURCE_ID = "{prefix}/{project_id}/{user_id}/{start_date}/{name}"
 
@@ -54,10 +60,35 @@ def debug_lease_reservations(msg, lease):
         LOG.debug(f"{msg}: {_r}")
 
 
+def _balance_failure(project, amount, left):
+    """The message of a reservation spending more than the project has left"""
+    if left - amount < 0:
+        return (
+            "Reservation for project {} would spend {:.2f} SUs, "
+            "only {:.2f} left".format(project.charge_code, amount, left)
+        )
+    return None
+
+
+def _user_budget_failure(user, amount, left):
+    """The message of a reservation spending more than the user budget left"""
+    if left is not None and left < amount:
+        return (
+            "Reservation for user {} would spend {:.2f} SUs, "
+            "only {:.2f} left in user budget".format(user.username, amount, left)
+        )
+    return None
+
+
 class UsageEnforcer(object):
     def __init__(self, keystone_api_client):
         self.keystone_api = keystone_api_client
+        # Keystone lookups memoized for the lifetime of this (per-request) enforcer
+        self._charge_codes = {}
+        self._keystone_users = {}
+        self._reservation_sus = {}
 
+    @metrics.timed("balance")
     def get_remaining_balance(self, project_id):
         balances = su_calculators.project_balances([project_id])[0]
         remaining = balances["allocated"] - balances["total"]
@@ -67,9 +98,31 @@ class UsageEnforcer(object):
 
         return remaining
 
-    def _get_project_charge_code(self, keystone_project_id):
-        """Get project charge code from Keystone"""
-        keystone_project = self.keystone_api.get_project(keystone_project_id)
+    def _cached_lookup(self, memo, kind, keystone_id):
+        if keystone_id not in memo:
+            memo[keystone_id] = cache.get(self._lookup_cache_key(kind, keystone_id))
+        return memo[keystone_id]
+
+    def _store_lookup(self, memo, kind, keystone_id, value):
+        memo[keystone_id] = value
+        cache.set(
+            self._lookup_cache_key(kind, keystone_id),
+            value,
+            settings.BALANCE_SERVICE_KEYSTONE_LOOKUP_CACHE_TTL_SECONDS,
+        )
+
+    def _keystone_cache_scope(self):
+        # Ids are only unique within a region's Keystone
+        auth_url = str(self.keystone_api.auth_url)
+        return hashlib.sha256(auth_url.encode()).hexdigest()[:16]
+
+    def _lookup_cache_key(self, kind, keystone_id):
+        return (
+            f"{KEYSTONE_LOOKUP_CACHE_PREFIX}:{self._keystone_cache_scope()}:"
+            f"{kind}:{keystone_id}"
+        )
+
+    def _charge_code_from_project(self, keystone_project):
         enforcement_key = "name"
 
         charge_code = keystone_project.get(enforcement_key)
@@ -78,15 +131,14 @@ class UsageEnforcer(object):
             raise exceptions.BillingError(
                 message=(
                     f"Enforcement attribute '{enforcement_key}' is not defined for "
-                    f"project {keystone_project.name} ({keystone_project.id})"
+                    f"project {keystone_project.get('name')} "
+                    f"({keystone_project.get('id')})"
                 )
             )
 
         return charge_code
 
-    def _get_keystone_user(self, keystone_user_id):
-        """Get username from Keystone"""
-        keystone_user = self.keystone_api.get_user(keystone_user_id)
+    def _keystone_user_from_user(self, keystone_user_id, keystone_user):
         username = keystone_user.get("name")
         if not username:
             raise exceptions.BillingError(
@@ -98,24 +150,80 @@ class UsageEnforcer(object):
             "email": keystone_user.get("email"),
         }
 
+    def _get_project_and_user(self, keystone_project_id, keystone_user_id):
+        """Get the project charge code and user from Keystone.
+
+        Project and user ids map to the same charge code and username for
+        their whole lifetime, so lookups are memoized for this request and
+        shared between workers for a few minutes. Whatever is missing from
+        both is fetched from Keystone concurrently.
+        """
+        charge_code = self._cached_lookup(
+            self._charge_codes, "project", keystone_project_id
+        )
+        ks_user = self._cached_lookup(self._keystone_users, "user", keystone_user_id)
+
+        calls = []
+        if charge_code is None:
+            calls.append(lambda: self.keystone_api.get_project(keystone_project_id))
+        if ks_user is None:
+            calls.append(lambda: self.keystone_api.get_user(keystone_user_id))
+        with metrics.timed("keystone"):
+            results = keystone.fetch_concurrently(*calls)
+
+        if charge_code is None:
+            charge_code = self._charge_code_from_project(results.pop(0))
+            self._store_lookup(
+                self._charge_codes, "project", keystone_project_id, charge_code
+            )
+        if ks_user is None:
+            ks_user = self._keystone_user_from_user(keystone_user_id, results.pop(0))
+            self._store_lookup(self._keystone_users, "user", keystone_user_id, ks_user)
+
+        return charge_code, ks_user
+
+    def _get_project_charge_code(self, keystone_project_id):
+        """Get project charge code from Keystone"""
+        charge_code = self._cached_lookup(
+            self._charge_codes, "project", keystone_project_id
+        )
+        if charge_code is None:
+            charge_code = self._charge_code_from_project(
+                self.keystone_api.get_project(keystone_project_id)
+            )
+            self._store_lookup(
+                self._charge_codes, "project", keystone_project_id, charge_code
+            )
+        return charge_code
+
     def _get_portal_project(self, charge_code):
         return Project.objects.get(charge_code=charge_code)
 
     def _get_charges_by_reservation(self, resource_id, region):
         return Charge.objects.filter(resource_id=resource_id).filter(region_name=region)
 
+    def _get_ongoing_charges(self, resource_ids, region, now):
+        """Lock and return the charges of several reservations still running"""
+        return (
+            Charge.objects.filter(resource_id__in=resource_ids, region_name=region)
+            .filter(end_time__gt=now)
+            .select_for_update()
+        )
+
     def get_lease_duration_hrs(self, lease_values):
         start_date = self._date_from_string(lease_values["start_date"])
         end_date = self._date_from_string(lease_values["end_date"])
 
         return dt_hours(end_date - start_date)
 
+    @metrics.timed("evaluate")
     def _evaluate_lease(self, context, lease_values):
-        project_charge_code = self._get_project_charge_code(context["project_id"])
+        project_charge_code, ks_user = self._get_project_and_user(
+            context["project_id"], context["user_id"]
+        )
         duration = self.get_lease_duration_hrs(lease_values)
         total_su_factor = self._total_su_factor(lease_values)
         amount = duration * total_su_factor
-        ks_user = self._get_keystone_user(context["user_id"])
 
         return LeaseEval(
             self._get_portal_project(project_charge_code),
@@ -137,35 +245,39 @@ class UsageEnforcer(object):
         else:
             return 2
 
+    @metrics.timed("budget")
+    def _get_user_budget_left(self, user, project, lock=False):
+        """Returns the SUs left in the user budget, or None if unlimited
+
+        With ``lock``, the user's usage stays locked until the end of the
+        transaction, so concurrent leases cannot both spend the same budget.
+        """
+        su_budget = (
+            ChargeBudget.objects.filter(user=user, project=project)
+            .values_list("su_budget", flat=True)
+            .first()
+        )
+        if su_budget is None:
+            # if the default SU budget for project is 0, then there are no limits
+            if project.default_su_budget == 0:
+                return None
+            su_budget = project.default_su_budget
+        alloc = su_calculators.get_active_allocation(project)
+        if not alloc:
+            return su_budget
+        return su_budget - ledger.user_committed_sus(alloc, user, lock=lock)
+
     def _check_usage_against_user_budget(self, user, project, new_charge):
         """Raises error if user charges exceed allocated budget
 
         Raises:
             exceptions.BillingError:
         """
-        try:
-            user_budget = ChargeBudget.objects.get(user=user, project=project)
-        except ChargeBudget.DoesNotExist:
-            # if the default SU budget for project is 0, then there are no limits
-            if project.default_su_budget == 0:
-                return
-            else:
-                user_budget = ChargeBudget(
-                    user=user, project=project, su_budget=project.default_su_budget
-                )
-                user_budget.save()
-        left = user_budget.su_budget - su_calculators.calculate_user_total_su_usage(
-            user, project
+        failure = _user_budget_failure(
+            user, new_charge, self._get_user_budget_left(user, project, lock=True)
         )
-        if left < new_charge:
-            raise exceptions.BillingError(
-                message=(
-                    "Reservation for user {} would spend {:.2f} SUs, "
-                    "only {:.2f} left in user budget".format(
-                        user.username, new_charge, left
-                    )
-                )
-            )
+        if failure:
+            raise exceptions.BillingError(message=failure)
 
     def check_usage_against_allocation(self, data):
         """Check if we have enough available SUs for this reservation
@@ -180,21 +292,16 @@ class UsageEnforcer(object):
 
         left = self.get_remaining_balance(lease_eval.project.id)
 
-        if left - lease_eval.amount < 0:
-            raise exceptions.BillingError(
-                message=(
-                    "Reservation for project {} would spend {:.2f} SUs, "
-                    "only {:.2f} left".format(
-                        lease_eval.project.charge_code, lease_eval.amount, left
-                    )
-                )
-            )
+        failure = _balance_failure(lease_eval.project, lease_eval.amount, left)
+        if failure:
+            raise exceptions.BillingError(message=failure)
 
         alloc = su_calculators.get_active_allocation(lease_eval.project)
-        keycloak_client = KeycloakClient()
-        role, scopes = keycloak_client.get_user_project_role_scopes(
-            lease_eval.user, lease_eval.project.charge_code
-        )
+        with metrics.timed("role"):
+            keycloak_client = KeycloakClient()
+            role, scopes = keycloak_client.get_user_project_role_scopes(
+                lease_eval.user, lease_eval.project.charge_code
+            )
         if role == "member":
             self._check_usage_against_user_budget(
                 lease_eval.user, lease_eval.project, lease_eval.amount
@@ -208,6 +315,7 @@ class UsageEnforcer(object):
         )
 
         # create new charges
+        new_charges = []
         for reservation in lease["reservations"]:
             # Use tmp resource id if not given
             resource_id = reservation.get(
@@ -220,21 +328,131 @@ class UsageEnforcer(object):
                     name=lease["name"],
                 ),
             )
-            new_charge = Charge(
-                allocation=alloc,
-                user=lease_eval.user,
-                region_name=lease_eval.region,
-                resource_id=resource_id,
-                resource_type=reservation["resource_type"],
-                start_time=self._convert_to_localtime(
-                    self._date_from_string(lease["start_date"])
-                ),
-                end_time=self._convert_to_localtime(
-                    self._date_from_string(lease["end_date"])
+            new_charges.append(
+                Charge(
+                    allocation=alloc,
+                    user=lease_eval.user,
+                    region_name=lease_eval.region,
+                    resource_id=resource_id,
+                    resource_type=reservation["resource_type"],
+                    start_time=self._convert_to_localtime(
+                        self._date_from_string(lease["start_date"])
+                    ),
+                    end_time=self._convert_to_localtime(
+                        self._date_from_string(lease["end_date"])
+                    ),
+                    hourly_cost=self._get_reservation_sus(reservation),
+                )
+            )
+        with metrics.timed("charge_write"):
+            Charge.objects.bulk_create(new_charges)
+            ledger.record(added=[ledger.charge_state(c) for c in new_charges])
+
+    def _quote_cache_key(self, data):
+        context = data["context"]
+        lease = data["lease"]
+        # Only what affects the price and the checks, not names or ids
+        shape = {
+            "start_date": lease["start_date"],
+            "end_date": lease["end_date"],
+            "reservations": [
+                {
+                    "resource_type": r["resource_type"],
+                    "resource_properties": r.get("resource_properties"),
+                    "vcpus": r.get("vcpus"),
+                    "allocations": [
+                        [a.get("vcpus"), a.get("su_factor")] for a in r["allocations"]
+                    ],
+                }
+                for r in lease["reservations"]
+            ],
+        }
+        digest = hashlib.sha256(json.dumps(shape, sort_keys=True).encode()).hexdigest()
+        return (
+            f"{QUOTE_CACHE_PREFIX}:{self._keystone_cache_scope()}:"
+            f"{context['project_id']}:{context['user_id']}:{digest}"
+        )
+
+    def quote(self, data):
+        """Price a new lease and run the checks of ``check_usage_against_allocation``
+
+        Nothing is written: instead of raising, failed checks are listed in the
+        result. Quotes are cached per lease shape, project and user for
+        ``BALANCE_SERVICE_QUOTE_CACHE_TTL_SECONDS``.
+        """
+        cache_key = self._quote_cache_key(data)
+        quote = cache.get(cache_key)
+        if quote is not None:
+            return quote
+
+        lease = data["lease"]
+        lease_eval = self._evaluate_lease(data["context"], lease)
+        project = lease_eval.project
+
+        # Unlike get_remaining_balance, this does not touch the ledger
+        balance = su_calculators.batch_project_balances([project.id])[0]
+        left = balance["allocated"] - balance["total"]
+        failures = []
+        failure = _balance_failure(project, lease_eval.amount, left)
+        if failure:
+            failures.append({"check": "balance", "message": failure})
+
+        user_budget_left = None
+        with metrics.timed("role"):
+            role, scopes = KeycloakClient().get_user_project_role_scopes(
+                lease_eval.user, project.charge_code
+            )
+        if role == "member":
+            user_budget_left = self._get_user_budget_left(lease_eval.user, project)
+            failure = _user_budget_failure(
+                lease_eval.user, lease_eval.amount, user_budget_left
+            )
+            if failure:
+                failures.append({"check": "user_budget", "message": failure})
+
+        alloc = su_calculators.get_active_allocation(project)
+        checks = [
+            (
+                "duration",
+                lambda: self._check_lease_duration(
+                    lease, lease_eval, lease["start_date"], lease["end_date"]
                 ),
-                hourly_cost=self._get_reservation_sus(reservation),
             )
-            new_charge.save()
+        ]
+        if alloc:
+            approved_alloc = su_calculators.get_consecutive_approved_allocation(
+                project, alloc
+            )
+            checks.append(
+                (
+                    "expiration",
+                    lambda: self._check_alloc_expiration_date(
+                        lease, alloc, approved_alloc
+                    ),
+                )
+            )
+        else:
+            failures.append(
+                {"check": "allocation", "message": "Project has no active allocation"}
+            )
+        for check, fn in checks:
+            try:
+                fn()
+            except exceptions.EnforcementException as e:
+                failures.append({"check": check, "message": e.message})
+
+        quote = {
+            "project": project.charge_code,
+            "duration": lease_eval.duration,
+            "su_factor": lease_eval.total_su_factor,
+            "amount": lease_eval.amount,
+            "remaining_balance": left,
+            "user_budget_remaining": user_budget_left,
+            "allowed": not failures,
+            "failures": failures,
+        }
+        cache.set(cache_key, quote, settings.BALANCE_SERVICE_QUOTE_CACHE_TTL_SECONDS)
+        return quote
 
     def check_usage_against_allocation_update(self, data):
         """Check if we have enough available SUs for update"""
@@ -278,6 +496,7 @@ class UsageEnforcer(object):
             new_lease_eval.project, alloc
         )
         self._check_alloc_expiration_date(new_lease, alloc, approved_alloc)
+        changed_reservations = []
         for reservation in new_lease["reservations"]:
             new_hourly_cost = self._get_reservation_sus(reservation)
             if not end_date_changed:
@@ -292,41 +511,58 @@ class UsageEnforcer(object):
                 if new_hourly_cost == old_hourly_cost:
                     # nothing changed
                     continue
-            reservation_charges = self._get_charges_by_reservation(
-                reservation["id"], new_lease_eval.region
-            )
+            changed_reservations.append((reservation, new_hourly_cost))
+        if not changed_reservations:
+            return
 
-            # get the ongoing charge
-            ongoing_charge = [c for c in reservation_charges if c.end_time > now]
+        ongoing_charges = collections.defaultdict(list)
+        for charge in self._get_ongoing_charges(
+            [r["id"] for r, _ in changed_reservations], new_lease_eval.region, now
+        ):
+            ongoing_charges[charge.resource_id].append(charge)
+
+        closed_charges = []
+        new_charges = []
+        for reservation, new_hourly_cost in changed_reservations:
             # should have exactly one ongoing charge
-            if len(ongoing_charge) == 1:
-                ongoing_charge = ongoing_charge[0]
-                ongoing_charge.end_time = now
-                ongoing_charge.save()
-            else:
+            if len(ongoing_charges[reservation["id"]]) != 1:
                 raise exceptions.BillingError(
                     message=(
                         f"Wrong number of ongoing charges for reservation {reservation['id']}"
                     )
                 )
-            new_charge = Charge(
-                allocation=alloc,
-                user=new_lease_eval.user,
-                region_name=new_lease_eval.region,
-                resource_id=reservation["id"],
-                resource_type=reservation["resource_type"],
-                start_time=max(
-                    now,
-                    self._convert_to_localtime(
-                        self._date_from_string(new_lease["start_date"])
+            closed_charges.extend(ongoing_charges[reservation["id"]])
+            new_charges.append(
+                Charge(
+                    allocation=alloc,
+                    user=new_lease_eval.user,
+                    region_name=new_lease_eval.region,
+                    resource_id=reservation["id"],
+                    resource_type=reservation["resource_type"],
+                    start_time=max(
+                        now,
+                        self._convert_to_localtime(
+                            self._date_from_string(new_lease["start_date"])
+                        ),
                     ),
-                ),
-                end_time=self._convert_to_localtime(
-                    self._date_from_string(new_lease["end_date"])
-                ),
-                hourly_cost=new_hourly_cost,
+                    end_time=self._convert_to_localtime(
+                        self._date_from_string(new_lease["end_date"])
+                    ),
+                    hourly_cost=new_hourly_cost,
+                )
+            )
+
+        with metrics.timed("charge_write"):
+            Charge.objects.filter(pk__in=[c.pk for c in closed_charges]).update(
+                end_time=now, updated_at=now
+            )
+            Charge.objects.bulk_create(new_charges)
+            removed = [ledger.charge_state(c) for c in closed_charges]
+            ledger.record(
+                removed=removed,
+                added=[state._replace(end_time=now) for state in removed]
+                + [ledger.charge_state(c) for c in new_charges],
             )
-            new_charge.save()
 
     def stop_charging(self, data):
         """Stop charging SUs"""
@@ -339,31 +575,40 @@ class UsageEnforcer(object):
         debug_lease_reservations("Ending reservation", lease)
 
         now = timezone.now()
-        for reservation in lease["reservations"]:
-            reservation_charges = self._get_charges_by_reservation(
-                reservation["id"], lease_eval.region
+        with metrics.timed("charge_write"):
+            ongoing_charges = self._get_ongoing_charges(
+                [reservation["id"] for reservation in lease["reservations"]],
+                lease_eval.region,
+                now,
+            )
+            closed_charges = list(ledger.charge_states(ongoing_charges))
+            if closed_charges:
+                # The rows are locked, so the UPDATE ends exactly these charges
+                ongoing_charges.update(end_time=now, updated_at=now)
+            ledger.record(
+                removed=closed_charges,
+                added=[state._replace(end_time=now) for state in closed_charges],
             )
 
-            for charge in reservation_charges:
-                if charge.end_time > now:
-                    charge.end_time = now
-                    charge.save()
+    def __get_flavor_billrate(self, reservation):
+        # SU factor is configured per flavor in portal
+        # Note: this doesn't let us customize su_factor per project/user yet
+        flavor_id = _get_reservation_flavor_id(reservation)
+        v = ConfigVariable.get_value(
+            "su_factor",
+            flavor_id=flavor_id,
+        )
+        if v is not None:
+            return float(v)
+        return None
 
-    def __get_billrate(self, resource, reservation, resource_type=None):
+    def __get_billrate(self, resource, resource_type=None, flavor_billrate=None):
         # Do not charge for floating IPs
         if resource_type == "virtual:floatingip":
             return 0
 
-        # SU factor is configured per flavor in portal
-        # Note: this doesn't let us customize su_factor per project/user yet
-        if resource_type == "flavor:instance":
-            flavor_id = _get_reservation_flavor_id(reservation)
-            v = ConfigVariable.get_value(
-                "su_factor",
-                flavor_id=flavor_id,
-            )
-            if v is not None:
-                return float(v)
+        if flavor_billrate is not None:
+            return flavor_billrate
 
         # SU factor can be set at the blazar resource via blazar API for other resource types
         su_factor = resource.get("su_factor")
@@ -373,23 +618,39 @@ class UsageEnforcer(object):
         return DEFAULT_SU_FACTOR
 
     def _get_reservation_sus(self, reservation):
+        """Gets the hourly SUs of a reservation.
+
+        The result is memoized for the lifetime of this (per-request) enforcer,
+        as the same reservations are priced several times when updating a lease.
+        """
+        # Keep a reference to the reservation so its id cannot be reused
+        cached = self._reservation_sus.get(id(reservation))
+        if cached is not None and cached[0] is reservation:
+            return cached[1]
+
         resource_type = reservation["resource_type"]
         allocations = reservation["allocations"]
         if resource_type == "flavor:instance":
-            # There is 1 allocation per reservation["amount"]
-            running_total = 0
-            for alloc in allocations:
-                su_factor = self.__get_billrate(alloc, reservation, resource_type)
-                # What propotion of the host is being used by this reservation
-                host_usage = reservation["vcpus"] / alloc.get(
-                    "vcpus", reservation["vcpus"]
+            # There is 1 allocation per reservation["amount"], usually all on
+            # the same kind of host, so price each distinct kind once.
+            flavor_billrate = self.__get_flavor_billrate(reservation)
+            host_types = collections.Counter(
+                (
+                    self.__get_billrate(alloc, resource_type, flavor_billrate),
+                    alloc.get("vcpus", reservation["vcpus"]),
                 )
-                running_total += su_factor * host_usage
-            return running_total
-        else:
-            return sum(
-                self.__get_billrate(a, reservation, resource_type) for a in allocations
+                for alloc in allocations
             )
+            sus = 0
+            for (su_factor, host_vcpus), count in host_types.items():
+                # What propotion of the host is being used by this reservation
+                host_usage = reservation["vcpus"] / host_vcpus
+                sus += su_factor * host_usage * count
+        else:
+            sus = sum(self.__get_billrate(a, resource_type) for a in allocations)
+
+        self._reservation_sus[id(reservation)] = (reservation, sus)
+        return sus
 
     def _total_su_factor(self, lease_values):
         """Gets the total SUs for the lease.
@@ -416,6 +677,7 @@ class UsageEnforcer(object):
         localtz = utc.astimezone(timezone.get_current_timezone())
         return localtz
 
+    @metrics.timed("limits")
     def _check_alloc_expiration_date(self, lease, alloc, approved_alloc):
         lease_end = self._convert_to_localtime(
             self._date_from_string(lease["end_date"])
@@ -425,6 +687,7 @@ class UsageEnforcer(object):
         ):
             raise exceptions.LeasePastExpirationError()
 
+    @metrics.timed("limits")
     def _check_lease_duration(self, lease, lease_eval, start_date_str, end_date_str):
         # Note that start_date_str and end_date_str are passed in as parameters
         # to support updates, where the dates are in the new_lease dict
@@ -444,6 +707,7 @@ class UsageEnforcer(object):
                 max_duration=max_duration,
             )
 
+    @metrics.timed("limits")
     def _check_lease_update_window(self, old_lease, new_lease, new_lease_eval):
         old_start_date = self._date_from_string(old_lease["start_date"])
         old_end_date = self._date_from_string(old_lease["end_date"])
@@ -22,3 +22,13 @@ class AuthUserException(Exception):
 
     def __str__(self):
         return self.message.format(self.user)
+
+
+class TokenRejectedException(Exception):
+    def __init__(self, status_code, message=("Token rejected by Keystone ({})")):
+        self.status_code = status_code
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return self.message.format(self.status_code)
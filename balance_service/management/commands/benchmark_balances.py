@@ -0,0 +1,134 @@
+import functools
+import statistics
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from allocations.models import Allocation, Charge
+from balance_service.utils import su_calculators
+from projects.models import Project
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the per-project balance loop with the set-based batch "
+        "computation on synthetic projects. All data is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[10, 100, 1000],
+            help="Numbers of projects to benchmark.",
+        )
+        parser.add_argument(
+            "--charges-per-project",
+            type=int,
+            default=50,
+            help="Number of charges created for each project's allocation.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=3,
+            help="Number of timed runs per size; the median is reported.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'projects':>8} {'loop ms':>10} {'loop queries':>13} "
+            f"{'batch ms':>10} {'batch queries':>14} {'speedup':>8}"
+        )
+        for size in options["sizes"]:
+            with transaction.atomic():
+                project_ids = self._create_projects(
+                    size, options["charges_per_project"]
+                )
+                loop_ms, loop_queries = self._measure(
+                    functools.partial(su_calculators.project_balances, project_ids),
+                    options["repeat"],
+                )
+                batch_ms, batch_queries = self._measure(
+                    functools.partial(
+                        su_calculators.batch_project_balances, project_ids
+                    ),
+                    options["repeat"],
+                )
+                transaction.set_rollback(True)
+            self.stdout.write(
+                f"{size:>8} {loop_ms:>10.1f} {loop_queries:>13} "
+                f"{batch_ms:>10.1f} {batch_queries:>14} "
+                f"{loop_ms / max(batch_ms, 1e-6):>7.1f}x"
+            )
+
+    def _measure(self, fn, repeat):
+        timings = []
+        queries = 0
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                fn()
+                timings.append((time.perf_counter() - start) * 1000)
+            queries = len(ctx.captured_queries)
+        return statistics.median(timings), queries
+
+    def _create_projects(self, count, charges_per_project):
+        now = timezone.now()
+        run_id = uuid.uuid4().hex[:8]
+        user = get_user_model().objects.create_user(
+            username=f"benchmark-{run_id}", password=uuid.uuid4().hex
+        )
+        Project.objects.bulk_create(
+            Project(
+                description="Balance benchmark project",
+                pi=user,
+                title=f"Benchmark {i}",
+                nickname=f"benchmark-{run_id}-{i}",
+                charge_code=f"BENCH-{run_id}-{i}",
+            )
+            for i in range(count)
+        )
+        # bulk_create does not return primary keys on every backend
+        projects = list(
+            Project.objects.filter(charge_code__startswith=f"BENCH-{run_id}-")
+        )
+        Allocation.objects.bulk_create(
+            Allocation(
+                project=project,
+                status="active",
+                requestor=user,
+                date_requested=now,
+                start_date=now - timezone.timedelta(days=30),
+                expiration_date=now + timezone.timedelta(days=30),
+                su_requested=100000,
+                su_allocated=100000,
+            )
+            for project in projects
+        )
+        allocations = Allocation.objects.filter(project__in=projects)
+        charges = []
+        for alloc in allocations:
+            for i in range(charges_per_project):
+                # a mix of finished, ongoing and future charges
+                start = now + timezone.timedelta(hours=i - charges_per_project * 0.8)
+                charges.append(
+                    Charge(
+                        allocation=alloc,
+                        user=user,
+                        region_name="CHI@UC",
+                        resource_id=uuid.uuid4().hex,
+                        resource_type="physical:host",
+                        start_time=start,
+                        end_time=start + timezone.timedelta(hours=4),
+                        hourly_cost=1.0,
+                    )
+                )
+        Charge.objects.bulk_create(charges, batch_size=5000)
+        return [project.id for project in projects]
@@ -0,0 +1,270 @@
+import contextlib
+import random
+import statistics
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from allocations import archive, charge_audit
+from allocations.models import Allocation, Charge
+from balance_service.utils import su_calculators
+from projects.models import Project
+
+REGIONS = ["CHI@UC", "CHI@TACC", "KVM@TACC"]
+RESOURCE_INDEX = "allocations_charge_resource_region_idx"
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the charge queries of enforcement on a synthetic charge history, "
+        "before and after archiving the charges of inactive allocations, and "
+        "show their query plans. All data is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--charges",
+            type=int,
+            default=2_000_000,
+            help="Number of charges in the synthetic history.",
+        )
+        parser.add_argument(
+            "--allocations",
+            type=int,
+            default=2000,
+            help="Number of allocations the charges are spread over.",
+        )
+        parser.add_argument(
+            "--active-fraction",
+            type=float,
+            default=0.05,
+            help="Fraction of the allocations that are active.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=20,
+            help="Number of timed runs per query; the median is reported.",
+        )
+        parser.add_argument(
+            "--without-indexes",
+            action="store_true",
+            help=(
+                "Also time the queries with the composite charge indexes "
+                "dropped. Needs a database that can roll back schema changes."
+            ),
+        )
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help="Print the query plan of each query in each phase.",
+        )
+
+    def handle(self, *args, **options):
+        if options["without_indexes"]:
+            if not connection.features.can_rollback_ddl:
+                raise CommandError(
+                    f"{connection.vendor} cannot roll back dropped indexes"
+                )
+            # SQLite can only alter tables in a transaction without them
+            connection.disable_constraint_checking()
+        try:
+            phases = self._run(options)
+        finally:
+            if options["without_indexes"]:
+                connection.enable_constraint_checking()
+
+        names = list(phases[0][1])
+        self.stdout.write(
+            f"{'query':<24}" + "".join(f"{phase + ' ms':>16}" for phase, _ in phases)
+        )
+        for name in names:
+            self.stdout.write(
+                f"{name:<24}"
+                + "".join(f"{timings[name]:>16.2f}" for _, timings in phases)
+            )
+
+    def _run(self, options):
+        with transaction.atomic():
+            self.stdout.write(f"Creating {options['charges']} charges...")
+            self._create_history(
+                options["charges"], options["allocations"], options["active_fraction"]
+            )
+            phases = []
+            if options["without_indexes"]:
+                with self._dropped_indexes():
+                    phases.append(("no indexes", self._measure(options)))
+            phases.append(("indexed", self._measure(options)))
+            start = time.perf_counter()
+            moved = archive.archive_charges()
+            self.stdout.write(
+                f"Archived {moved} charges in {time.perf_counter() - start:.1f}s, "
+                f"{Charge.objects.count()} left"
+            )
+            phases.append(("archived", self._measure(options)))
+            transaction.set_rollback(True)
+        return phases
+
+    def _queries(self):
+        """The charge queries run while enforcing leases"""
+        reservation = self.active_resource_ids[0]
+        reservations = self.active_resource_ids[:10]
+        now = timezone.now()
+        return {
+            # UsageEnforcer._get_charges_by_reservation
+            "charges by reservation": lambda: list(
+                Charge.objects.filter(resource_id=reservation, region_name=REGIONS[0])
+            ),
+            # UsageEnforcer._get_ongoing_charges
+            "ongoing charges": lambda: list(
+                Charge.objects.filter(
+                    resource_id__in=reservations, region_name=REGIONS[0]
+                )
+                .filter(end_time__gt=now)
+                .select_for_update()
+            ),
+            # the user budget check
+            "user charges": lambda: Charge.objects.filter(
+                allocation=self.active_allocation, user=self.user
+            ).aggregate(Sum("hourly_cost")),
+            "project balances": lambda: su_calculators.batch_project_balances(
+                self.active_project_ids
+            ),
+            # the portal side of check_charge
+            "charge audit": lambda: list(
+                charge_audit.portal_reservations(
+                    REGIONS[0], now - timezone.timedelta(days=30)
+                )
+            ),
+        }
+
+    def _measure(self, options):
+        results = {}
+        for name, query in self._queries().items():
+            query()
+            timings = []
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                query()
+                timings.append((time.perf_counter() - start) * 1000)
+            results[name] = statistics.median(timings)
+        if options["explain"]:
+            self._explain()
+        return results
+
+    def _explain(self):
+        plans = {
+            "charges by reservation": Charge.objects.filter(
+                resource_id=self.active_resource_ids[0], region_name=REGIONS[0]
+            ),
+            "user charges": Charge.objects.filter(
+                allocation=self.active_allocation, user=self.user
+            ),
+            "charge audit": Charge.objects.filter(
+                region_name=REGIONS[0],
+                end_time__gte=timezone.now() - timezone.timedelta(days=30),
+            ).order_by("resource_id", "-end_time"),
+        }
+        for name, queryset in plans.items():
+            self.stdout.write(f"-- {name}\n{queryset.explain()}")
+
+    @contextlib.contextmanager
+    def _dropped_indexes(self):
+        # The (resource_id, region_name) index is created by a migration, as
+        # it needs prefix lengths on MySQL, which cannot roll back DDL anyway
+        with connection.schema_editor(atomic=False) as editor:
+            for index in Charge._meta.indexes:
+                editor.remove_index(Charge, index)
+            editor.execute(f"DROP INDEX {RESOURCE_INDEX}")
+        yield
+        with connection.schema_editor(atomic=False) as editor:
+            for index in Charge._meta.indexes:
+                editor.add_index(Charge, index)
+            editor.execute(
+                f"CREATE INDEX {RESOURCE_INDEX} "
+                f"ON {Charge._meta.db_table} (resource_id, region_name)"
+            )
+
+    def _create_history(self, charge_count, allocation_count, active_fraction):
+        now = timezone.now()
+        run_id = uuid.uuid4().hex[:8]
+        self.user = get_user_model().objects.create_user(
+            username=f"benchmark-{run_id}", password=uuid.uuid4().hex
+        )
+        Project.objects.bulk_create(
+            Project(
+                description="Charge archive benchmark project",
+                pi=self.user,
+                title=f"Benchmark {i}",
+                nickname=f"benchmark-{run_id}-{i}",
+                charge_code=f"BENCH-{run_id}-{i}",
+            )
+            for i in range(allocation_count)
+        )
+        projects = list(
+            Project.objects.filter(charge_code__startswith=f"BENCH-{run_id}-")
+        )
+        active_count = max(1, int(allocation_count * active_fraction))
+        allocations = []
+        for i, project in enumerate(projects):
+            active = i < active_count
+            # Inactive allocations expired between 2 and 6 years ago
+            expiration = (
+                now + timezone.timedelta(days=90)
+                if active
+                else now - timezone.timedelta(days=random.randint(730, 2190))
+            )
+            allocations.append(
+                Allocation(
+                    project=project,
+                    status="active" if active else "inactive",
+                    requestor=self.user,
+                    date_requested=expiration - timezone.timedelta(days=365),
+                    start_date=expiration - timezone.timedelta(days=365),
+                    expiration_date=expiration,
+                    su_requested=100000,
+                    su_allocated=100000,
+                )
+            )
+        Allocation.objects.bulk_create(allocations)
+        allocations = list(
+            Allocation.objects.filter(project__in=projects).order_by("-expiration_date")
+        )
+        self.active_allocation = allocations[0]
+        self.active_project_ids = [a.project_id for a in allocations[:active_count]]
+
+        self.active_resource_ids = []
+        batch = []
+        for i in range(charge_count):
+            alloc = allocations[i % len(allocations)]
+            start = alloc.expiration_date - timezone.timedelta(
+                hours=random.randint(24, 24 * 360)
+            )
+            resource_id = uuid.uuid4().hex
+            region = REGIONS[i % len(REGIONS)]
+            # Leases still running, looked up by the benchmarked queries
+            if alloc.status == "active" and len(self.active_resource_ids) < 100:
+                self.active_resource_ids.append(resource_id)
+                start = now - timezone.timedelta(hours=1)
+                region = REGIONS[0]
+            batch.append(
+                Charge(
+                    allocation=alloc,
+                    user=self.user,
+                    region_name=region,
+                    resource_id=resource_id,
+                    resource_type="physical:host",
+                    start_time=start,
+                    end_time=start + timezone.timedelta(hours=random.randint(1, 168)),
+                    hourly_cost=1.0,
+                )
+            )
+            if len(batch) >= 10000:
+                Charge.objects.bulk_create(batch)
+                batch = []
+        Charge.objects.bulk_create(batch)
@@ -0,0 +1,397 @@
+import json
+import re
+import statistics
+import threading
+import time
+import uuid
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from allocations.models import Allocation, Charge
+from balance_service import views
+from projects.models import Project
+
+SERVICE_USER = "blazar"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+SCENARIOS = ["create", "create-flavor", "update", "on-end"]
+
+
+class FakeServices:
+    """Keystone and Keycloak stand-ins served over HTTP from a local thread.
+
+    Keystone answers ``/v3/auth/tokens``, ``/v3/projects/<id>`` and
+    ``/v3/users/<id>`` for the benchmark project and user. Keycloak answers
+    the admin token, group search and user group role endpoints used by
+    ``FakeKeycloakClient``. Every response is delayed by ``latency`` seconds.
+    """
+
+    def __init__(self, latency, project, user):
+        self.latency = latency
+        self.project = project
+        self.user = user
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, method, path):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        expires_at = timezone.now() + timezone.timedelta(hours=1)
+        if method == "POST" and path == "/v3/auth/tokens":
+            return 201, {
+                "token": {
+                    "user": {"name": SERVICE_USER},
+                    "expires_at": expires_at.isoformat(),
+                }
+            }
+        if method == "POST" and path.endswith("/protocol/openid-connect/token"):
+            return 200, {"access_token": uuid.uuid4().hex, "expires_in": 300}
+        if re.fullmatch(r"/v3/projects/[^/]+", path):
+            return 200, {
+                "project": {"id": path.rsplit("/", 1)[1], "name": self.project}
+            }
+        if re.fullmatch(r"/v3/users/[^/]+", path):
+            return 200, {
+                "user": {
+                    "id": path.rsplit("/", 1)[1],
+                    "name": self.user.username,
+                    "email": self.user.email,
+                }
+            }
+        if re.fullmatch(r"/admin/realms/[^/]+/groups", path):
+            return 200, [{"id": "group-id", "name": self.project}]
+        if re.fullmatch(r"/admin/realms/[^/]+/users/[^/]+/group-roles", path):
+            return 200, [{"policy": FakeKeycloakClient.role, "scopes": []}]
+        return 404, {}
+
+    def _handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, avoid delayed ACKs
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                status, body = services.respond(self.command, self.path.split("?")[0])
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class FakeKeycloakClient:
+    """Stands in for ``util.keycloak_client.KeycloakClient`` in the enforcer.
+
+    Makes the same round trips as the real client when looking up a role: an
+    admin token and a group search, then another admin token and the user's
+    group roles.
+    """
+
+    role = "admin"
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def _token(self):
+        return self.session.post(
+            f"{self.base_url}/realms/master/protocol/openid-connect/token"
+        ).json()["access_token"]
+
+    def get_user_project_role_scopes(self, portal_user, project_charge_code):
+        headers = {"Authorization": f"Bearer {self._token()}"}
+        groups = self.session.get(
+            f"{self.base_url}/admin/realms/chameleon/groups",
+            params={"search": project_charge_code},
+            headers=headers,
+        ).json()
+        group = next(g for g in groups if g["name"] == project_charge_code)
+        headers = {"Authorization": f"Bearer {self._token()}"}
+        roles = self.session.get(
+            f"{self.base_url}/admin/realms/chameleon/users/"
+            f"{portal_user.username}/group-roles",
+            params={"group": group["id"]},
+            headers=headers,
+        ).json()
+        return roles[0]["policy"], roles[0]["scopes"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the enforcement endpoints against local Keystone and "
+        "Keycloak stand-ins. All data is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scenarios",
+            nargs="+",
+            choices=SCENARIOS,
+            default=SCENARIOS,
+            help="Scenarios to run.",
+        )
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=50,
+            help="Number of timed requests per scenario.",
+        )
+        parser.add_argument(
+            "--reservations",
+            type=int,
+            default=10,
+            help="Number of host reservations per lease.",
+        )
+        parser.add_argument(
+            "--hosts-per-reservation",
+            type=int,
+            default=4,
+            help="Number of allocations of each host reservation.",
+        )
+        parser.add_argument(
+            "--flavor-allocations",
+            type=int,
+            default=100,
+            help="Number of allocations of the flavor reservation.",
+        )
+        parser.add_argument(
+            "--history",
+            type=int,
+            default=10000,
+            help="Number of past charges of the benchmark project.",
+        )
+        parser.add_argument(
+            "--latency-ms",
+            type=float,
+            default=5.0,
+            help="Latency added to every Keystone and Keycloak response.",
+        )
+        parser.add_argument(
+            "--role",
+            choices=["admin", "member"],
+            default="admin",
+            help="Project role of the user, members also check their budget.",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.factory = RequestFactory()
+        FakeKeycloakClient.role = options["role"]
+
+        with transaction.atomic():
+            project, user = self._create_fixture(options["history"])
+            with FakeServices(
+                options["latency_ms"] / 1000, project.charge_code, user
+            ) as services:
+                self.services = services
+                self.auth_url = f"{services.url}/v3"
+                # Blazar calls back with the same ids for a project's leases
+                self.keystone_project_id = uuid.uuid4().hex
+                self.keystone_user_id = uuid.uuid4().hex
+                with override_settings(
+                    OPENSTACK_AUTH_REGIONS={"Benchmark": self.auth_url},
+                    ALLOWED_OPENSTACK_SERVICE_USERS=[SERVICE_USER],
+                ), mock.patch(
+                    "balance_service.enforcement.usage_enforcement.KeycloakClient",
+                    partial(FakeKeycloakClient, services.url),
+                ):
+                    self.stdout.write(
+                        f"{'scenario':>14} {'req/s':>8} {'p50 ms':>8} "
+                        f"{'p95 ms':>8} {'p99 ms':>8} {'queries':>8} "
+                        f"{'http':>6} {'errors':>7}"
+                    )
+                    for scenario in options["scenarios"]:
+                        self._report(scenario, self._run(scenario))
+            transaction.set_rollback(True)
+
+    def _run(self, scenario):
+        results = []
+        for _ in range(self.options["requests"]):
+            if scenario == "create":
+                view, body = views.check_create, self._create_payload()
+            elif scenario == "create-flavor":
+                view, body = views.check_create, self._create_payload(flavor=True)
+            elif scenario == "update":
+                body = self._create_payload()
+                self._post(views.check_create, body)
+                view, body = views.check_update, self._update_payload(body)
+            else:
+                body = self._create_payload()
+                self._post(views.check_create, body)
+                view = views.on_end
+            service_requests = self.services.requests
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                status = self._post(view, body)
+                elapsed = time.perf_counter() - start
+            results.append(
+                (
+                    elapsed,
+                    len(ctx.captured_queries),
+                    self.services.requests - service_requests,
+                    status,
+                )
+            )
+        return results
+
+    def _report(self, scenario, results):
+        latencies = sorted(r[0] for r in results)
+        queries = statistics.mean(r[1] for r in results)
+        service_requests = statistics.mean(r[2] for r in results)
+        errors = sum(1 for r in results if r[3] != 204)
+
+        def percentile(p):
+            index = max(0, int(round(p / 100 * len(latencies))) - 1)
+            return latencies[index] * 1000
+
+        self.stdout.write(
+            f"{scenario:>14} {len(latencies) / sum(latencies):>8.1f} "
+            f"{percentile(50):>8.1f} {percentile(95):>8.1f} "
+            f"{percentile(99):>8.1f} {queries:>8.1f} "
+            f"{service_requests:>6.1f} {errors:>7}"
+        )
+
+    def _post(self, view, body):
+        request = self.factory.post(
+            "/",
+            data=json.dumps(body),
+            content_type="application/json",
+            HTTP_X_AUTH_TOKEN="benchmark-token",
+        )
+        return view(request).status_code
+
+    def _create_payload(self, flavor=False):
+        now = timezone.now()
+        if flavor:
+            reservations = [
+                {
+                    "id": str(uuid.uuid4()),
+                    "resource_type": "flavor:instance",
+                    "resource_properties": json.dumps({"id": "benchmark-flavor"}),
+                    "vcpus": 2,
+                    "allocations": [
+                        {"id": str(uuid.uuid4()), "vcpus": 48}
+                        for _ in range(self.options["flavor_allocations"])
+                    ],
+                }
+            ]
+        else:
+            reservations = [
+                {
+                    "id": str(uuid.uuid4()),
+                    "resource_type": "physical:host",
+                    "resource_properties": '["==", "$node_type", "compute"]',
+                    "allocations": [
+                        {"id": str(uuid.uuid4()), "su_factor": 1.0}
+                        for _ in range(self.options["hosts_per_reservation"])
+                    ],
+                }
+                for _ in range(self.options["reservations"])
+            ]
+        return {
+            "context": {
+                "user_id": self.keystone_user_id,
+                "project_id": self.keystone_project_id,
+                "auth_url": self.auth_url,
+                "region_name": "Benchmark",
+            },
+            "lease": {
+                "id": str(uuid.uuid4()),
+                "name": "benchmark",
+                "project_id": self.keystone_project_id,
+                "user_id": self.keystone_user_id,
+                # Not started yet, so updates skip the extension window check
+                "start_date": (now + timezone.timedelta(hours=1)).strftime(DATE_FORMAT),
+                "end_date": (now + timezone.timedelta(days=1)).strftime(DATE_FORMAT),
+                "reservations": reservations,
+            },
+        }
+
+    def _update_payload(self, body):
+        new_lease = dict(body["lease"])
+        end_date = timezone.datetime.strptime(new_lease["end_date"], DATE_FORMAT)
+        new_lease["end_date"] = (end_date + timezone.timedelta(hours=1)).strftime(
+            DATE_FORMAT
+        )
+        return {
+            "context": body["context"],
+            "current_lease": body["lease"],
+            "lease": new_lease,
+        }
+
+    def _create_fixture(self, history):
+        now = timezone.now()
+        run_id = uuid.uuid4().hex[:8]
+        user = get_user_model().objects.create_user(
+            username=f"benchmark-{run_id}",
+            email=f"benchmark-{run_id}@example.com",
+            password=uuid.uuid4().hex,
+        )
+        project = Project.objects.create(
+            description="Enforcement benchmark project",
+            pi=user,
+            title="Enforcement benchmark",
+            nickname=f"benchmark-{run_id}",
+            charge_code=f"BENCH-{run_id}",
+            default_su_budget=10**9,
+        )
+        alloc = Allocation.objects.create(
+            project=project,
+            status="active",
+            requestor=user,
+            date_requested=now,
+            start_date=now - timezone.timedelta(days=365),
+            expiration_date=now + timezone.timedelta(days=365),
+            su_requested=10**9,
+            su_allocated=10**9,
+        )
+        Charge.objects.bulk_create(
+            (
+                Charge(
+                    allocation=alloc,
+                    user=user,
+                    region_name="Benchmark",
+                    resource_id=uuid.uuid4().hex,
+                    resource_type="physical:host",
+                    start_time=now - timezone.timedelta(hours=i + 4),
+                    end_time=now - timezone.timedelta(hours=i),
+                    hourly_cost=1.0,
+                )
+                for i in range(history)
+            ),
+            batch_size=5000,
+        )
+        return project, user
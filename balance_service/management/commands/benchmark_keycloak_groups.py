@@ -0,0 +1,197 @@
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from util.keycloak_client import KeycloakClient
+
+REALM = "chameleon"
+
+
+class FakeKeycloak:
+    """A Keycloak stand-in with many groups, served over HTTP from a thread.
+
+    Answers the admin token and the group collection of the realm, which can
+    be searched by name with ``search`` and ``exact``. Every response is
+    delayed by ``latency`` seconds, and the requests and bytes sent are
+    counted.
+    """
+
+    def __init__(self, group_count, latency):
+        self.latency = latency
+        self.groups = [
+            {
+                "id": str(uuid.uuid4()),
+                "name": f"CHI-{i}",
+                "path": f"/CHI-{i}",
+                "attributes": {
+                    "has_active_allocation": [random.choice(["true", "false"])],
+                    "nickname": [f"project-{i}"],
+                },
+                "subGroups": [],
+            }
+            for i in range(group_count)
+        ]
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, method, path, params):
+        time.sleep(self.latency)
+        if path.endswith("/.well-known/openid-configuration"):
+            return 200, {
+                "token_endpoint": f"{self.url}/auth/realms/master/"
+                "protocol/openid-connect/token"
+            }
+        if method == "POST" and path.endswith("/protocol/openid-connect/token"):
+            return 200, {"access_token": uuid.uuid4().hex, "expires_in": 300}
+        if method == "GET" and path == f"/auth/admin/realms/{REALM}/groups":
+            search = params.get("search", [None])[0]
+            if search is None:
+                return 200, self.groups
+            if params.get("exact", ["false"])[0] == "true":
+                return 200, [g for g in self.groups if g["name"] == search]
+            return 200, [g for g in self.groups if search.lower() in g["name"].lower()]
+        return 404, {}
+
+    def _handler(self):
+        keycloak = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, avoid delayed ACKs
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                url = urlparse(self.path)
+                status, body = keycloak.respond(
+                    self.command, url.path, parse_qs(url.query)
+                )
+                payload = json.dumps(body).encode()
+                with keycloak._lock:
+                    keycloak.requests += 1
+                    keycloak.bytes_sent += len(payload)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class Command(BaseCommand):
+    help = (
+        "Time KeycloakClient group lookups against a local Keycloak stand-in "
+        "with many groups: scanning every group as lookups used to, searching "
+        "by exact name, and reading the group cache."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--groups",
+            type=int,
+            default=10000,
+            help="Number of groups in Keycloak.",
+        )
+        parser.add_argument(
+            "--lookups",
+            type=int,
+            default=100,
+            help="Number of timed lookups per method.",
+        )
+        parser.add_argument(
+            "--projects",
+            type=int,
+            default=20,
+            help="Number of distinct projects looked up.",
+        )
+        parser.add_argument(
+            "--latency-ms",
+            type=float,
+            default=2.0,
+            help="Latency added to every Keycloak response.",
+        )
+
+    def handle(self, *args, **options):
+        with FakeKeycloak(
+            options["groups"], options["latency_ms"] / 1000
+        ) as keycloak, override_settings(
+            KEYCLOAK_SERVER_URL=keycloak.url,
+            KEYCLOAK_REALM_NAME=REALM,
+            KEYCLOAK_PORTAL_ADMIN_CLIENT_ID="portal",
+            KEYCLOAK_PORTAL_ADMIN_CLIENT_SECRET=uuid.uuid4().hex,
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+            },
+        ):
+            client = KeycloakClient()
+            names = [
+                group["name"]
+                for group in random.sample(keycloak.groups, options["projects"])
+            ]
+            # Fetch the admin token outside of the timings
+            client._search_group(names[0])
+            methods = {
+                "full scan": lambda name: self._scan(client, name),
+                "exact search": client._search_group,
+                "cached": client._lookup_group,
+            }
+            self.stdout.write(
+                f"{'lookup':<14} {'p50 ms':>8} {'p95 ms':>8} "
+                f"{'requests':>9} {'KB':>10}"
+            )
+            for method, lookup in methods.items():
+                cache.clear()
+                requests, bytes_sent = keycloak.requests, keycloak.bytes_sent
+                timings = []
+                for i in range(options["lookups"]):
+                    name = names[i % len(names)]
+                    start = time.perf_counter()
+                    group = lookup(name)
+                    timings.append((time.perf_counter() - start) * 1000)
+                    assert group["name"] == name
+                lookups = options["lookups"]
+                self.stdout.write(
+                    f"{method:<14} {statistics.median(timings):>8.2f} "
+                    f"{statistics.quantiles(timings, n=20)[-1]:>8.2f} "
+                    f"{(keycloak.requests - requests) / lookups:>9.2f} "
+                    f"{(keycloak.bytes_sent - bytes_sent) / lookups / 1024:>10.1f}"
+                )
+
+    def _scan(self, client, name):
+        """How ``KeycloakClient._lookup_group`` used to find a group."""
+        keycloakproject = client._project_admin()
+        groups = keycloakproject._client.get(
+            url=keycloakproject._client.get_full_url(
+                keycloakproject.get_path("collection", realm=client.realm_name)
+            )
+        )
+        return next((g for g in groups if g["name"] == name), None)
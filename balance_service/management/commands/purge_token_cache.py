@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from balance_service.utils.openstack import keystone
+
+
+class Command(BaseCommand):
+    help = "Forget all cached Keystone service token validations."
+
+    def handle(self, *args, **options):
+        keystone.purge_token_cache()
+        self.stdout.write("Purged the Keystone token validation cache")
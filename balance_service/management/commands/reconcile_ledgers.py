@@ -0,0 +1,94 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from allocations.models import Allocation, AllocationLedger, AllocationUserLedger
+from balance_service.utils import ledger
+
+# Ledger counters are sums of values rounded to the cent
+DRIFT_TOLERANCE = 0.01
+
+
+class Command(BaseCommand):
+    help = "Rebuild allocation SU ledgers from Charge rows and report drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--allocation",
+            type=int,
+            action="append",
+            dest="allocation_ids",
+            help="Only reconcile the given allocation id (repeatable).",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Reconcile every allocation, not only active ones.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report drift, without rebuilding the ledgers.",
+        )
+
+    def handle(self, *args, **options):
+        allocations = Allocation.objects.all()
+        if options["allocation_ids"]:
+            allocations = allocations.filter(pk__in=options["allocation_ids"])
+        elif not options["all"]:
+            allocations = allocations.filter(status="active")
+
+        checked = 0
+        drifted = 0
+        drifted_users = 0
+        for alloc in allocations.iterator():
+            checked += 1
+            with transaction.atomic():
+                current = (
+                    AllocationLedger.objects.select_for_update()
+                    .filter(allocation=alloc)
+                    .first()
+                )
+                if current is None:
+                    self.stdout.write(f"Allocation {alloc.id}: no ledger")
+                else:
+                    committed, settled = ledger.compute_counters(
+                        alloc.id, current.settled_until
+                    )
+                    committed_drift = current.committed_sus - committed
+                    settled_drift = current.settled_sus - settled
+                    if (
+                        abs(committed_drift) > DRIFT_TOLERANCE
+                        or abs(settled_drift) > DRIFT_TOLERANCE
+                    ):
+                        drifted += 1
+                        self.stdout.write(
+                            self.style.WARNING(
+                                f"Allocation {alloc.id}: committed drift "
+                                f"{committed_drift:+.2f} SUs, settled drift "
+                                f"{settled_drift:+.2f} SUs"
+                            )
+                        )
+                user_counters = ledger.compute_user_counters(alloc.id)
+                for user_ledger in AllocationUserLedger.objects.filter(
+                    allocation=alloc
+                ):
+                    user_drift = user_ledger.committed_sus - user_counters.get(
+                        user_ledger.user_id, 0.0
+                    )
+                    if abs(user_drift) > DRIFT_TOLERANCE:
+                        drifted_users += 1
+                        self.stdout.write(
+                            self.style.WARNING(
+                                f"Allocation {alloc.id}, user {user_ledger.user_id}: "
+                                f"committed drift {user_drift:+.2f} SUs"
+                            )
+                        )
+                if not options["dry_run"]:
+                    ledger.rebuild(alloc, timezone.now())
+
+        self.stdout.write(
+            f"Checked {checked} allocation ledgers, {drifted} had drifted, "
+            f"{drifted_users} user ledgers had drifted"
+            + ("" if options["dry_run"] else "; all ledgers rebuilt")
+        )
@@ -1,6 +1,19 @@
-from itertools import combinations
-from django.db import models
+import time
+import uuid
+from itertools import combinations, product
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+# Bumped whenever a ConfigVariable changes, so every worker reloads them
+CONFIG_VERSION_CACHE_KEY = "balance_service:config_variables:version"
+
+# (username, project, flavor) scopes to try, from most to least specific
+SCOPE_SPECIFICITY = list(product([True, False], repeat=3))
 
 
 def generate_constraints():
@@ -74,26 +87,92 @@ class ConfigVariable(models.Model):
         Look up the most specific configuration variable for the given parameters,
         returning none if not found.
 
-        Finds all ConfigVariables matching the key and any of the optional parameters,
-        then ranks by specificity (i.e. user > project > flavor), and gets the value
-        for the most specific match.
+        Ranks by specificity (i.e. user > project > flavor), and gets the value
+        for the most specific match. Lookups are answered from an in-memory
+        copy of all ConfigVariables, see :class:`ConfigResolver`.
         """
-        matching = cls.objects.filter(key=key).filter(
-            Q(username__isnull=True) | Q(username=username),
-            Q(project_charge_code__isnull=True) | Q(project_charge_code=charge_code),
-            Q(flavor_id__isnull=True) | Q(flavor_id=flavor_id),
-        )
-
-        def rank(c):
-            return (
-                1 if c.username and c.username == username else 0,
-                (
-                    1
-                    if c.project_charge_code and c.project_charge_code == charge_code
-                    else 0
-                ),
-                1 if c.flavor_id and c.flavor_id == flavor_id else 0,
+        return _resolver.get_value(key, flavor_id, username, charge_code)
+
+    @classmethod
+    def clear_cache(cls):
+        """Drop this process' in-memory copy of ConfigVariables."""
+        _resolver.clear()
+
+
+class ConfigResolver:
+    """
+    In-memory index of every ConfigVariable by its exact scope.
+
+    The index is reloaded when a ConfigVariable is saved or deleted in this
+    process, and when the version stored in the shared cache has changed, which
+    is checked at most every ``BALANCE_SERVICE_CONFIG_RECHECK_SECONDS``. Bulk
+    queryset updates do not send signals and are not picked up until
+    :func:`bump_config_version` is called.
+    """
+
+    def __init__(self):
+        self._values = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def clear(self):
+        self._values = None
+
+    def _shared_version(self):
+        version = cache.get(CONFIG_VERSION_CACHE_KEY)
+        if version is None:
+            cache.add(CONFIG_VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+            version = cache.get(CONFIG_VERSION_CACHE_KEY)
+        return version
+
+    def _load(self):
+        now = time.monotonic()
+        values = self._values
+        if (
+            values is not None
+            and now - self._checked_at < settings.BALANCE_SERVICE_CONFIG_RECHECK_SECONDS
+        ):
+            return values
+
+        # Read the version first, so a change racing with the load below
+        # is picked up on the next check
+        version = self._shared_version()
+        if values is None or version != self._version:
+            values = {
+                (c.key, c.username, c.project_charge_code, c.flavor_id): c.value
+                for c in ConfigVariable.objects.all()
+            }
+            self._values = values
+            self._version = version
+        self._checked_at = now
+        return values
+
+    def get_value(self, key, flavor_id=None, username=None, charge_code=None):
+        values = self._load()
+        for by_user, by_project, by_flavor in SCOPE_SPECIFICITY:
+            scope = (
+                key,
+                username if by_user else None,
+                charge_code if by_project else None,
+                flavor_id if by_flavor else None,
             )
+            if scope in values:
+                return values[scope]
+        return None
+
+
+_resolver = ConfigResolver()
+
+
+def bump_config_version():
+    """Make every worker reload ConfigVariables on its next check."""
+    _resolver.clear()
+    cache.set(CONFIG_VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+
 
-        ranked = sorted(matching, key=lambda c: rank(c), reverse=True)
-        return ranked[0].value if ranked else None
+@receiver(post_save, sender=ConfigVariable)
+@receiver(post_delete, sender=ConfigVariable)
+def config_variable_changed(sender, **kwargs):
+    _resolver.clear()
+    # Other workers must not reload before the change is visible to them
+    transaction.on_commit(bump_config_version)
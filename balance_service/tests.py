@@ -1,13 +1,28 @@
+import io
 import json
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
-from allocations.models import Charge, ChargeBudget
+from allocations.models import (
+    AllocationLedger,
+    AllocationUserLedger,
+    ArchivedCharge,
+    Charge,
+    ChargeBudget,
+)
 from balance_service.enforcement import exceptions
 from balance_service.enforcement.usage_enforcement import (
     UsageEnforcer,
     get_config_value,
 )
-from balance_service.models import ConfigVariable
+from balance_service.models import CONFIG_VERSION_CACHE_KEY, ConfigVariable
+from balance_service import views
+from balance_service.apps import check_shared_cache
+from balance_service.exceptions import AuthUserException, TokenRejectedException
+from balance_service.utils.openstack import keystone
 from projects.models import Project
 from django.contrib.auth import get_user_model
 from unittest.mock import patch, MagicMock
@@ -15,7 +30,7 @@ from datetime import timedelta
 
 import logging
 
-from balance_service.utils import su_calculators
+from balance_service.utils import ledger, su_calculators
 
 LOG = logging.getLogger(__name__)
 
@@ -31,6 +46,8 @@ from .utils.su_calculators import (
 class BalanceServiceTest(TestCase):
     def setUp(self):
         # Set up data for the tests
+        cache.clear()
+        ConfigVariable.clear_cache()
         User = get_user_model()
         self.now = timezone.now()
         self.test_requestor = User.objects.create_user(
@@ -139,6 +156,40 @@ class BalanceServiceTest(TestCase):
         self.assertAlmostEqual(balance["allocated"], 50)
         self.assertAlmostEqual(balance["encumbered"], 25.0, places=2)
 
+    @patch("django.utils.timezone.now")
+    def test_batch_project_balances_matches_project_balances(self, mock_now):
+        mock_now.return_value = self.now
+        other_project = Project.objects.create(
+            pi=self.test_requestor,
+            title="Project without allocation",
+            nickname="no_alloc_project",
+            charge_code="TEST456",
+        )
+        project_ids = [self.project.id, other_project.id]
+
+        with self.assertNumQueries(3):
+            batch = su_calculators.batch_project_balances(project_ids, now=self.now)
+        expected = sorted(project_balances(project_ids), key=lambda b: b["id"])
+        self.assertEqual(len(batch), len(expected))
+        for balance, expected_balance in zip(batch, expected):
+            self.assertEqual(balance["charge_code"], expected_balance["charge_code"])
+            for key in ("used", "total", "encumbered", "allocated"):
+                self.assertAlmostEqual(balance[key], expected_balance[key], places=2)
+
+    @patch("balance_service.views.keystone.KeystoneAPI")
+    def test_batch_get_project_allocations_ndjson(self, mock_ks):
+        mock_ks.load_from_request.return_value.get_auth_username.return_value = "blazar"
+        body = f'{self.project.id}\n{{"id": {self.project.id}}}\n'
+        request = RequestFactory().post(
+            "/", data=body, content_type="application/x-ndjson"
+        )
+
+        response = views.batch_get_project_allocations(request)
+
+        self.assertEqual(response.status_code, 200)
+        projects = json.loads(response.content)["projects"]
+        self.assertEqual([p["charge_code"] for p in projects], ["TEST123"])
+
     @patch("django.utils.timezone.now")
     def test_calculate_user_total_su_usage(self, mock_now):
         mock_now.return_value = self.now
@@ -352,6 +403,190 @@ class BalanceServiceTest(TestCase):
                 self._lease_data(timezone.timedelta(hours=5))
             )
 
+    @patch("django.utils.timezone.now")
+    @patch("balance_service.utils.openstack.keystone.KeystoneAPI")
+    @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
+    def test_usage_enforcer_quote_does_not_charge(self, mock_kc, mock_ks, mock_now):
+        mock_now.return_value = self.now
+
+        ks_instance = mock_ks.return_value
+        ks_instance.get_project.return_value = {"name": "TEST123"}
+        ks_instance.get_user.return_value = {"name": "test_requestor"}
+
+        kc_instance = mock_kc.return_value
+        kc_instance.get_user_project_role_scopes.return_value = ("admin", None)
+
+        charge_count = Charge.objects.count()
+        lease_data = self._lease_data(timezone.timedelta(hours=5))
+        quote = UsageEnforcer(ks_instance).quote(lease_data)
+
+        self.assertAlmostEqual(quote["amount"], 30)
+        self.assertAlmostEqual(quote["remaining_balance"], 9)
+        self.assertFalse(quote["allowed"])
+        self.assertEqual([f["check"] for f in quote["failures"]], ["balance"])
+        # The same message check_usage_against_allocation raises
+        self.assertRegex(
+            quote["failures"][0]["message"], r"would spend 30.00 SUs.*only 9.00 left"
+        )
+        self.assertEqual(Charge.objects.count(), charge_count)
+
+        # The same lease shape under another name is served from the cache
+        lease_data["lease"]["name"] = "other_lease"
+        with self.assertNumQueries(0):
+            self.assertEqual(UsageEnforcer(ks_instance).quote(lease_data), quote)
+
+    @patch("django.utils.timezone.now")
+    @patch("balance_service.views.keystone.KeystoneAPI")
+    @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
+    def test_quote_view(self, mock_kc, mock_ks, mock_now):
+        mock_now.return_value = self.now
+
+        ks_instance = mock_ks.load_from_request.return_value
+        ks_instance.get_auth_username.return_value = "blazar"
+        ks_instance.get_project.return_value = {"name": "TEST123"}
+        ks_instance.get_user.return_value = {"name": "test_requestor"}
+        mock_kc.return_value.get_user_project_role_scopes.return_value = (
+            "admin",
+            None,
+        )
+
+        request = RequestFactory().post(
+            "/",
+            data=json.dumps(self._lease_data(timezone.timedelta(hours=1))),
+            content_type="application/json",
+        )
+        response = views.quote(request)
+
+        self.assertEqual(response.status_code, 200)
+        quote = json.loads(response.content)
+        self.assertTrue(quote["allowed"])
+        self.assertAlmostEqual(quote["amount"], 6)
+
+    def _enforcement_request(self, mock_ks, mock_kc, lease_data):
+        ks_instance = mock_ks.load_from_request.return_value
+        ks_instance.auth_url = "https://kvm.example.com:5000/v3"
+        ks_instance.get_auth_username.return_value = "blazar"
+        ks_instance.get_project.return_value = {"name": "TEST123"}
+        ks_instance.get_user.return_value = {"name": "test_requestor"}
+        mock_kc.return_value.get_user_project_role_scopes.return_value = (
+            "admin",
+            None,
+        )
+        return RequestFactory().post(
+            "/", data=json.dumps(lease_data), content_type="application/json"
+        )
+
+    @patch("django.utils.timezone.now")
+    @patch("balance_service.views.keystone.KeystoneAPI")
+    @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
+    def test_check_create_replays_retries(self, mock_kc, mock_ks, mock_now):
+        mock_now.return_value = self.now
+        self.allocation.su_allocated = 10000
+        self.allocation.save()
+        lease_data = self._lease_data(timezone.timedelta(hours=1))
+        charge_count = Charge.objects.count()
+
+        with patch.object(
+            UsageEnforcer,
+            "check_usage_against_allocation",
+            autospec=True,
+            side_effect=UsageEnforcer.check_usage_against_allocation,
+        ) as mock_check:
+            for _ in range(3):
+                response = views.check_create(
+                    self._enforcement_request(mock_ks, mock_kc, lease_data)
+                )
+                self.assertEqual(response.status_code, 204)
+        mock_check.assert_called_once()
+        self.assertEqual(Charge.objects.count(), charge_count + 1)
+
+        # A different payload for the same lease is evaluated again
+        lease_data["lease"]["end_date"] = (
+            self.now + timezone.timedelta(hours=2)
+        ).strftime("%Y-%m-%d %H:%M:%S")
+        views.check_create(self._enforcement_request(mock_ks, mock_kc, lease_data))
+        self.assertEqual(Charge.objects.count(), charge_count + 2)
+
+    @override_settings(BALANCE_SERVICE_SLOW_REQUEST_SECONDS=0)
+    @patch("django.utils.timezone.now")
+    @patch("balance_service.views.keystone.KeystoneAPI")
+    @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
+    def test_enforcement_views_report_phase_timings(self, mock_kc, mock_ks, mock_now):
+        mock_now.return_value = self.now
+        self.allocation.su_allocated = 10000
+        self.allocation.save()
+        request = self._enforcement_request(
+            mock_ks, mock_kc, self._lease_data(timezone.timedelta(hours=1))
+        )
+
+        with self.assertLogs("balance_service.utils.metrics", "WARNING") as logs:
+            response = views.check_create(request)
+
+        self.assertEqual(response.status_code, 204)
+        phases = [p.split(";")[0] for p in response["Server-Timing"].split(", ")]
+        for phase in ("auth", "evaluate", "balance", "role", "charge_write", "total"):
+            self.assertIn(phase, phases)
+        self.assertIn('"operation": "check-create"', logs.output[0])
+
+        metrics_response = views.metrics_view(RequestFactory().get("/"))
+        self.assertIn(
+            'balance_service_phase_seconds_count{operation="check-create",'
+            'phase="charge_write"}',
+            metrics_response.content.decode(),
+        )
+
+        mock_ks.load_from_request.side_effect = TokenRejectedException(401)
+        with self.assertLogs("balance_service", "ERROR"):
+            metrics_response = views.metrics_view(RequestFactory().get("/"))
+        self.assertEqual(metrics_response.status_code, 403)
+
+    @override_settings(BALANCE_SERVICE_IDEMPOTENCY_WAIT_SECONDS=0)
+    @patch("balance_service.views.keystone.KeystoneAPI")
+    @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
+    def test_on_end_rejects_in_flight_duplicate(self, mock_kc, mock_ks):
+        request = self._enforcement_request(
+            mock_ks, mock_kc, self._lease_data(timezone.timedelta(hours=1))
+        )
+        with patch("balance_service.views.cache.add", return_value=False):
+            response = views.on_end(request)
+        self.assertEqual(response.status_code, 409)
+
+    @patch("balance_service.views.keystone.KeystoneAPI")
+    @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
+    def test_in_flight_lock_outlives_wait_and_is_released(self, mock_kc, mock_ks):
+        request = self._enforcement_request(
+            mock_ks, mock_kc, self._lease_data(timezone.timedelta(hours=1))
+        )
+        with patch(
+            "balance_service.views.cache.add", wraps=views.cache.add
+        ) as cache_add, patch(
+            "balance_service.views.cache.delete", wraps=views.cache.delete
+        ) as cache_delete:
+            views.on_end(request)
+        lock_key = cache_add.call_args.args[0]
+        self.assertEqual(cache_add.call_args.kwargs["timeout"], 600)
+        cache_delete.assert_called_once_with(lock_key)
+        self.assertIsNone(cache.get(lock_key))
+
+    def test_local_cache_backend_is_reported(self):
+        with override_settings(
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+            }
+        ):
+            self.assertEqual(
+                [e.id for e in check_shared_cache(None)], ["balance_service.W001"]
+            )
+        with override_settings(
+            CACHES={
+                "default": {
+                    "BACKEND": "django.core.cache.backends.redis.RedisCache",
+                    "LOCATION": "redis://redis:6379",
+                }
+            }
+        ):
+            self.assertEqual(check_shared_cache(None), [])
+
     @patch("django.utils.timezone.now")
     @patch("balance_service.utils.openstack.keystone.KeystoneAPI")
     @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
@@ -408,6 +643,41 @@ class BalanceServiceTest(TestCase):
         self.assertEqual(len(new_charges), 1)
         self.assertEqual(get_total_sus(new_charges[0]), 30)
 
+    @patch("django.utils.timezone.now")
+    @patch("balance_service.utils.openstack.keystone.KeystoneAPI")
+    @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
+    @patch.object(UsageEnforcer, "_check_lease_duration")
+    @patch.object(UsageEnforcer, "_check_lease_update_window")
+    def test_usage_enforcer_caches_keystone_lookups(
+        self, mock_uw, mock_ld, mock_kc, mock_ks, mock_now
+    ):
+        mock_now.return_value = self.now
+
+        ks_instance = mock_ks.return_value
+        ks_instance.auth_url = "https://kvm.example.com:5000/v3"
+        ks_instance.get_project.return_value = {"name": "TEST123"}
+        ks_instance.get_user.return_value = {"name": "test_requestor"}
+
+        kc_instance = mock_kc.return_value
+        kc_instance.get_user_project_role_scopes.return_value = ("admin", None)
+
+        self.allocation.su_allocated = 10000
+        self.allocation.save()
+
+        # Separate enforcers, as for separate requests, share the lookups
+        UsageEnforcer(ks_instance).check_usage_against_allocation(
+            self._lease_data(timezone.timedelta(hours=1))
+        )
+        UsageEnforcer(ks_instance).check_usage_against_allocation(
+            self._lease_data(timezone.timedelta(hours=2))
+        )
+        ks_instance.get_project.assert_called_once_with(
+            "a0b86a98-b0d3-43cb-948e-00689182efd4"
+        )
+        ks_instance.get_user.assert_called_once_with(
+            "c631173e-dec0-4bb7-a0c3-f7711153c06c"
+        )
+
     @patch("django.utils.timezone.now")
     @patch("balance_service.utils.openstack.keystone.KeystoneAPI")
     @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
@@ -731,6 +1001,49 @@ class BalanceServiceTest(TestCase):
             if c not in self.existing_charges:
                 self.assertEqual(c.end_time, self.now)
 
+    @patch("django.utils.timezone.now")
+    @patch("balance_service.utils.openstack.keystone.KeystoneAPI")
+    @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
+    @patch.object(UsageEnforcer, "_check_lease_duration")
+    @patch.object(UsageEnforcer, "_check_lease_update_window")
+    def test_usage_enforcer_charge_writes_do_not_scale_with_reservations(
+        self, mock_ld, mock_uw, mock_kc, mock_ks, mock_now
+    ):
+        mock_now.return_value = self.now
+
+        ks_instance = mock_ks.return_value
+        ks_instance.get_project.return_value = {"name": "TEST123"}
+        ks_instance.get_user.return_value = {"name": "test_requestor"}
+
+        kc_instance = mock_kc.return_value
+        kc_instance.get_user_project_role_scopes.return_value = ("admin", None)
+
+        self.allocation.su_allocated = 10000
+        self.allocation.save()
+
+        query_counts = []
+        # The first lease also builds the allocation ledger
+        for reservations in (1, 1, 10):
+            lease_data = self._lease_data(
+                timezone.timedelta(hours=5), reservations=reservations
+            )
+            ue = UsageEnforcer(ks_instance)
+            with CaptureQueriesContext(connection) as create_ctx:
+                ue.check_usage_against_allocation(lease_data)
+            with CaptureQueriesContext(connection) as stop_ctx:
+                ue.stop_charging(lease_data)
+            query_counts.append(
+                (len(create_ctx.captured_queries), len(stop_ctx.captured_queries))
+            )
+        self.assertEqual(query_counts[1], query_counts[2])
+
+        for c in Charge.objects.all():
+            if c not in self.existing_charges:
+                self.assertEqual(c.end_time, self.now)
+        self.assertEqual(
+            ledger.allocation_balance(self.allocation), self._recomputed_balance()
+        )
+
     @patch("django.utils.timezone.now")
     @patch("balance_service.utils.openstack.keystone.KeystoneAPI")
     @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
@@ -772,6 +1085,25 @@ class BalanceServiceTest(TestCase):
         # 5 hrs * 3 su_factor * 10/100 vcpus = 1.5
         self.assertAlmostEqual(get_total_sus(new_charges[0]), 1.5)
 
+    @patch("balance_service.utils.openstack.keystone.KeystoneAPI")
+    def test_usage_enforcer_get_reservation_sus_groups_host_types(self, mock_ks):
+        ConfigVariable.objects.create(key="su_factor", flavor_id="f1", value=2)
+        reservation = {
+            "resource_type": "flavor:instance",
+            "resource_properties": json.dumps({"id": "f1"}),
+            "vcpus": 4,
+            "allocations": [{"vcpus": 48}] * 60 + [{"vcpus": 96}] * 40,
+        }
+        ue = UsageEnforcer(mock_ks.return_value)
+
+        with patch.object(
+            ConfigVariable, "get_value", wraps=ConfigVariable.get_value
+        ) as mock_get_value:
+            # 60 * 2 * 4/48 + 40 * 2 * 4/96
+            self.assertAlmostEqual(ue._get_reservation_sus(reservation), 40 / 3)
+            self.assertAlmostEqual(ue._get_reservation_sus(reservation), 40 / 3)
+        mock_get_value.assert_called_once()
+
     @patch("django.utils.timezone.now")
     @patch("balance_service.utils.openstack.keystone.KeystoneAPI")
     @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
@@ -1091,3 +1423,280 @@ class BalanceServiceTest(TestCase):
             charge_code="DIFFERENT",
         )
         self.assertAlmostEqual(result, 1234)
+
+    def test_ConfigVarible_get_value_is_cached_until_changed(self):
+        config = ConfigVariable.objects.create(
+            key="lease_limit",
+            flavor_id="f1",
+            value=10,
+        )
+        self.assertAlmostEqual(ConfigVariable.get_value("lease_limit", "f1"), 10)
+        with self.assertNumQueries(0):
+            for _ in range(100):
+                ConfigVariable.get_value("lease_limit", flavor_id="f1")
+
+        config.value = 20
+        config.save()
+        self.assertAlmostEqual(ConfigVariable.get_value("lease_limit", "f1"), 20)
+        config.delete()
+        self.assertIsNone(ConfigVariable.get_value("lease_limit", "f1"))
+
+    def test_ConfigVarible_get_value_reloads_on_shared_version_change(self):
+        ConfigVariable.objects.create(key="lease_limit", value=10)
+        self.assertAlmostEqual(ConfigVariable.get_value("lease_limit"), 10)
+        # Simulate a change made by another worker
+        ConfigVariable.objects.filter(key="lease_limit").update(value=30)
+        with override_settings(BALANCE_SERVICE_CONFIG_RECHECK_SECONDS=0):
+            self.assertAlmostEqual(ConfigVariable.get_value("lease_limit"), 10)
+            cache.set(CONFIG_VERSION_CACHE_KEY, "changed-elsewhere")
+            self.assertAlmostEqual(ConfigVariable.get_value("lease_limit"), 30)
+
+    def _recomputed_balance(self):
+        charges = self.allocation.charges.all()
+        return (
+            sum(get_used_sus(c) for c in charges),
+            sum(get_total_sus(c) for c in charges),
+        )
+
+    @patch("django.utils.timezone.now")
+    @patch("balance_service.utils.openstack.keystone.KeystoneAPI")
+    @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
+    @patch.object(UsageEnforcer, "_check_lease_duration")
+    @patch.object(UsageEnforcer, "_check_lease_update_window")
+    def test_ledger_tracks_enforcement_charges(
+        self, mock_ld, mock_uw, mock_kc, mock_ks, mock_now
+    ):
+        mock_now.return_value = self.now
+        ledger.rebuild(self.allocation)
+
+        ks_instance = mock_ks.return_value
+        ks_instance.get_project.return_value = {"name": "TEST123"}
+        ks_instance.get_user.return_value = {"name": "test_requestor"}
+
+        kc_instance = mock_kc.return_value
+        kc_instance.get_user_project_role_scopes.return_value = ("admin", None)
+
+        self.allocation.su_allocated = 10000
+        self.allocation.save()
+
+        ue = UsageEnforcer(ks_instance)
+        lease_data = self._lease_data(timezone.timedelta(hours=5), reservations=3)
+        ue.check_usage_against_allocation(lease_data)
+
+        mock_now.return_value = self.now + timezone.timedelta(hours=4)
+        used, total = ledger.allocation_balance(self.allocation)
+        expected_used, expected_total = self._recomputed_balance()
+        self.assertAlmostEqual(used, expected_used, places=2)
+        self.assertAlmostEqual(total, expected_total, places=2)
+
+        ue.stop_charging(lease_data)
+        used, total = ledger.allocation_balance(self.allocation)
+        expected_used, expected_total = self._recomputed_balance()
+        self.assertAlmostEqual(used, expected_used, places=2)
+        self.assertAlmostEqual(total, expected_total, places=2)
+        self.assertEqual(
+            AllocationLedger.objects.get(allocation=self.allocation).settled_until,
+            mock_now.return_value,
+        )
+
+    @patch("django.utils.timezone.now")
+    @patch("balance_service.utils.openstack.keystone.KeystoneAPI")
+    @patch("balance_service.enforcement.usage_enforcement.KeycloakClient")
+    @patch.object(UsageEnforcer, "_check_lease_duration")
+    @patch.object(UsageEnforcer, "_check_lease_update_window")
+    def test_user_ledger_tracks_member_budget(
+        self, mock_ld, mock_uw, mock_kc, mock_ks, mock_now
+    ):
+        mock_now.return_value = self.now
+
+        ks_instance = mock_ks.return_value
+        ks_instance.get_project.return_value = {"name": "TEST123"}
+        ks_instance.get_user.return_value = {"name": "test_requestor"}
+
+        kc_instance = mock_kc.return_value
+        kc_instance.get_user_project_role_scopes.return_value = ("member", None)
+
+        self.allocation.su_allocated = 10000
+        self.allocation.save()
+        ChargeBudget.objects.create(
+            user=self.test_requestor, project=self.project, su_budget=100
+        )
+
+        def user_total():
+            return sum(
+                get_total_sus(c)
+                for c in self.allocation.charges.filter(user=self.test_requestor)
+            )
+
+        ue = UsageEnforcer(ks_instance)
+        # 30 SUs each, with 21 SUs already used
+        lease_data = self._lease_data(timezone.timedelta(hours=5))
+        ue.check_usage_against_allocation(lease_data)
+        self.assertAlmostEqual(
+            ledger.user_committed_sus(self.allocation, self.test_requestor),
+            user_total(),
+        )
+
+        mock_now.return_value = self.now + timezone.timedelta(hours=1)
+        ue.stop_charging(lease_data)
+        self.assertAlmostEqual(
+            ledger.user_committed_sus(self.allocation, self.test_requestor),
+            user_total(),
+        )
+
+        ue = UsageEnforcer(ks_instance)
+        ue.check_usage_against_allocation(
+            self._lease_data(timezone.timedelta(hours=10))
+        )
+        with self.assertRaisesRegex(exceptions.BillingError, "left in user budget"):
+            UsageEnforcer(ks_instance).check_usage_against_allocation(
+                self._lease_data(timezone.timedelta(hours=5))
+            )
+
+    def test_user_committed_sus_only_writes_when_locking(self):
+        expected = sum(
+            get_total_sus(c)
+            for c in self.allocation.charges.filter(user=self.test_requestor)
+        )
+        with self.assertNumQueries(3):
+            self.assertAlmostEqual(
+                ledger.user_committed_sus(self.allocation, self.test_requestor),
+                expected,
+            )
+        self.assertFalse(AllocationUserLedger.objects.exists())
+
+        self.assertAlmostEqual(
+            ledger.user_committed_sus(self.allocation, self.test_requestor, lock=True),
+            expected,
+        )
+        self.assertEqual(AllocationUserLedger.objects.count(), 1)
+
+    @patch("django.utils.timezone.now")
+    def test_balance_without_ledger_does_not_write(self, mock_now):
+        mock_now.return_value = self.now
+        ArchivedCharge.objects.create(
+            allocation=self.allocation,
+            user=self.test_requestor,
+            region_name="RegionOne",
+            resource_id="archived",
+            resource_type="physical:host",
+            start_time=self.now - timezone.timedelta(days=2),
+            end_time=self.now - timezone.timedelta(days=1),
+            hourly_cost=1.0,
+            updated_at=self.now,
+        )
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            used, total = ledger.allocation_balance(self.allocation)
+
+        self.assertFalse(AllocationLedger.objects.exists())
+        self.assertEqual(len(callbacks), 1)
+        ledger.rebuild(self.allocation)
+        self.assertEqual(ledger.allocation_balance(self.allocation), (used, total))
+        self.assertAlmostEqual(total, 41.0 + 24.0, places=2)
+
+    @patch("django.utils.timezone.now")
+    def test_reconcile_ledgers_reports_and_fixes_drift(self, mock_now):
+        mock_now.return_value = self.now
+        ledger.rebuild(self.allocation)
+        AllocationLedger.objects.filter(allocation=self.allocation).update(
+            committed_sus=1000
+        )
+
+        out = io.StringIO()
+        call_command("reconcile_ledgers", "--dry-run", stdout=out)
+        self.assertIn(
+            f"Allocation {self.allocation.id}: committed drift", out.getvalue()
+        )
+        self.assertEqual(
+            AllocationLedger.objects.get(allocation=self.allocation).committed_sus, 1000
+        )
+
+        call_command("reconcile_ledgers", stdout=io.StringIO())
+        self.assertAlmostEqual(
+            AllocationLedger.objects.get(allocation=self.allocation).committed_sus,
+            41.0,
+            places=2,
+        )
+
+
+class BenchmarkEnforcementTest(TestCase):
+    def test_benchmark_enforcement_runs_against_fake_services(self):
+        out = io.StringIO()
+        call_command(
+            "benchmark_enforcement",
+            requests=2,
+            history=10,
+            latency_ms=0,
+            reservations=2,
+            flavor_allocations=5,
+            stdout=out,
+        )
+        rows = out.getvalue().splitlines()[1:]
+        self.assertEqual(
+            [row.split()[0] for row in rows],
+            ["create", "create-flavor", "update", "on-end"],
+        )
+        # No request failed
+        self.assertEqual([row.split()[-1] for row in rows], ["0"] * 4)
+
+
+@override_settings(
+    OPENSTACK_AUTH_REGIONS={"RegionOne": "https://api.example.com:5000/v3"},
+    ALLOWED_OPENSTACK_SERVICE_USERS=["blazar"],
+)
+class KeystoneTokenCacheTest(TestCase):
+    auth_url = "https://api.example.com:5000/v3"
+
+    def setUp(self):
+        cache.clear()
+
+    def _token_response(self, status_code=201, user_name="blazar"):
+        response = MagicMock(status_code=status_code)
+        response.json.return_value = {
+            "token": {
+                "user": {"name": user_name},
+                "expires_at": (timezone.now() + timedelta(hours=1)).isoformat(),
+            }
+        }
+        return response
+
+    @patch("balance_service.utils.openstack.keystone._get_session")
+    def test_validation_is_cached(self, mock_session):
+        mock_post = mock_session.return_value.post
+        mock_post.return_value = self._token_response()
+
+        for _ in range(3):
+            api = keystone.KeystoneAPI("token", self.auth_url)
+            self.assertEqual(api.get_auth_username(), "blazar")
+        self.assertEqual(mock_post.call_count, 1)
+
+        keystone.purge_token_cache()
+        keystone.KeystoneAPI("token", self.auth_url).get_auth_username()
+        self.assertEqual(mock_post.call_count, 2)
+
+    @patch("balance_service.utils.openstack.keystone._get_session")
+    def test_expired_token_is_not_cached(self, mock_session):
+        mock_post = mock_session.return_value.post
+        response = self._token_response()
+        response.json.return_value["token"]["expires_at"] = timezone.now().isoformat()
+        mock_post.return_value = response
+
+        for _ in range(2):
+            keystone.KeystoneAPI("token", self.auth_url).get_auth_username()
+        self.assertEqual(mock_post.call_count, 2)
+
+    @patch("balance_service.utils.openstack.keystone._get_session")
+    def test_rejections_are_cached(self, mock_session):
+        mock_post = mock_session.return_value.post
+        mock_post.return_value = self._token_response(status_code=401)
+        for _ in range(2):
+            with self.assertRaises(TokenRejectedException):
+                keystone.KeystoneAPI("bad", self.auth_url).get_auth_username()
+
+        mock_post.return_value = self._token_response(user_name="someone")
+        for _ in range(2):
+            with self.assertRaises(AuthUserException):
+                keystone.KeystoneAPI("other", self.auth_url).get_auth_username()
+
+        self.assertEqual(mock_post.call_count, 2)
@@ -12,4 +12,6 @@ urlpatterns = [
     path("v2/check-create/", views.check_create, name="check_create"),
     path("v2/check-update/", views.check_update, name="check_update"),
     path("v2/on-end/", views.on_end, name="on_end"),
+    path("v2/quote/", views.quote, name="quote"),
+    path("v2/metrics/", views.metrics_view, name="metrics"),
 ]
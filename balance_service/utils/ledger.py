@@ -0,0 +1,271 @@
+"""Incrementally maintained SU counters for allocations.
+
+Every write of a ``Charge`` is mirrored into the allocation's
+``AllocationLedger`` through :func:`record`, inside the same transaction.
+Reading a balance then costs O(open charges): charges that ended before the
+ledger checkpoint are already summed up in ``settled_sus``.
+
+Each user's share of ``committed_sus`` is kept in ``AllocationUserLedger``,
+so user budgets can be checked by locking a single row.
+
+Reading an allocation without a ledger computes its balance from its charges,
+without writing, and queues a task to build the ledger. ``manage.py
+reconcile_ledgers`` can be used to rebuild ledgers and report drift if charges
+were written some other way.
+"""
+
+import collections
+import itertools
+import logging
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from allocations.models import (
+    Allocation,
+    AllocationLedger,
+    AllocationUserLedger,
+    ArchivedCharge,
+    Charge,
+)
+
+LOG = logging.getLogger(__name__)
+
+ChargeState = collections.namedtuple(
+    "ChargeState",
+    ["allocation_id", "user_id", "start_time", "end_time", "hourly_cost"],
+)
+
+_STATE_FIELDS = ChargeState._fields
+
+
+def charge_state(charge):
+    """Snapshot the fields of a charge that contribute to its SU cost."""
+    return ChargeState(*(getattr(charge, f) for f in _STATE_FIELDS))
+
+
+def charge_states(queryset):
+    return (ChargeState._make(row) for row in queryset.values_list(*_STATE_FIELDS))
+
+
+def total_sus(state):
+    """Same as ``su_calculators.get_total_sus``, for a ``ChargeState``."""
+    if state.end_time is None:
+        return 0.0
+    time_diff = (state.end_time - state.start_time).total_seconds()
+    return max(round(time_diff / 3600.0 * state.hourly_cost, 2), 0.0)
+
+
+def used_sus(state, now):
+    """Same as ``su_calculators.get_used_sus``, for a ``ChargeState``."""
+    if state.start_time > now:
+        return 0.0
+    end_time = state.end_time
+    if not end_time or end_time > now:
+        end_time = now
+    time_diff = (end_time - state.start_time).total_seconds()
+    if time_diff < 0:
+        return 0.0
+    return round(time_diff / 3600.0 * state.hourly_cost, 2)
+
+
+def _is_settled(state, settled_until):
+    return state.end_time is not None and state.end_time <= settled_until
+
+
+def _open_charges(allocation_id, settled_until):
+    return Charge.objects.filter(allocation_id=allocation_id).filter(
+        Q(end_time__gt=settled_until) | Q(end_time__isnull=True)
+    )
+
+
+def _all_charge_states(**filters):
+    # Charges of long inactive allocations may have been archived
+    return itertools.chain(
+        charge_states(Charge.objects.filter(**filters)),
+        charge_states(ArchivedCharge.objects.filter(**filters)),
+    )
+
+
+def _compute(allocation_id, settled_until):
+    committed = 0.0
+    settled = 0.0
+    by_user = collections.defaultdict(float)
+    for state in _all_charge_states(allocation_id=allocation_id):
+        total = total_sus(state)
+        committed += total
+        by_user[state.user_id] += total
+        if _is_settled(state, settled_until):
+            settled += total
+    return committed, settled, by_user
+
+
+def compute_counters(allocation_id, settled_until):
+    """Recompute ``(committed_sus, settled_sus)`` from every charge."""
+    committed, settled, _ = _compute(allocation_id, settled_until)
+    return committed, settled
+
+
+def compute_user_counters(allocation_id):
+    """Recompute the ``committed_sus`` of each user from every charge."""
+    return _compute(allocation_id, timezone.now())[2]
+
+
+def rebuild(allocation, now=None):
+    """Rebuild the ledgers of an allocation from its charges.
+
+    The allocation row stays locked until the end of the transaction, so that
+    concurrent rebuilds of the same allocation run one after the other. Its
+    ledger rows are locked too before charges are read, in the order charge
+    writers lock them, so that no charge written meanwhile is lost.
+    """
+    now = now or timezone.now()
+    with transaction.atomic(savepoint=False):
+        for rows in (
+            Allocation.objects.filter(pk=allocation.id),
+            AllocationUserLedger.objects.filter(allocation_id=allocation.id),
+            AllocationLedger.objects.filter(allocation_id=allocation.id),
+        ):
+            list(rows.select_for_update().values_list("pk"))
+        committed, settled, by_user = _compute(allocation.id, now)
+        ledger, _ = AllocationLedger.objects.update_or_create(
+            allocation_id=allocation.id,
+            defaults={
+                "committed_sus": committed,
+                "settled_sus": settled,
+                "settled_until": now,
+            },
+        )
+        AllocationUserLedger.objects.filter(allocation_id=allocation.id).delete()
+        AllocationUserLedger.objects.bulk_create(
+            AllocationUserLedger(
+                allocation_id=allocation.id, user_id=user_id, committed_sus=total
+            )
+            for user_id, total in by_user.items()
+        )
+    return ledger
+
+
+def record(removed=(), added=()):
+    """Apply charge writes to the ledgers of the allocations involved.
+
+    Args:
+        removed (list[ChargeState]): charges as they were before the write.
+        added (list[ChargeState]): charges as they are after the write.
+
+    A created charge is only ``added``, a deleted charge is only ``removed``
+    and an updated charge appears in both. Allocations and users without a
+    ledger are skipped, as theirs will be built from their charges.
+    """
+    changes = collections.defaultdict(list)
+    user_changes = collections.defaultdict(float)
+    for sign, states in ((-1, removed), (1, added)):
+        for state in states:
+            changes[state.allocation_id].append((sign, state))
+            user_changes[(state.allocation_id, state.user_id)] += sign * total_sus(
+                state
+            )
+    if not changes:
+        return
+
+    with transaction.atomic(savepoint=False):
+        for ledger in AllocationLedger.objects.select_for_update().filter(
+            allocation_id__in=changes.keys()
+        ):
+            for sign, state in changes[ledger.allocation_id]:
+                total = total_sus(state)
+                ledger.committed_sus += sign * total
+                if _is_settled(state, ledger.settled_until):
+                    ledger.settled_sus += sign * total
+            ledger.save(update_fields=["committed_sus", "settled_sus", "updated_at"])
+
+        for user_ledger in AllocationUserLedger.objects.select_for_update().filter(
+            allocation_id__in=changes.keys(),
+            user_id__in={user_id for _, user_id in user_changes},
+        ):
+            delta = user_changes.get((user_ledger.allocation_id, user_ledger.user_id))
+            if delta:
+                user_ledger.committed_sus += delta
+                user_ledger.save(update_fields=["committed_sus", "updated_at"])
+
+
+def _settle(ledger, now):
+    """Move charges that ended since the checkpoint into ``settled_sus``."""
+    with transaction.atomic(savepoint=False):
+        ledger = AllocationLedger.objects.select_for_update().get(pk=ledger.pk)
+        if ledger.settled_until >= now:
+            return
+        ended = _open_charges(ledger.allocation_id, ledger.settled_until).filter(
+            end_time__lte=now
+        )
+        ledger.settled_sus += sum(
+            total_sus(state) for state in charge_states(ended.select_for_update())
+        )
+        ledger.settled_until = now
+        ledger.save(update_fields=["settled_sus", "settled_until", "updated_at"])
+
+
+def _schedule_rebuild(allocation_id):
+    from allocations import tasks
+
+    transaction.on_commit(
+        lambda: tasks.rebuild_allocation_ledger.apply_async(args=(allocation_id,))
+    )
+
+
+def allocation_balance(allocation):
+    """Return the ``(used, total)`` SUs of an allocation.
+
+    Only the charges still open after the ledger checkpoint are loaded.
+    """
+    now = timezone.now()
+    ledger = AllocationLedger.objects.filter(allocation_id=allocation.id).first()
+    if ledger is None or ledger.settled_until > now:
+        # No ledger yet, or the clock is behind the checkpoint, in which case
+        # some settled charges would not have been fully used yet.
+        _schedule_rebuild(allocation.id)
+        states = list(_all_charge_states(allocation_id=allocation.id))
+        return (
+            sum(used_sus(s, now) for s in states),
+            sum(total_sus(s) for s in states),
+        )
+
+    open_states = list(
+        charge_states(_open_charges(allocation.id, ledger.settled_until))
+    )
+    used = ledger.settled_sus + sum(used_sus(s, now) for s in open_states)
+    if any(_is_settled(s, now) for s in open_states):
+        _settle(ledger, now)
+
+    return used, ledger.committed_sus
+
+
+def user_committed_sus(allocation, user, lock=False):
+    """Return the total SU cost of a user's charges on an allocation.
+
+    With ``lock``, the user's ledger row is created if missing and stays
+    locked until the end of the transaction, so that concurrent budget checks
+    for the same user are serialized. Without it, nothing is written.
+    """
+    user_ledgers = AllocationUserLedger.objects.filter(
+        allocation_id=allocation.id, user_id=user.id
+    )
+    if lock:
+        user_ledgers = user_ledgers.select_for_update()
+    user_ledger = user_ledgers.first()
+    if user_ledger is not None:
+        return user_ledger.committed_sus
+
+    total = sum(
+        total_sus(state)
+        for state in _all_charge_states(allocation_id=allocation.id, user_id=user.id)
+    )
+    if not lock:
+        return total
+    AllocationUserLedger.objects.get_or_create(
+        allocation_id=allocation.id,
+        user_id=user.id,
+        defaults={"committed_sus": total},
+    )
+    return user_ledgers.get().committed_sus
@@ -0,0 +1,179 @@
+"""Per-phase timing of balance service requests.
+
+A :class:`PhaseTimer` is made current for the duration of a request by
+:func:`request_timer`; code anywhere below it times its phases with
+:func:`timed`, which does nothing outside of a request. When the request ends,
+phase durations are sent to the metrics sink configured by
+``BALANCE_SERVICE_METRICS_SINK``:
+
+- :class:`PrometheusSink` keeps histograms in process memory, rendered by the
+  ``v2/metrics/`` view, which takes a Keystone token like the other views.
+  Each worker process only reports its own requests.
+- :class:`StatsdSink` sends each duration as a statsd timer over UDP.
+"""
+
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+LOG = logging.getLogger(__name__)
+
+PHASE_METRIC = "balance_service_phase_seconds"
+REQUEST_METRIC = "balance_service_request_seconds"
+
+_current_timer = contextvars.ContextVar("balance_service_timer", default=None)
+
+
+class PhaseTimer:
+    """Accumulates the time spent in each named phase of a request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Format the phases as a ``Server-Timing`` header value"""
+        entries = [
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases.items()
+        ]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Time a phase of the current request, if any"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
+
+
+@contextlib.contextmanager
+def request_timer(operation):
+    """Make a new timer current, and report its phases when done"""
+    timer = PhaseTimer()
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+        total = timer.elapsed()
+        sink = get_sink()
+        for name, seconds in timer.phases.items():
+            sink.observe(PHASE_METRIC, seconds, operation=operation, phase=name)
+        sink.observe(REQUEST_METRIC, total, operation=operation)
+        if total >= settings.BALANCE_SERVICE_SLOW_REQUEST_SECONDS:
+            record = {
+                "operation": operation,
+                "duration": round(total, 3),
+                "phases": {k: round(v, 3) for k, v in timer.phases.items()},
+            }
+            LOG.warning(f"Slow balance service request: {json.dumps(record)}")
+
+
+class NullSink:
+    def observe(self, metric, seconds, **labels):
+        pass
+
+
+class PrometheusSink:
+    """Cumulative histograms, in the Prometheus text exposition format."""
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (metric, sorted labels) -> [bucket counts..., count, sum]
+        self._series = {}
+
+    def observe(self, metric, seconds, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def render(self):
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+        lines = []
+        declared = set()
+        for (metric, labels), values in series:
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+            sep = "," if label_str else ""
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{metric}_bucket{{{label_str}{sep}le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{{label_str}{sep}le="+Inf"}} {values[-2]}')
+            lines.append(f"{metric}_count{{{label_str}}} {values[-2]}")
+            lines.append(f"{metric}_sum{{{label_str}}} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+class StatsdSink:
+    """Sends durations as statsd timers, e.g. ``<prefix>.phase_seconds.on-end.auth``"""
+
+    def __init__(self):
+        self.address = (
+            settings.BALANCE_SERVICE_STATSD_HOST,
+            settings.BALANCE_SERVICE_STATSD_PORT,
+        )
+        self.prefix = settings.BALANCE_SERVICE_STATSD_PREFIX
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def observe(self, metric, seconds, **labels):
+        name = ".".join(
+            [self.prefix, metric.replace(f"{self.prefix}_", "")]
+            + [str(labels[k]) for k in sorted(labels)]
+        )
+        try:
+            self._socket.sendto(
+                f"{name}:{seconds * 1000:.3f}|ms".encode(), self.address
+            )
+        except OSError:
+            LOG.debug(f"Could not send {name} to statsd")
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                path = settings.BALANCE_SERVICE_METRICS_SINK
+                _sink = import_string(path)() if path else NullSink()
+    return _sink
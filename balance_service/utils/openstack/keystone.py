@@ -1,13 +1,78 @@
+import hashlib
 import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from balance_service import exceptions
 
 LOG = logging.getLogger(__name__)
 
+TOKEN_CACHE_PREFIX = "balance_service:keystone_token"
+TOKEN_CACHE_GENERATION_KEY = f"{TOKEN_CACHE_PREFIX}:generation"
+# Stop trusting a cached token this long before Keystone expires it
+TOKEN_EXPIRY_MARGIN_SECONDS = 30
+
+
+# Connections kept alive per Keystone host, and concurrent lookups allowed
+KEYSTONE_POOL_SIZE = 16
+KEYSTONE_MAX_CONCURRENCY = 8
+
+_session = None
+_session_lock = threading.Lock()
+_executor = ThreadPoolExecutor(
+    max_workers=KEYSTONE_MAX_CONCURRENCY, thread_name_prefix="keystone"
+)
+
+
+def _get_session():
+    """Return the process-wide HTTP session used to talk to Keystone."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=KEYSTONE_POOL_SIZE,
+                    pool_maxsize=KEYSTONE_POOL_SIZE,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def fetch_concurrently(*calls):
+    """Run zero-argument callables on the shared pool, returning their results
+    in order. Only use this for HTTP calls; the ORM must stay on the request
+    thread.
+    """
+    futures = [_executor.submit(call) for call in calls]
+    return [future.result() for future in futures]
+
+
+def _token_cache_key(token, auth_url):
+    # Bumping the generation invalidates every cached validation at once
+    generation = cache.get_or_set(TOKEN_CACHE_GENERATION_KEY, 0, timeout=None)
+    digest = hashlib.sha256(f"{auth_url}\n{token}".encode()).hexdigest()
+    return f"{TOKEN_CACHE_PREFIX}:{generation}:{digest}"
+
+
+def purge_token_cache():
+    """Invalidate all cached token validations."""
+    try:
+        cache.incr(TOKEN_CACHE_GENERATION_KEY)
+    except ValueError:
+        cache.set(TOKEN_CACHE_GENERATION_KEY, 1, timeout=None)
+
 
 class KeystoneAPI:
     def __init__(self, token, auth_url):
@@ -20,8 +85,12 @@ class KeystoneAPI:
     def load_from_request(cls, request):
         keystone_auth_token = request.headers.get("X-Auth-Token")
         if request.method == "POST":
-            context = json.loads(request.body).get("context", {})
-            auth_url = context.get("auth_url")
+            # Batch requests may stream their body, so they pass the auth URL
+            # as a header like GET requests do
+            auth_url = request.headers.get("X-Auth-URL")
+            if not auth_url:
+                context = json.loads(request.body).get("context", {})
+                auth_url = context.get("auth_url")
         elif request.method == "GET":
             auth_url = request.headers.get("X-Auth-URL")
         else:
@@ -44,36 +113,72 @@ class KeystoneAPI:
         return auth_url
 
     def get_auth_username(self):
+        """Validate the token and return the name of the service user.
+
+        Validations are cached per token and auth URL until shortly before the
+        token expires. Rejected tokens are cached for a short period as well.
+        """
         if not self.token:
             raise exceptions.MissingAuthInformation()
 
+        cache_key = _token_cache_key(self.token, self.auth_url)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if cached.get("rejected_user"):
+                raise exceptions.AuthUserException(cached["rejected_user"])
+            if cached.get("rejected_status"):
+                raise exceptions.TokenRejectedException(cached["rejected_status"])
+            return cached["user_name"]
+
+        negative_ttl = settings.BALANCE_SERVICE_TOKEN_NEGATIVE_CACHE_TTL_SECONDS
+        try:
+            user_name, expires_at = self._validate_token()
+        except exceptions.AuthUserException as e:
+            cache.set(cache_key, {"rejected_user": e.user}, negative_ttl)
+            raise
+        except exceptions.TokenRejectedException as e:
+            cache.set(cache_key, {"rejected_status": e.status_code}, negative_ttl)
+            raise
+
+        ttl = settings.BALANCE_SERVICE_TOKEN_CACHE_TTL_SECONDS
+        if expires_at:
+            remaining = (expires_at - timezone.now()).total_seconds()
+            ttl = min(ttl, remaining - TOKEN_EXPIRY_MARGIN_SECONDS)
+        if ttl > 0:
+            cache.set(cache_key, {"user_name": user_name}, ttl)
+        return user_name
+
+    def _validate_token(self):
         auth_users = settings.ALLOWED_OPENSTACK_SERVICE_USERS
         url = "{}/auth/tokens".format(self.auth_url)
         data = {
             "auth": {"identity": {"methods": ["token"], "token": {"id": self.token}}}
         }
 
-        resp = requests.post(url, headers=self.headers, json=data)
+        resp = _get_session().post(url, headers=self.headers, json=data)
 
         if resp.status_code in [200, 201]:
-            user_name = resp.json()["token"]["user"]["name"]
+            token = resp.json()["token"]
+            user_name = token["user"]["name"]
             if user_name not in auth_users:
                 raise exceptions.AuthUserException(user_name)
 
-            return user_name
+            return user_name, parse_datetime(token.get("expires_at") or "")
+        elif resp.status_code in [401, 403, 404]:
+            raise exceptions.TokenRejectedException(resp.status_code)
         else:
             resp.raise_for_status()
 
     def get_project(self, project_id):
         url = "{}/projects/{}".format(self.auth_url, project_id)
-        res = requests.get(url, headers=self.headers)
+        res = _get_session().get(url, headers=self.headers)
         res_json = res.json()
         LOG.debug(f"Fetched project from Keystone: {res_json}")
         return res_json.get("project")
 
     def get_user(self, user_id):
         url = "{}/users/{}".format(self.auth_url, user_id)
-        res = requests.get(url, headers=self.headers)
+        res = _get_session().get(url, headers=self.headers)
         res_json = res.json()
         LOG.debug(f"Fetched user from Keystone: {res_json}")
         return res_json.get("user")
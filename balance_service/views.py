@@ -1,7 +1,12 @@
 import functools
+import hashlib
 import logging
 import json
+import time
+import uuid
 
+from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
 from django.http import (
     HttpResponseBadRequest,
@@ -14,10 +19,12 @@ from django.http import (
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 
+from projects.models import Project
+
 from .enforcement import exceptions as ue_exceptions
 from .enforcement import usage_enforcement
 from .utils.openstack import keystone
-from .utils import su_calculators
+from .utils import metrics, su_calculators
 from . import exceptions
 
 logger = logging.getLogger("balance_service")
@@ -29,9 +36,14 @@ def authenticate(func):
     def auth_f(*args, **kwargs):
         request = args[0]
         try:
-            keystone_api = keystone.KeystoneAPI.load_from_request(request)
-            user_name = keystone_api.get_auth_username()
-        except (exceptions.AuthURLException, exceptions.AuthUserException) as e:
+            with metrics.timed("auth"):
+                keystone_api = keystone.KeystoneAPI.load_from_request(request)
+                user_name = keystone_api.get_auth_username()
+        except (
+            exceptions.AuthURLException,
+            exceptions.AuthUserException,
+            exceptions.TokenRejectedException,
+        ) as e:
             logger.exception(e)
             return HttpResponseForbidden()
         except Exception as ex:
@@ -45,17 +57,47 @@ def authenticate(func):
     return auth_f
 
 
-@require_http_methods(["GET"])
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def _project_id(value):
+    if isinstance(value, dict):
+        value = value["id"]
+    return int(value)
+
+
+def _parse_batch_project_ids(request):
+    """Read the project ids of a batch balance request.
+
+    GET requests pass a comma-separated ``projects`` query parameter. POST
+    requests either send a JSON body ``{"projects": [...]}`` or stream one
+    project per line as NDJSON, where each project is an id or ``{"id": ...}``.
+    """
+    if request.method == "GET":
+        projects = request.GET.get("projects")
+        # Assume comma-separated
+        return [int(pid) for pid in projects.split(",")] if projects else []
+
+    if request.content_type == NDJSON_CONTENT_TYPE:
+        # Read line by line rather than loading the whole body
+        return [_project_id(json.loads(line)) for line in request if line.strip()]
+
+    return [_project_id(p) for p in json.loads(request.body).get("projects", [])]
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
 @authenticate
 def batch_get_project_allocations(keystone_api, request):
-    projects = request.GET["projects"]
+    try:
+        projects = _parse_batch_project_ids(request)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return HttpResponseBadRequest("Invalid project list")
     if not projects:
         return HttpResponseBadRequest("No projects specified")
-    # Assume comma-separated
-    projects = [int(pid) for pid in projects.split(",")]
 
     return HttpResponse(
-        json.dumps({"projects": su_calculators.project_balances(projects)}),
+        json.dumps({"projects": su_calculators.batch_project_balances(projects)}),
         content_type="application/json",
     )
 
@@ -106,7 +148,8 @@ def _process(enforcer, request, fun_v2):
     data = json.loads(request.body)
 
     check = None
-    balance_service_version = int(enforcer.get_balance_service_version(data))
+    with metrics.timed("version"):
+        balance_service_version = int(enforcer.get_balance_service_version(data))
     if balance_service_version == 1:
         raise ValueError("Balance service version 1 is not supported")
 
@@ -123,9 +166,116 @@ def _process(enforcer, request, fun_v2):
     return make_enforcement_response(check)
 
 
+def instrumented(operation):
+    """Time the phases of an enforcement request.
+
+    Phase durations are reported to the metrics sink and returned in a
+    ``Server-Timing`` header, see :mod:`balance_service.utils.metrics`.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def instrumented_f(*args, **kwargs):
+            with metrics.request_timer(operation) as timer:
+                response = func(*args, **kwargs)
+                response["Server-Timing"] = timer.server_timing()
+            return response
+
+        return instrumented_f
+
+    return decorator
+
+
+IDEMPOTENCY_CACHE_PREFIX = "balance_service:idempotency"
+IDEMPOTENCY_POLL_SECONDS = 0.1
+
+
+def idempotent(operation):
+    """Replay the response of a repeated enforcement callback.
+
+    Blazar retries callbacks that time out, which would otherwise evaluate the
+    lease again and, for creates, charge it twice. Requests are keyed on the
+    operation, lease id and a hash of the payload. While a request is being
+    processed, repeats wait for its response, up to
+    ``BALANCE_SERVICE_IDEMPOTENCY_WAIT_SECONDS``. Successful and rejected
+    responses are then replayed for ``BALANCE_SERVICE_IDEMPOTENCY_TTL_SECONDS``;
+    server errors are not, so they can be retried.
+
+    The in-flight lock is released when the request finishes, and otherwise
+    expires after ``BALANCE_SERVICE_IDEMPOTENCY_LOCK_SECONDS``, which must be
+    longer than any request. Retries reaching other workers are only caught
+    with a cache shared by the workers.
+
+    Must wrap the transaction, so responses are only stored once committed.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def idempotent_f(keystone_api, request, *args, **kwargs):
+            try:
+                lease_id = json.loads(request.body)["lease"].get("id")
+            except (ValueError, KeyError, TypeError, AttributeError):
+                return func(keystone_api, request, *args, **kwargs)
+            digest = hashlib.sha256(
+                keystone_api.auth_url.encode() + b"\n" + request.body
+            ).hexdigest()
+            key = f"{IDEMPOTENCY_CACHE_PREFIX}:{operation}:{lease_id}:{digest}"
+            lock_key = f"{key}:lock"
+
+            lock_token = uuid.uuid4().hex
+            deadline = (
+                time.monotonic() + settings.BALANCE_SERVICE_IDEMPOTENCY_WAIT_SECONDS
+            )
+            while True:
+                stored = cache.get(key)
+                if stored is not None:
+                    logger.info(f"Replaying {operation} response for lease {lease_id}")
+                    status, content, content_type = stored
+                    return HttpResponse(
+                        content, content_type=content_type, status=status
+                    )
+                if cache.add(
+                    lock_key,
+                    lock_token,
+                    timeout=settings.BALANCE_SERVICE_IDEMPOTENCY_LOCK_SECONDS,
+                ):
+                    break
+                if time.monotonic() >= deadline:
+                    return HttpResponse(
+                        json.dumps({"message": "Request is already being processed"}),
+                        content_type="application/json",
+                        status=409,
+                    )
+                time.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+            try:
+                response = func(keystone_api, request, *args, **kwargs)
+                if response.status_code < 500:
+                    cache.set(
+                        key,
+                        (
+                            response.status_code,
+                            response.content,
+                            response["Content-Type"],
+                        ),
+                        settings.BALANCE_SERVICE_IDEMPOTENCY_TTL_SECONDS,
+                    )
+                return response
+            finally:
+                # Not a lock taken by a retry after ours expired
+                if cache.get(lock_key) == lock_token:
+                    cache.delete(lock_key)
+
+        return idempotent_f
+
+    return decorator
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
+@instrumented("check-create")
 @authenticate
+@idempotent("check-create")
 @transaction.atomic
 def check_create(keystone_api, request):
     enforcer = usage_enforcement.UsageEnforcer(keystone_api)
@@ -138,7 +288,9 @@ def check_create(keystone_api, request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@instrumented("check-update")
 @authenticate
+@idempotent("check-update")
 @transaction.atomic
 def check_update(keystone_api, request):
     enforcer = usage_enforcement.UsageEnforcer(keystone_api)
@@ -151,7 +303,9 @@ def check_update(keystone_api, request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@instrumented("on-end")
 @authenticate
+@idempotent("on-end")
 @transaction.atomic
 def on_end(keystone_api, request):
     enforcer = usage_enforcement.UsageEnforcer(keystone_api)
@@ -160,3 +314,32 @@ def on_end(keystone_api, request):
         request,
         enforcer.stop_charging,
     )
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@instrumented("quote")
+@authenticate
+def quote(keystone_api, request):
+    """Price a lease and report which checks would fail, without charging"""
+    enforcer = usage_enforcement.UsageEnforcer(keystone_api)
+    try:
+        data = json.loads(request.body)
+        return JsonResponse(enforcer.quote(data))
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest("Invalid lease")
+    except Project.DoesNotExist:
+        return HttpResponseNotFound("Project not found")
+    except ue_exceptions.EnforcementException as e:
+        logger.exception(e)
+        return make_enforcement_response(e)
+
+
+@require_http_methods(["GET"])
+@authenticate
+def metrics_view(keystone_api, request):
+    """Expose request timings when using the in-process Prometheus sink"""
+    sink = metrics.get_sink()
+    if not isinstance(sink, metrics.PrometheusSink):
+        return HttpResponseNotFound("Metrics are not collected in process")
+    return HttpResponse(sink.render(), content_type="text/plain; version=0.0.4")
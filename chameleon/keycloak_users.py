@@ -0,0 +1,184 @@
+"""Portal mirror of the Keycloak user directory.
+
+Reports used to page through every Keycloak user each time they ran. The
+directory is now mirrored in ``KeycloakDirectoryUser`` by :func:`sync`, and
+read with :func:`users` and :func:`users_attributes`, which take queryset
+filters.
+
+Keycloak cannot list the users changed since a point in time, so :func:`sync`
+fetches the pages of users in parallel and only writes the users whose
+representation changed since the last sync. Users no longer listed are
+checked one by one before being removed, as pages shift when users are added
+or removed during a sync.
+"""
+
+import hashlib
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import transaction
+from django.utils import timezone
+
+from chameleon.models import KeycloakDirectoryUser
+from util.keycloak_client import DATETIME_FORMAT, KeycloakClient, UserAttributes
+
+LOG = logging.getLogger(__name__)
+
+PAGE_SIZE = 500
+WORKERS = 4
+
+_SYNCED_FIELDS = [
+    "username",
+    "email",
+    "first_name",
+    "last_name",
+    "enabled",
+    "created_at",
+    "affiliation_title",
+    "affiliation_department",
+    "affiliation_institution",
+    "country",
+    "citizenship",
+    "lifecycle_allocation_joined",
+    "group_events",
+    "attributes",
+    "checksum",
+    "updated_at",
+]
+
+
+def _checksum(kc_user):
+    return hashlib.sha256(
+        json.dumps(kc_user, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def _parse_datetime(value):
+    try:
+        return datetime.strptime(value, DATETIME_FORMAT).replace(tzinfo=dt_timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+def _directory_user(kc_user, now):
+    attributes = kc_user.get("attributes") or {}
+
+    def first(name):
+        return next(iter(attributes.get(name) or []), "") or ""
+
+    created = kc_user.get("createdTimestamp")
+    return KeycloakDirectoryUser(
+        sub=kc_user["id"],
+        username=kc_user.get("username", ""),
+        email=kc_user.get("email") or "",
+        first_name=kc_user.get("firstName") or "",
+        last_name=kc_user.get("lastName") or "",
+        enabled=kc_user.get("enabled", True),
+        created_at=(
+            datetime.fromtimestamp(created / 1000, tz=dt_timezone.utc)
+            if created
+            else None
+        ),
+        affiliation_title=first("affiliationTitle")[:500],
+        affiliation_department=first("affiliationDepartment")[:500],
+        affiliation_institution=" || ".join(
+            attributes.get("affiliationInstitution") or []
+        ),
+        country=first("country")[:255],
+        citizenship=first("citizenship")[:255],
+        lifecycle_allocation_joined=_parse_datetime(
+            first(UserAttributes.LIFECYCLE_ALLOCATION_JOINED)
+        ),
+        group_events=attributes.get(UserAttributes.GROUP_EVENTS, []),
+        attributes=attributes,
+        checksum=_checksum(kc_user),
+        updated_at=now,
+    )
+
+
+def sync(keycloak_client=None):
+    """Bring ``KeycloakDirectoryUser`` up to date with Keycloak.
+
+    Returns:
+        A dict of counts and the duration in seconds of the sync.
+    """
+    started = time.perf_counter()
+    now = timezone.now()
+    keycloak_client = keycloak_client or KeycloakClient()
+    users_admin = keycloak_client._users_admin()
+    known = {
+        sub: (pk, checksum)
+        for pk, sub, checksum in KeycloakDirectoryUser.objects.values_list(
+            "pk", "sub", "checksum"
+        )
+    }
+
+    def fetch(first):
+        return keycloak_client.get_users_page(
+            first, PAGE_SIZE, keycloakusers=users_admin
+        )
+
+    total = keycloak_client.count_users(keycloakusers=users_admin)
+    # One more page, for the users added during the sync
+    firsts = range(0, total + PAGE_SIZE, PAGE_SIZE)
+    seen = set()
+    created = updated = 0
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        for page in executor.map(fetch, firsts):
+            new = []
+            changed = []
+            for kc_user in page:
+                sub = kc_user["id"]
+                if sub in seen:
+                    continue
+                seen.add(sub)
+                pk, checksum = known.get(sub, (None, None))
+                if checksum == _checksum(kc_user):
+                    continue
+                directory_user = _directory_user(kc_user, now)
+                if pk is None:
+                    new.append(directory_user)
+                else:
+                    directory_user.pk = pk
+                    changed.append(directory_user)
+            with transaction.atomic():
+                KeycloakDirectoryUser.objects.bulk_create(new)
+                KeycloakDirectoryUser.objects.bulk_update(changed, _SYNCED_FIELDS)
+            created += len(new)
+            updated += len(changed)
+
+    removed = [
+        sub for sub in known.keys() - seen if not keycloak_client.user_exists(sub)
+    ]
+    KeycloakDirectoryUser.objects.filter(sub__in=removed).delete()
+
+    report = {
+        "users": len(seen),
+        "created": created,
+        "updated": updated,
+        "removed": len(removed),
+        "total_seconds": round(time.perf_counter() - started, 3),
+    }
+    LOG.info(f"Keycloak user sync: {report}")
+    return report
+
+
+def users(*args, **filters):
+    """Mirrored Keycloak users, filtered like ``QuerySet.filter``."""
+    return KeycloakDirectoryUser.objects.filter(*args, **filters)
+
+
+def users_attributes(*args, **filters):
+    """The attributes of mirrored users by username.
+
+    Same as ``KeycloakClient.get_all_users_attributes``, for the users
+    matching the filters.
+    """
+    return dict(
+        users(*args, **filters)
+        .values_list("username", "attributes")
+        .iterator(chunk_size=2000)
+    )
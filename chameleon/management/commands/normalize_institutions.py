@@ -3,7 +3,7 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import transaction
 import json
-from util.keycloak_client import KeycloakClient
+from chameleon import keycloak_users
 
 
 from chameleon.models import Institution, InstitutionAlias, UserInstitution
@@ -39,11 +39,14 @@ class Command(BaseCommand):
 
         self.stdout.write(f"Processing {users.count()} users")
 
-        keycloak_client = KeycloakClient()
-        kc_user_map = keycloak_client.get_all_users_attributes()
+        directory_users = {
+            directory_user.username: directory_user
+            for directory_user in keycloak_users.users(
+                username__in=users.values("username")
+            )
+        }
         for user in users.iterator():
-            # fetch user from
-            kc_user = kc_user_map.get(user.username)
+            kc_user = directory_users.get(user.username)
             if not kc_user:
                 # Legacy user, no login since fed. identity
                 continue
@@ -52,7 +55,7 @@ class Command(BaseCommand):
 
     def process_user(self, user, kc_user):
         # Try to match user to a known institution or alias
-        raw_value = kc_user.get("attributes", {}).get("affiliationInstitution")
+        raw_value = kc_user.affiliation_institution
         if raw_value:
             raw_value = raw_value.strip()
 
@@ -85,7 +88,7 @@ class Command(BaseCommand):
         # Use AI to generate an alias -> institution mapping
         if not raw_value:
             raw_value = domain or ""
-        country = kc_user.get("attributes", {}).get("country")
+        country = kc_user.country or None
         ai_data = self.generate_institution_metadata(raw_value, domain, country)
         if ai_data:
             inst, created = Institution.objects.get_or_create(
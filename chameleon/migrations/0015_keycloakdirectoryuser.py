@@ -0,0 +1,36 @@
+# Generated by Django 4.2.20 on 2026-10-18 20:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chameleon', '0014_dataset_datasetdownloadevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeycloakDirectoryUser',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sub', models.CharField(max_length=255, unique=True)),
+                ('username', models.CharField(db_index=True, max_length=255)),
+                ('email', models.CharField(blank=True, db_index=True, max_length=255)),
+                ('first_name', models.CharField(blank=True, max_length=255)),
+                ('last_name', models.CharField(blank=True, max_length=255)),
+                ('enabled', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(blank=True, null=True)),
+                ('affiliation_title', models.CharField(blank=True, max_length=500)),
+                ('affiliation_department', models.CharField(blank=True, max_length=500)),
+                ('affiliation_institution', models.TextField(blank=True)),
+                ('country', models.CharField(blank=True, db_index=True, max_length=255)),
+                ('citizenship', models.CharField(blank=True, max_length=255)),
+                ('lifecycle_allocation_joined', models.DateTimeField(blank=True, null=True)),
+                ('group_events', models.JSONField(blank=True, default=list)),
+                ('attributes', models.JSONField(blank=True, default=dict)),
+                ('checksum', models.CharField(max_length=64)),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -140,6 +140,38 @@ class KeycloakUser(models.Model):
     sub = models.CharField(max_length=255, unique=True, null=True, blank=True)
 
 
+class KeycloakDirectoryUser(models.Model):
+    """A Keycloak user, as last synced by ``chameleon.keycloak_users.sync``.
+
+    The profile attributes reports filter on have their own columns, holding
+    the first value of the attribute, except for ``affiliation_institution``,
+    which joins all of them with " || " as institution reports always did.
+    ``attributes`` keeps every attribute as returned by Keycloak.
+    """
+
+    sub = models.CharField(max_length=255, unique=True)
+    username = models.CharField(max_length=255, db_index=True)
+    email = models.CharField(max_length=255, blank=True, db_index=True)
+    first_name = models.CharField(max_length=255, blank=True)
+    last_name = models.CharField(max_length=255, blank=True)
+    enabled = models.BooleanField(default=True)
+    created_at = models.DateTimeField(null=True, blank=True)
+    affiliation_title = models.CharField(max_length=500, blank=True)
+    affiliation_department = models.CharField(max_length=500, blank=True)
+    affiliation_institution = models.TextField(blank=True)
+    country = models.CharField(max_length=255, blank=True, db_index=True)
+    citizenship = models.CharField(max_length=255, blank=True)
+    lifecycle_allocation_joined = models.DateTimeField(null=True, blank=True)
+    group_events = models.JSONField(default=list, blank=True)
+    attributes = models.JSONField(default=dict, blank=True)
+    # Of the Keycloak representation, to only write users that changed
+    checksum = models.CharField(max_length=64)
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.username
+
+
 class Dataset(models.Model):
     name = models.CharField(max_length=1024, unique=True)
     url = models.CharField(max_length=1024)
@@ -3,10 +3,12 @@ from django.contrib.auth.models import User
 from chameleon.models import PIEligibility
 from projects.models import Project, Publication, Tag
 from datetime import datetime, timedelta
-from django.db.models import Sum, FloatField, Count, Q, F, DurationField
+from django.db.models import Sum, FloatField, Count, Q, DurationField
 from django.db.models.functions import TruncYear
-from allocations.models import Charge, Allocation
-from util.keycloak_client import KeycloakClient
+from django.utils import timezone
+from allocations import rollups
+from allocations.models import Allocation
+from chameleon import keycloak_users
 from projects.util import get_project_members
 from collections import defaultdict
 import functools
@@ -28,9 +30,6 @@ LOG = logging.getLogger(__name__)
 
 
 def institution_report():
-    kcc = KeycloakClient()
-    kcc_users = kcc.get_all_users_attributes()
-
     @functools.lru_cache()
     def similarity_score(str1, str2):
         ratio = SequenceMatcher(None, str1.lower(), str2.lower()).ratio()
@@ -39,15 +38,14 @@ def institution_report():
     edu_users = get_education_users()
     insts = set()
     edu_insts = set()
-    for u in kcc_users:
-        user = kcc_users[u]
-        if not user:
-            continue
-        inst = user.get("affiliationInstitution", "")
-        if isinstance(inst, list):
-            inst = " || ".join(inst)
+    directory_users = (
+        keycloak_users.users()
+        .exclude(attributes={})
+        .values_list("username", "affiliation_institution")
+    )
+    for username, inst in directory_users.iterator():
         insts.add(inst.lower())
-        if user.get("username") in edu_users:
+        if username in edu_users:
             edu_insts.add(inst.lower())
 
     MSI_UNI_SET = set(MSI_UNIVERFSITY_LIST)
@@ -280,6 +278,7 @@ def get_sus_context():
     new_data["Total"] = {all_sum: ""}
     return {
         "su_usage_data": new_data,
+        "su_usage_updated_at": rollups.refreshed_at(),
     }
 
 
@@ -299,22 +298,18 @@ def get_education_users():
 def su_information(start_year, end_year):
     su_usage_data = {}
 
+    yearly_usage = rollups.usage(
+        start=timezone.make_aware(datetime(start_year, 1, 1)),
+        end=timezone.make_aware(datetime(end_year + 1, 1, 1)),
+        period="year",
+        group_by=["region_name"],
+    )
     for year in range(start_year, end_year + 1):
-        # Calculate SU usage
-        sus = (
-            Charge.objects.filter(start_time__year=year)
-            .annotate(duration=F("end_time") - F("start_time"))
-            .values("region_name", "duration", "hourly_cost")
-        )
-        total_su = defaultdict(int)
-        total_su_all = 0
-        for su in sus:
-            cost = su["duration"].total_seconds() / 3600 * su["hourly_cost"]
-            total_su[su["region_name"]] += cost
-            total_su_all += cost
-        total_su["All Sites"] = total_su_all
-        # Append data to the dictionary
-        su_usage_data[year] = total_su
+        su_usage_data[year] = defaultdict(int)
+    for row in yearly_usage:
+        su_usage_data[row["period"].year][row["region_name"]] += row["sus"]
+    for total_su in su_usage_data.values():
+        total_su["All Sites"] = sum(total_su.values())
     return su_usage_data
 
 
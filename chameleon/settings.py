@@ -72,6 +72,11 @@ if UC_OPENSTACK_DB_HOST:
         "passwd": UC_OPENSTACK_DB_PASSWORD,
     }
 
+# Idle connections kept open to each region's database
+ALLOCATIONS_REGION_DB_POOL_SIZE = int(
+    os.environ.get("ALLOCATIONS_REGION_DB_POOL_SIZE", 2)
+)
+
 # Change to http for local dev only
 SSO_CALLBACK_PROTOCOL = os.environ.get("SSO_CALLBACK_PROTOCOL", "https")
 SSO_CALLBACK_VALID_HOSTS = os.environ.get("SSO_CALLBACK_VALID_HOSTS", [])
@@ -348,6 +353,15 @@ KEYCLOAK_PORTAL_ADMIN_CLIENT_SECRET = os.environ.get(
 )
 KEYCLOAK_CLIENT_PROVIDER_ALIAS = os.environ.get("KEYCLOAK_CLIENT_PROVIDER_ALIAS")
 KEYCLOAK_CLIENT_PROVIDER_SUB = os.environ.get("KEYCLOAK_CLIENT_PROVIDER_SUB")
+# Project groups looked up in Keycloak are cached this long
+KEYCLOAK_GROUP_CACHE_TTL_SECONDS = int(
+    os.environ.get("KEYCLOAK_GROUP_CACHE_TTL_SECONDS", 60 * 5)
+)
+# Project members and their roles are cached this long, changes made from the
+# portal are written through
+KEYCLOAK_MEMBERSHIP_CACHE_TTL_SECONDS = int(
+    os.environ.get("KEYCLOAK_MEMBERSHIP_CACHE_TTL_SECONDS", 60 * 10)
+)
 
 AUTHENTICATION_BACKENDS = ("chameleon.ChameleonOIDCAuthBackend.ChameleonOIDCAB",)
 
@@ -801,6 +815,20 @@ PENDING_ALLOCATION_NOTIFICATION_EMAIL = os.environ.get(
     "PENDING_ALLOCATION_NOTIFICATION_EMAIL", ""
 )
 ACTIVATE_EXPIRE_ALLOCATION_FREQUENCY = 60 * 5
+# Allocation activation and expiration jobs are only enqueued this long ahead,
+# below the Redis broker's one hour visibility timeout
+ALLOCATIONS_TRANSITION_HORIZON_SECONDS = int(
+    os.environ.get("ALLOCATIONS_TRANSITION_HORIZON_SECONDS", 60 * 30)
+)
+# Charges of allocations expired for longer are moved to the archive table
+ALLOCATIONS_CHARGE_ARCHIVE_AFTER_DAYS = int(
+    os.environ.get("ALLOCATIONS_CHARGE_ARCHIVE_AFTER_DAYS", 365)
+)
+# Reservations that started this long ago are compared with OpenStack by the
+# charge audit
+ALLOCATIONS_CHARGE_AUDIT_WINDOW_DAYS = int(
+    os.environ.get("ALLOCATIONS_CHARGE_AUDIT_WINDOW_DAYS", 30)
+)
 ACTIVATE_EXPIRE_INVITATION_FREQUENCY = 60 * 5
 
 ########
@@ -828,6 +856,14 @@ CELERY_BEAT_SCHEDULE = {
             minute="*/{}".format(int(ACTIVATE_EXPIRE_ALLOCATION_FREQUENCY // 60))
         ),
     },
+    "check-keycloak-allocation-consistency": {
+        "task": "allocations.tasks.check_keycloak_consistency",
+        "schedule": crontab(minute=45),
+    },
+    "sync-keycloak-users": {
+        "task": "chameleon.tasks.sync_keycloak_users",
+        "schedule": crontab(minute=20),
+    },
     "activate-expire-invitations": {
         "task": "projects.tasks.activate_expire_invitations",
         "schedule": crontab(
@@ -846,6 +882,14 @@ CELERY_BEAT_SCHEDULE = {
         "task": "allocations.tasks.warn_user_for_low_allocations",
         "schedule": crontab(minute=30, hour=7),
     },
+    "rollup-charges": {
+        "task": "allocations.tasks.rollup_charges",
+        "schedule": crontab(minute="*/15"),
+    },
+    "archive-charges": {
+        "task": "allocations.tasks.archive_charges",
+        "schedule": crontab(minute=0, hour=3),
+    },
 }
 if DEBUG:
     CELERY_BEAT_SCHEDULE = {}
@@ -904,6 +948,8 @@ if DEBUG:
     # Webpack uses eval to provide its Hot Module Replacement capability
     CSP_SCRIPT_SRC.append("'unsafe-eval'")
 
+# Use a cache shared by all workers in production: the balance service relies
+# on it to deduplicate retried enforcement callbacks (check balance_service.W001)
 CACHES = {
     "default": {
         "BACKEND": os.environ.get(
@@ -923,6 +969,54 @@ if DEBUG:
 ALLOWED_OPENSTACK_SERVICE_USERS = os.environ.get(
     "ALLOWED_OPENSTACK_SERVICE_USERS", ["blazar", "portal", "smoke-tests"]
 )
+# How long a validated service token is trusted before asking Keystone again,
+# capped by the token's own expiry
+BALANCE_SERVICE_TOKEN_CACHE_TTL_SECONDS = int(
+    os.environ.get("BALANCE_SERVICE_TOKEN_CACHE_TTL_SECONDS", 60 * 5)
+)
+BALANCE_SERVICE_TOKEN_NEGATIVE_CACHE_TTL_SECONDS = int(
+    os.environ.get("BALANCE_SERVICE_TOKEN_NEGATIVE_CACHE_TTL_SECONDS", 30)
+)
+# How long Keystone project charge codes and usernames are shared between
+# workers; both are fixed for the lifetime of a project or user id
+BALANCE_SERVICE_KEYSTONE_LOOKUP_CACHE_TTL_SECONDS = int(
+    os.environ.get("BALANCE_SERVICE_KEYSTONE_LOOKUP_CACHE_TTL_SECONDS", 60 * 10)
+)
+# How often each worker checks whether ConfigVariables changed elsewhere
+BALANCE_SERVICE_CONFIG_RECHECK_SECONDS = int(
+    os.environ.get("BALANCE_SERVICE_CONFIG_RECHECK_SECONDS", 5)
+)
+# How long a lease price quote is reused for the same lease, project and user
+BALANCE_SERVICE_QUOTE_CACHE_TTL_SECONDS = int(
+    os.environ.get("BALANCE_SERVICE_QUOTE_CACHE_TTL_SECONDS", 60)
+)
+# How long the response to a Blazar enforcement callback is replayed to retries
+BALANCE_SERVICE_IDEMPOTENCY_TTL_SECONDS = int(
+    os.environ.get("BALANCE_SERVICE_IDEMPOTENCY_TTL_SECONDS", 60 * 10)
+)
+# How long a retry waits for the original callback to finish
+BALANCE_SERVICE_IDEMPOTENCY_WAIT_SECONDS = int(
+    os.environ.get("BALANCE_SERVICE_IDEMPOTENCY_WAIT_SECONDS", 30)
+)
+# How long a callback holds its in-flight lock if it is never released, well
+# above the request timeout so a slow callback cannot be processed twice
+BALANCE_SERVICE_IDEMPOTENCY_LOCK_SECONDS = int(
+    os.environ.get("BALANCE_SERVICE_IDEMPOTENCY_LOCK_SECONDS", 60 * 10)
+)
+# Where request phase timings are reported: an in-process Prometheus registry
+# exposed at /api/balance_service/v2/metrics/, statsd, or nowhere if empty
+BALANCE_SERVICE_METRICS_SINK = os.environ.get(
+    "BALANCE_SERVICE_METRICS_SINK", "balance_service.utils.metrics.PrometheusSink"
+)
+BALANCE_SERVICE_STATSD_HOST = os.environ.get("BALANCE_SERVICE_STATSD_HOST", "localhost")
+BALANCE_SERVICE_STATSD_PORT = int(os.environ.get("BALANCE_SERVICE_STATSD_PORT", 8125))
+BALANCE_SERVICE_STATSD_PREFIX = os.environ.get(
+    "BALANCE_SERVICE_STATSD_PREFIX", "balance_service"
+)
+# Requests slower than this are logged with their phase timings
+BALANCE_SERVICE_SLOW_REQUEST_SECONDS = float(
+    os.environ.get("BALANCE_SERVICE_SLOW_REQUEST_SECONDS", 2)
+)
 
 ########
 # Publication
@@ -5,6 +5,7 @@ from celery.utils.log import get_task_logger
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db.models import Q
+from chameleon import keycloak_users
 from chameleon.models import Institution, InstitutionAlias, UserInstitution
 from cinderclient.v3 import client as cinder_client
 import glanceclient
@@ -339,6 +340,12 @@ def update_institutions(interactive=True):
             )
 
 
+@task()
+def sync_keycloak_users():
+    """Mirror the users changed in Keycloak since the last sync."""
+    keycloak_users.sync()
+
+
 class AdminTaskManager:
     """This is used to add a "start_task" and "check_task" view to an admin page.
     This is useful for one-off tasks that an admin should initiate.
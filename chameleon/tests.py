@@ -0,0 +1,93 @@
+from unittest.mock import MagicMock
+
+from django.test import TestCase
+
+from chameleon import keycloak_users
+from chameleon.models import KeycloakDirectoryUser
+
+
+def kc_user(i, **attributes):
+    return {
+        "id": f"sub-{i}",
+        "username": f"user{i}",
+        "email": f"user{i}@example.edu",
+        "enabled": True,
+        "createdTimestamp": 1700000000000,
+        "attributes": {key: [value] for key, value in attributes.items()},
+    }
+
+
+class KeycloakUserSyncTests(TestCase):
+    def _client(self, users, existing=()):
+        client = MagicMock()
+        client.count_users.return_value = len(users)
+        client.get_users_page.side_effect = (
+            lambda first, page_size, keycloakusers=None: users[
+                first : first + page_size
+            ]
+        )
+        client.user_exists.side_effect = lambda sub: sub in existing
+        return client
+
+    def test_sync_creates_updates_and_removes_users(self):
+        users = [kc_user(i, affiliationInstitution="UChicago") for i in range(5)]
+        report = keycloak_users.sync(self._client(users))
+        self.assertEqual(report["created"], 5)
+        self.assertEqual(KeycloakDirectoryUser.objects.count(), 5)
+
+        users[1] = kc_user(1, affiliationInstitution="TACC", country="USA")
+        del users[4]
+        users.append(kc_user(5))
+        client = self._client(users)
+        report = keycloak_users.sync(client)
+
+        self.assertEqual(
+            (report["created"], report["updated"], report["removed"]), (1, 1, 1)
+        )
+        client.user_exists.assert_called_once_with("sub-4")
+        updated = KeycloakDirectoryUser.objects.get(sub="sub-1")
+        self.assertEqual(updated.affiliation_institution, "TACC")
+        self.assertEqual(updated.country, "USA")
+        self.assertFalse(KeycloakDirectoryUser.objects.filter(sub="sub-4").exists())
+
+    def test_sync_skips_unchanged_users(self):
+        users = [kc_user(i) for i in range(3)]
+        keycloak_users.sync(self._client(users))
+        before = dict(KeycloakDirectoryUser.objects.values_list("sub", "updated_at"))
+
+        report = keycloak_users.sync(self._client(users))
+
+        self.assertEqual((report["created"], report["updated"]), (0, 0))
+        self.assertEqual(
+            dict(KeycloakDirectoryUser.objects.values_list("sub", "updated_at")),
+            before,
+        )
+
+    def test_users_missing_from_pages_are_kept_if_they_exist(self):
+        users = [kc_user(i) for i in range(3)]
+        keycloak_users.sync(self._client(users))
+
+        # A user shifted out of the pages during the sync
+        report = keycloak_users.sync(self._client(users[:2], existing={"sub-2"}))
+
+        self.assertEqual(report["removed"], 0)
+        self.assertEqual(KeycloakDirectoryUser.objects.count(), 3)
+
+    def test_all_institutions_are_kept(self):
+        user = kc_user(1)
+        user["attributes"]["affiliationInstitution"] = ["UChicago", "TACC"]
+        keycloak_users.sync(self._client([user]))
+
+        self.assertEqual(
+            KeycloakDirectoryUser.objects.get(sub="sub-1").affiliation_institution,
+            "UChicago || TACC",
+        )
+
+    def test_users_attributes(self):
+        keycloak_users.sync(
+            self._client([kc_user(1, country="USA"), kc_user(2, country="France")])
+        )
+        self.assertEqual(
+            keycloak_users.users_attributes(username__in=["user1"]),
+            {"user1": {"country": ["USA"]}},
+        )
@@ -0,0 +1,68 @@
+import unittest
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+
+from chameleon.models import KeycloakUser
+from projects.util import get_user_by_reference, get_users_by_reference
+
+
+class GetUsersByReferenceTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.by_sub = User.objects.create(username="alice", email="a@example.com")
+        KeycloakUser.objects.create(user=self.by_sub, sub="sub-alice")
+        self.by_username = User.objects.create(username="Bob", email="b@example.com")
+        self.by_email = User.objects.create(username="carol", email="C@example.com")
+        # Both match "dave" by email, the first one wins
+        self.first = User.objects.create(username="dave1", email="d@example.com")
+        User.objects.create(username="dave2", email="D@example.com")
+
+    def _assert_resolves(self, kc_users, expected):
+        with self.assertNumQueries(3):
+            users = get_users_by_reference(kc_users)
+
+        self.assertEqual(users, expected)
+        self.assertEqual(
+            users,
+            [
+                get_user_by_reference(
+                    keycloak_id=u["id"], username=u["username"], email=u["email"]
+                )
+                for u in kc_users
+            ],
+        )
+
+    def test_same_users_as_one_by_one(self):
+        self._assert_resolves(
+            [
+                {"id": "sub-alice", "username": "Bob", "email": "C@example.com"},
+                {"id": "sub-unknown", "username": "Bob", "email": "C@example.com"},
+                {"id": "sub-carol", "username": "nobody", "email": "C@example.com"},
+                {"id": "sub-dave", "username": "dave", "email": "d@example.com"},
+                {"id": "sub-eve", "username": "eve", "email": None},
+            ],
+            [self.by_sub, self.by_username, self.by_email, self.first, None],
+        )
+
+    @unittest.skipUnless(
+        connection.vendor == "mysql", "Needs a case-insensitive collation"
+    )
+    def test_references_match_case_insensitively(self):
+        self._assert_resolves(
+            [
+                {"id": "sub-bob", "username": "bob", "email": None},
+                {"id": "sub-carol", "username": "nobody", "email": "c@EXAMPLE.com"},
+                {"id": "sub-dave", "username": "dave", "email": "D@EXAMPLE.COM"},
+            ],
+            [self.by_username, self.by_email, self.first],
+        )
+
+    def test_query_count_does_not_grow_with_members(self):
+        kc_users = [
+            {"id": f"sub-{i}", "username": f"student{i}", "email": None}
+            for i in range(200)
+        ]
+        with self.assertNumQueries(2):
+            self.assertEqual(get_users_by_reference(kc_users), [None] * 200)
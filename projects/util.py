@@ -37,28 +37,92 @@ def get_user_by_reference(keycloak_id=None, username=None, email=None):
     return None
 
 
-def get_project_members(project):
-    keycloak_client = KeycloakClient()
-    charge_code = get_charge_code(project)
+def get_users_by_reference(kc_users):
+    """
+    Batch version of ``get_user_by_reference`` for Keycloak user dicts.
 
-    users = []
-    for kc_user in keycloak_client.get_project_members(charge_code):
-        # match KC user by ID, then username, then email
-        user = get_user_by_reference(
-            keycloak_id=kc_user["id"],
-            username=kc_user["username"],
-            email=kc_user.get("email"),
+    Resolves every user with at most three queries, by Keycloak ID, then by
+    username, then by email, with the same priority as
+    ``get_user_by_reference``. Usernames and emails are looked up with plain
+    ``IN`` filters, so that their indexes are used, and match as the database
+    collation compares them: case-insensitively on MySQL. When several users
+    match, the one with the lowest id wins.
+
+    Args:
+        kc_users (list): Keycloak user dicts, with ``id``, ``username`` and
+            optionally ``email``.
+
+    Returns:
+        list: The Django User model of each Keycloak user, or None when not
+            found, in the order of ``kc_users``.
+    """
+    resolved = [None] * len(kc_users)
+
+    subs = {kc_user["id"] for kc_user in kc_users if kc_user.get("id")}
+    by_sub = {
+        keycloak_user.sub: keycloak_user.user
+        for keycloak_user in KeycloakUser.objects.filter(sub__in=subs).select_related(
+            "user"
         )
+    }
+    for i, kc_user in enumerate(kc_users):
+        resolved[i] = by_sub.get(kc_user.get("id"))
+        if kc_user.get("id") and not resolved[i]:
+            logger.warning(f"Could not find KeycloakUser with sub={kc_user['id']}")
+
+    for field in ("username", "email"):
+        values = {
+            kc_user[field]
+            for user, kc_user in zip(resolved, kc_users)
+            if not user and kc_user.get(field)
+        }
+        if not values:
+            continue
+        values |= {value.lower() for value in values}
+        by_value = {}
+        # Highest id first, so the lowest id is kept
+        for user in (
+            get_user_model().objects.filter(**{f"{field}__in": values}).order_by("-pk")
+        ):
+            by_value[getattr(user, field).lower()] = user
+        for i, kc_user in enumerate(kc_users):
+            if not resolved[i] and kc_user.get(field):
+                resolved[i] = by_value.get(kc_user[field].lower())
+
+    return resolved
+
+
+def _portal_users(kc_users):
+    users = []
+    for kc_user, user in zip(kc_users, get_users_by_reference(kc_users)):
         if user:
             users.append(user)
         else:
             logger.warning(
                 f"Could not get user model for Keycloak user {kc_user['id']}"
             )
-
     return users
 
 
+def get_project_members(project):
+    keycloak_client = KeycloakClient()
+    charge_code = get_charge_code(project)
+    return _portal_users(keycloak_client.get_project_members(charge_code))
+
+
+def get_project_membership(project):
+    """The portal users of a project and the roles of members by username.
+
+    Reads the members and their roles with one (cached) Keycloak lookup.
+    """
+    keycloak_client = KeycloakClient()
+    charge_code = get_charge_code(project)
+    membership = keycloak_client.get_project_membership(charge_code)
+    if membership is None:
+        raise ValueError(f"Couldn't find project {charge_code}")
+    return _portal_users(membership["members"]), membership["roles"]
+
+
 def email_exists_on_project(project, email_address):
     for member in get_project_members(project):
         if email_address == member.email:
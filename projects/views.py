@@ -28,7 +28,8 @@ from django.utils.html import strip_tags
 from django.views.decorators.http import require_POST
 from keycloak.exceptions import KeycloakClientError
 
-from allocations.models import Allocation, Charge, ChargeBudget
+from allocations import archive
+from allocations.models import Allocation, ChargeBudget
 from balance_service.utils import su_calculators
 from chameleon.decorators import terms_required
 from chameleon.keystone_auth import admin_ks_client
@@ -51,7 +52,12 @@ from .forms import (
     ProjectCreateForm,
 )
 from .models import Invitation, Project, ProjectExtras
-from .util import get_charge_code, get_project_members, get_user_by_reference
+from .util import (
+    get_charge_code,
+    get_project_members,
+    get_project_membership,
+    get_user_by_reference,
+)
 
 logger = logging.getLogger("projects")
 
@@ -351,10 +357,7 @@ def view_project(request, project_id):
     pi_form = EditPIForm()
     bulk_user_form = ProjectAddBulkUserForm()
 
-    user_roles = keycloak_client.get_roles_for_all_project_members(
-        get_charge_code(project)
-    )
-    users = get_project_members(project)
+    users, user_roles = get_project_membership(project)
     users_by_username = {u.username: u for u in users}
     if project.active_allocations:
         current_allocation_su_allocated = project.active_allocations[0].computeAllocated
@@ -427,6 +430,7 @@ def view_project(request, project_id):
                     get_charge_code(project),
                     role_name,
                 )
+                users_is_stale = True
                 if role_name == "manager":
                     # delete user budgets for the user if they are manager
                     try:
@@ -562,7 +566,7 @@ def view_project(request, project_id):
             users_is_stale = True
             non_managers = [
                 user
-                for user in get_project_members(project)
+                for user in users
                 if user_roles.get(user.username) not in ("admin", "manager")
             ]
             errors = []
@@ -591,7 +595,7 @@ def view_project(request, project_id):
                 a.end = datetime.strptime(a.end, "%Y-%m-%dT%H:%M:%SZ")
 
     if users_is_stale:
-        users = get_project_members(project)
+        users, user_roles = get_project_membership(project)
 
     if not project_member_or_admin_or_superuser(request.user, project, users):
         raise PermissionDenied
@@ -1269,7 +1273,7 @@ def get_project_membership_managers(project):
 def view_charge(request, allocation_id):
     charges = []
     alloc = Allocation.objects.get(pk=allocation_id)
-    for charge in Charge.objects.filter(allocation__pk=allocation_id):
+    for charge in archive.all_charges(allocation__pk=allocation_id):
         used_sus = su_calculators.get_used_sus(charge)
         charge = model_to_dict(charge)
         portal_user = User.objects.get(pk=charge["user"])
@@ -1299,11 +1303,9 @@ def project_member_export(request, project_id):
         content_type="text/csv",
         headers={"Content-Disposition": f'attachment; filename="{project.title}.csv"'},
     )
-    user_roles = keycloak_client.get_roles_for_all_project_members(
-        get_charge_code(project)
-    )
+    users, user_roles = get_project_membership(project)
     members = []
-    for user in get_project_members(project):
+    for user in users:
         role = (
             "manager"
             if user_roles.get(user.username, "member") in ("admin", "manager")
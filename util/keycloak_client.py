@@ -1,8 +1,13 @@
 import json
 import logging
+import os
+import threading
+import time
 from datetime import datetime, timezone
+from urllib.parse import urlencode
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from keycloak.admin.groups import Groups
 from keycloak.admin.user.usergroup import UserGroups
@@ -10,6 +15,7 @@ from keycloak.admin.user.usergrouproles import UserGroupRoles
 from keycloak.admin.users import User, Users
 from keycloak.exceptions import KeycloakClientError
 from keycloak.realm import KeycloakRealm
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +31,78 @@ class DuplicateUserError(Exception):
     pass
 
 
+class AdminTokenManager:
+    """The master realm admin token and HTTP connections of a process.
+
+    The client credentials token is reused until ``EXPIRY_MARGIN_SECONDS``
+    before it expires. When it is due, one thread fetches a new token while
+    the others wait for it. Admin clients read the token on every request, so
+    clients kept across a renewal use the new token. All requests go through
+    one session, which keeps up to ``HTTP_POOL_SIZE`` connections alive.
+    """
+
+    EXPIRY_MARGIN_SECONDS = 30
+    HTTP_POOL_SIZE = 10
+
+    def __init__(self, server_url, client_id, client_secret):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.realm = KeycloakRealm(server_url=server_url, realm_name="master")
+        adapter = HTTPAdapter(pool_maxsize=self.HTTP_POOL_SIZE)
+        self.realm.client.session.mount("http://", adapter)
+        self.realm.client.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        # The access token and when to renew it, replaced together
+        self._token = (None, 0.0)
+
+    def get_token(self):
+        access_token, renew_at = self._token
+        if time.monotonic() < renew_at:
+            return access_token
+        with self._lock:
+            access_token, renew_at = self._token
+            if time.monotonic() >= renew_at:
+                openid = self.realm.open_id_connect(
+                    client_id=self.client_id, client_secret=self.client_secret
+                )
+                token = openid.client_credentials()
+                expires_in = token.get("expires_in", 60)
+                access_token = token.get("access_token")
+                self._token = (
+                    access_token,
+                    time.monotonic()
+                    + max(expires_in - self.EXPIRY_MARGIN_SECONDS, expires_in / 2),
+                )
+        return access_token
+
+    def admin_client(self):
+        return self.realm.admin.set_token(self.get_token)
+
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+# Forked workers must not share the parent's connections
+os.register_at_fork(after_in_child=_token_managers.clear)
+
+
+def get_token_manager(server_url, client_id, client_secret):
+    """The ``AdminTokenManager`` of this process for a Keycloak client."""
+    key = (server_url, client_id, client_secret)
+    with _token_managers_lock:
+        manager = _token_managers.get(key)
+        if manager is None:
+            manager = _token_managers[key] = AdminTokenManager(*key)
+    return manager
+
+
+def _group_cache_key(name):
+    return f"keycloak-group:{name}"
+
+
+def _membership_cache_key(charge_code):
+    return f"keycloak-members:{charge_code}"
+
+
 class KeycloakClient:
     def __init__(self):
         self.server_url = settings.KEYCLOAK_SERVER_URL
@@ -34,18 +112,10 @@ class KeycloakClient:
         self.client_provider_alias = (settings.KEYCLOAK_CLIENT_PROVIDER_ALIAS,)
         self.client_provider_sub = (settings.KEYCLOAK_CLIENT_PROVIDER_SUB,)
 
-    def _get_token(self, realm):
-        openid = realm.open_id_connect(
-            client_id=self.client_id, client_secret=self.client_secret
-        )
-        return openid.client_credentials()
-
     def _get_admin_client(self):
-        realm = KeycloakRealm(server_url=self.server_url, realm_name="master")
-        token = self._get_token(realm)
-        admin_client = realm.admin
-        admin_client.set_token(token.get("access_token"))
-        return admin_client
+        return get_token_manager(
+            self.server_url, self.client_id, self.client_secret
+        ).admin_client()
 
     def _users_admin(self):
         return Users(realm_name=self.realm_name, client=self._get_admin_client())
@@ -68,20 +138,56 @@ class KeycloakClient:
             realm_name=self.realm_name, user_id=user_id, client=self._get_admin_client()
         )
 
-    def _lookup_group(self, name):
+    def _lookup_group(self, name, use_cache=True):
+        """The group of a project, with its attributes and subgroups.
+
+        Groups are looked up by exact name and cached for
+        ``KEYCLOAK_GROUP_CACHE_TTL_SECONDS``. The write helpers invalidate the
+        cached group; pass ``use_cache=False`` to read a group before changing
+        it.
+        """
+        cache_key = _group_cache_key(name)
+        if use_cache:
+            group = cache.get(cache_key)
+            if group is not None:
+                return group
+        group = self._search_group(name)
+        if group is not None:
+            cache.set(cache_key, group, settings.KEYCLOAK_GROUP_CACHE_TTL_SECONDS)
+        return group
+
+    def _search_group(self, name):
         keycloakproject = self._project_admin()
-
-        matching = [
-            u
-            for u in keycloakproject._client.get(
-                url=keycloakproject._client.get_full_url(
-                    keycloakproject.get_path("collection", realm=self.realm_name)
-                ),
-                briefRepresentation=False,
+        url = keycloakproject._client.get_full_url(
+            keycloakproject.get_path("collection", realm=self.realm_name)
+        )
+        # Parameters go in the URL, as in iter_groups
+        matching = keycloakproject._client.get(
+            url=url
+            + "?"
+            + urlencode(
+                {"search": name, "exact": "true", "briefRepresentation": "false"}
             )
-            if u["name"] == name
-        ]
-        return next(iter(matching), None)
+        )
+        # Search also matches subgroups, and is a substring search before
+        # Keycloak 22
+        return next((g for g in matching if g["name"] == name), None)
+
+    def _invalidate_group(self, name):
+        cache.delete(_group_cache_key(name))
+
+    def _write_membership(self, charge_code, change):
+        """Apply ``change`` to the cached membership of a project, if cached.
+
+        Writes from two processes at once can lose one of the changes, which
+        the TTL bounds.
+        """
+        cache_key = _membership_cache_key(charge_code)
+        membership = cache.get(cache_key)
+        if membership is None:
+            return
+        change(membership)
+        cache.set(cache_key, membership, settings.KEYCLOAK_MEMBERSHIP_CACHE_TTL_SECONDS)
 
     def _add_identity(self, user_id, **kwargs):
         keycloakuser = self._user_admin(user_id)
@@ -189,6 +295,43 @@ class KeycloakClient:
 
         return result
 
+    def count_users(self, keycloakusers=None):
+        keycloakusers = keycloakusers or self._users_admin()
+        return keycloakusers._client.get(
+            url=keycloakusers._client.get_full_url(
+                keycloakusers.get_path("collection", realm=self.realm_name)
+            )
+            + "/count"
+        )
+
+    def get_users_page(self, first, page_size, keycloakusers=None):
+        """A page of users with their attributes, in username order."""
+        keycloakusers = keycloakusers or self._users_admin()
+        return keycloakusers._client.get(
+            url=keycloakusers._client.get_full_url(
+                keycloakusers.get_path("collection", realm=self.realm_name)
+            )
+            + "?briefRepresentation=false&first={first}&max={max}".format(
+                first=first, max=page_size
+            )
+        )
+
+    def user_exists(self, user_id):
+        keycloakusers = self._users_admin()
+        try:
+            keycloakusers._client.get(
+                url=keycloakusers._client.get_full_url(
+                    keycloakusers.get_path("collection", realm=self.realm_name)
+                )
+                + "/{id}".format(id=user_id)
+            )
+        except KeycloakClientError as err:
+            res = getattr(err.original_exc, "response", None)
+            if res is not None and res.status_code == 404:
+                return False
+            raise
+        return True
+
     def get_user_projects_by_user(self, portal_user):
         kc_id = self.get_keycloak_user_id_from_portal_user(portal_user)
         if not kc_id:
@@ -211,11 +354,22 @@ class KeycloakClient:
         projects = [project for project in keycloakuser.groups.all()]
         return projects
 
-    def get_project_members(self, charge_code):
+    def get_project_membership(self, charge_code, use_cache=True):
+        """The members of a project and their roles, or None without a group.
+
+        Returns a dict of the ``members``, with their ``id``, ``username`` and
+        ``email``, and of the ``roles`` of members by username. It is cached
+        for ``KEYCLOAK_MEMBERSHIP_CACHE_TTL_SECONDS``, and the membership and
+        role helpers update the cached copy as they change Keycloak.
+        """
+        cache_key = _membership_cache_key(charge_code)
+        if use_cache:
+            membership = cache.get(cache_key)
+            if membership is not None:
+                return membership
         group = self._lookup_group(charge_code)
         if not group:
-            logger.warning("Couldn't find group {} in keycloak".format(charge_code))
-            return []
+            return None
 
         keycloakproject = self._project_admin()
         members = keycloakproject._client.get(
@@ -224,7 +378,25 @@ class KeycloakClient:
             )
             + "/{id}/members?max=9999".format(id=group["id"]),
         )
-        return [m for m in members]
+        roles = self._user_project_roles_admin(None).bulk_fetch_group_member_roles(
+            group["id"]
+        )
+        membership = {
+            "members": [
+                {"id": m["id"], "username": m["username"], "email": m.get("email")}
+                for m in members
+            ],
+            "roles": dict(roles),
+        }
+        cache.set(cache_key, membership, settings.KEYCLOAK_MEMBERSHIP_CACHE_TTL_SECONDS)
+        return membership
+
+    def get_project_members(self, charge_code):
+        membership = self.get_project_membership(charge_code)
+        if membership is None:
+            logger.warning("Couldn't find group {} in keycloak".format(charge_code))
+            return []
+        return membership["members"]
 
     def update_membership(self, charge_code, portal_user, action):
         kc_id = self.get_keycloak_user_id_from_portal_user(portal_user)
@@ -244,17 +416,37 @@ class KeycloakClient:
         else:
             raise ValueError("Unrecognized keycloak membership action")
 
+        def change(membership):
+            others = [m for m in membership["members"] if m["id"] != kc_id]
+            if action == "add":
+                others.append(
+                    {
+                        "id": kc_id,
+                        "username": portal_user.username,
+                        "email": portal_user.email,
+                    }
+                )
+            else:
+                for member in membership["members"]:
+                    if member["id"] == kc_id:
+                        membership["roles"].pop(member["username"], None)
+            membership["members"] = others
+
+        self._write_membership(charge_code, change)
+
     def create_project(self, charge_code, pi_user):
         keycloakproject = Groups(
             realm_name=self.realm_name, client=self._get_admin_client()
         )
         keycloakproject.create(charge_code)
+        self._invalidate_group(charge_code)
+        cache.delete(_membership_cache_key(charge_code))
         # TODO this needs to go through a helper to set attributes
         self.update_membership(charge_code, pi_user, "add")
         self.set_user_project_role(pi_user, charge_code, "admin")
 
     def delete_project(self, charge_code):
-        group = self._lookup_group(charge_code)
+        group = self._lookup_group(charge_code, use_cache=False)
         if not group:
             logger.warning("Couldn't find group {} in keycloak".format(charge_code))
             return
@@ -266,11 +458,38 @@ class KeycloakClient:
             )
             + "/{id}".format(id=group["id"]),
         )
+        self._invalidate_group(charge_code)
+        cache.delete(_membership_cache_key(charge_code))
+
+    def iter_groups(self, page_size=500, keycloakproject=None):
+        """Yield every group with its attributes, fetching them page by page."""
+        keycloakproject = keycloakproject or self._project_admin()
+        url = keycloakproject._client.get_full_url(
+            keycloakproject.get_path("collection", realm=self.realm_name)
+        )
+        first = 0
+        while True:
+            # The admin client drops keyword arguments, so pass them in the URL
+            page = keycloakproject._client.get(
+                url=url
+                + "?briefRepresentation=false&first={first}&max={max}".format(
+                    first=first, max=page_size
+                ),
+            )
+            yield from page
+            if len(page) < page_size:
+                return
+            first += page_size
 
     def update_project(self, charge_code, **group_attributes):
-        group = self._lookup_group(charge_code)
+        group = self._lookup_group(charge_code, use_cache=False)
         if not group:
             raise ValueError(f"Group {charge_code} does not exist")
+        self.update_group(group, **group_attributes)
+
+    def update_group(self, group, keycloakproject=None, **group_attributes):
+        """Set attributes of an already fetched group, keeping its others."""
+        charge_code = group["name"]
         # Ensure all attributes are wrapped in lists
         group_attributes = {
             k: (v if isinstance(v, list) else [v]) for k, v in group_attributes.items()
@@ -278,9 +497,7 @@ class KeycloakClient:
         # Avoid nulling out existing values (PATCH not supported)
         for k, v in group.get("attributes", {}).items():
             group_attributes.setdefault(k, v)
-        keycloakproject = Groups(
-            realm_name=self.realm_name, client=self._get_admin_client()
-        )
+        keycloakproject = keycloakproject or self._project_admin()
         keycloakproject._client.put(
             url=keycloakproject._client.get_full_url(
                 keycloakproject.get_path("collection", realm=self.realm_name)
@@ -291,6 +508,7 @@ class KeycloakClient:
                 sort_keys=True,
             ),
         )
+        self._invalidate_group(charge_code)
 
     def create_user(
         self,
@@ -419,11 +637,13 @@ class KeycloakClient:
         keycloakusergrouproles = self._user_project_roles_admin(kc_id)
 
         keycloakusergrouproles.grant(policy=role, group_name=project_charge_code)
+        self._write_membership(
+            project_charge_code,
+            lambda membership: membership["roles"].update({user["username"]: role}),
+        )
 
     def get_roles_for_all_project_members(self, project_charge_code):
-        group = self._lookup_group(project_charge_code)
-        if not group:
+        membership = self.get_project_membership(project_charge_code)
+        if membership is None:
             raise ValueError(f"Couldn't find project {project_charge_code}")
-        keycloakusergrouproles = self._user_project_roles_admin(None)
-
-        return keycloakusergrouproles.bulk_fetch_group_member_roles(group["id"])
+        return membership["roles"]